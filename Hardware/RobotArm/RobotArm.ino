@@ -17,6 +17,15 @@ Servo thumb;
 char userInput;
 int i = 0;
 
+// pre-motion (commands 4, 5, 6): fingers moved part of the way from the open pose to the grab pose
+// order: pinky, ring, middle, index, thumb
+const int OPEN_POSE[5] = {150, 110, 170, 20, 150};
+const int GRAB_POSE[5] = {40, 5, 60, 110, 90};
+// a prepare with neither commit nor cancel is reverted after this delay
+const unsigned long PREPARE_TIMEOUT_MS = 1500;
+bool prepared = false;
+unsigned long preparedAt = 0;
+
 void grab() {
   pinky.write(40);
   ring.write(5);
@@ -50,9 +59,32 @@ void reset() {
   thumb.write(150);
 }
 
+void prepare(int percent) {
+  // partial and reversible: cancel() goes back to the open pose
+  percent = constrain(percent, 0, 100);
+  pinky.write(OPEN_POSE[0] + (long)(GRAB_POSE[0] - OPEN_POSE[0]) * percent / 100);
+  ring.write(OPEN_POSE[1] + (long)(GRAB_POSE[1] - OPEN_POSE[1]) * percent / 100);
+  middle.write(OPEN_POSE[2] + (long)(GRAB_POSE[2] - OPEN_POSE[2]) * percent / 100);
+  index.write(OPEN_POSE[3] + (long)(GRAB_POSE[3] - OPEN_POSE[3]) * percent / 100);
+  thumb.write(OPEN_POSE[4] + (long)(GRAB_POSE[4] - OPEN_POSE[4]) * percent / 100);
+  prepared = true;
+  preparedAt = millis();
+}
+
+void cancel() {
+  pinky.write(OPEN_POSE[0]);
+  ring.write(OPEN_POSE[1]);
+  middle.write(OPEN_POSE[2]);
+  index.write(OPEN_POSE[3]);
+  thumb.write(OPEN_POSE[4]);
+  prepared = false;
+}
+
 void setup() {
   // put your setup code here, to run once:
   Serial.begin(9600);
+  // parseInt waits this long for more digits when a command has no terminator, 1 s by default
+  Serial.setTimeout(50);
   pinky.attach(3);
   ring.attach(4);
   middle.attach(5);
@@ -62,6 +94,13 @@ void setup() {
 }
 
 void loop() {
+  if (prepared && millis() - preparedAt > PREPARE_TIMEOUT_MS) {
+    cancel();
+  }
+  // drop separators and terminators such as ';' so parseInt does not wait for digits that never come
+  while (Serial.available() > 0 && !isDigit(Serial.peek())) {
+    Serial.read();
+  }
   if(Serial.available() > 0) {
     userInput = Serial.parseInt();
     
@@ -83,5 +122,22 @@ void loop() {
       delay(500);
       reset();
     }
+    else if (userInput == 4) {
+      // "4 <percent>;" pre-motion towards grab
+      prepare(Serial.parseInt());
+      Serial.print(4);
+    }
+    else if (userInput == 5) {
+      // commit: complete the grab from wherever the pre-motion got to
+      prepared = false;
+      grab();
+      Serial.print(5);
+      delay(500);
+      reset();
+    }
+    else if (userInput == 6) {
+      cancel();
+      Serial.print(6);
+    }
   }
 }
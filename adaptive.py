@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Online adaptation of the local classifier from accepted trials
+
+AdaptiveLDA keeps the sufficient statistics of an LDA: per action a weight,
+the sum of the feature vectors and the sum of their outer products. A trial is
+added in closed form, so the class means, the pooled within-class covariance
+and the discriminant are updated in microseconds without re-reading any
+session. A forgetting factor decays the history of an action every time it gets
+a new trial, so the model follows day-to-day drift; the history of one action
+does not fade while the other is trained. Every update keeps the previous
+statistics for undo, and snapshot()/rollback() restore any saved state.
+
+TrialAdapter follows a training session: it keeps the recent EEG in a ring
+buffer, stamps the sys events with the EEG clock, and when a trial is accepted
+(MC_Completed, after Train accepted MC_Succeeded) cuts its windows, computes
+the mi_classifier features and updates the model used by
+mi_classifier.LocalCommandDetector. confirm() does the same for a live event
+confirmed by the user.
+"""
+
+import argparse
+import time
+from collections import deque
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+from epochs import extract_epochs
+from mi_classifier import DEFAULT_ACTIONS, shrink_covariance
+from ring_buffer import TimedRingBuffer
+
+
+class AdaptiveLDA():
+    """
+    A two-class LDA updated in closed form
+
+    Attributes
+    ----------
+    actions : list
+        [rest action, imagery action]
+    forgetting : float
+        weight kept by the history of an action when it gets a new trial, 1.0 keeps everything
+    shrinkage : float
+        shrinkage of the pooled covariance
+    weights, bias :
+        the current discriminant, features @ weights + bias > 0 predicts actions[1]
+    updates : int
+        trials added
+    min_count : float
+        windows each action needs before the statistics replace the discriminant set from outside
+
+    Methods
+    -------
+    from_model(model):
+        To start from the training statistics of a mi_classifier.MotorImageryModel
+    fit(features, labels):
+        To start from a labelled feature set
+    update(features, action):
+        To add the feature vectors of one trial
+    snapshot() / rollback(state):
+        To save the statistics and the discriminant and restore them; rollback() without a state undoes the
+        last update
+    apply_to(model):
+        To copy the discriminant and the statistics into a mi_classifier.MotorImageryModel
+    """
+    def __init__(self, dimension, actions=DEFAULT_ACTIONS, forgetting=0.95, shrinkage=0.1, max_undo=20,
+                 min_count=0.0):
+        self.dimension = dimension
+        self.actions = list(actions)
+        self.forgetting = forgetting
+        self.shrinkage = shrinkage
+        self.min_count = min_count
+        self.updates = 0
+        self._count = np.zeros(2)
+        self._sum = np.zeros((2, dimension))
+        self._outer = np.zeros((2, dimension, dimension))
+        self._undo = deque(maxlen=max_undo)
+        self.weights = np.zeros(dimension)
+        self.bias = 0.0
+
+    @classmethod
+    def from_model(cls, model, forgetting=0.95, min_count=200.0, **kwargs):
+        """
+        To start from a trained model: from its training statistics when it has them, so that the first
+        trials refine the offline discriminant instead of replacing it. A model saved without them keeps
+        its discriminant until each action has min_count windows of new trials.
+        """
+        learner = cls(len(model.filters), model.actions, forgetting, model.shrinkage, **kwargs)
+        if model.stats is not None:
+            learner.rollback({'count': model.stats['count'], 'sum': model.stats['sum'],
+                              'outer': model.stats['outer'], 'updates': 0})
+        else:
+            learner.min_count = min_count
+            learner.weights, learner.bias = model.weights.copy(), model.bias
+        return learner
+
+    def _class(self, action):
+        return self.actions.index(action)
+
+    def fit(self, features, labels):
+        labels = np.asarray(labels)
+        self._count[:] = 0.0
+        self._sum[:] = 0.0
+        self._outer[:] = 0.0
+        for k, action in enumerate(self.actions):
+            x = np.asarray(features, dtype=np.float64)[labels == action]
+            self._count[k] = len(x)
+            self._sum[k] = x.sum(axis=0)
+            self._outer[k] = x.T @ x
+        self._solve()
+        return self
+
+    def update(self, features, action):
+        """
+        Parameters
+        ----------
+        features : array, required
+            feature vectors of one trial, shape (n, dimension)
+        action : str, required
+            the action of the trial
+
+        Returns
+        -------
+        None
+        """
+        x = np.asarray(features, dtype=np.float64).reshape(-1, self.dimension)
+        k = self._class(action)
+        self._undo.append(self.snapshot())
+        self._count[k] = self.forgetting * self._count[k] + len(x)
+        self._sum[k] = self.forgetting * self._sum[k] + x.sum(axis=0)
+        self._outer[k] = self.forgetting * self._outer[k] + x.T @ x
+        self.updates += 1
+        self._solve()
+
+    def _solve(self):
+        # until every action has enough windows the previous discriminant is kept, such as the offline one
+        if np.any(self._count == 0) or np.any(self._count < self.min_count):
+            return
+        means = self._sum / self._count[:, None]
+        scatter = self._outer - self._count[:, None, None] * np.einsum('ki,kj->kij', means, means)
+        cov = shrink_covariance(scatter.sum(axis=0) / max(self._count.sum() - 2, 1.0), self.shrinkage)
+        self.weights = np.linalg.solve(cov, means[1] - means[0])
+        prior = np.log(self._count[1] / self._count[0])
+        self.bias = float(-self.weights @ (means[0] + means[1]) / 2.0 + prior)
+
+    def means(self):
+        return self._sum / np.maximum(self._count, 1e-12)[:, None]
+
+    def snapshot(self):
+        return {'count': self._count.copy(), 'sum': self._sum.copy(), 'outer': self._outer.copy(),
+                'updates': self.updates, 'weights': self.weights.copy(), 'bias': self.bias}
+
+    def rollback(self, state=None):
+        """
+        Parameters
+        ----------
+        state : dict, optional
+            a state returned by snapshot(). Default is the state before the last update
+
+        Returns
+        -------
+        bool
+            False when there is nothing to undo
+        """
+        if state is None:
+            if not self._undo:
+                return False
+            state = self._undo.pop()
+        self._count = state['count'].copy()
+        self._sum = state['sum'].copy()
+        self._outer = state['outer'].copy()
+        self.updates = state['updates']
+        if 'weights' in state:
+            # below min_count _solve keeps the discriminant, which must be the one of the state
+            self.weights = state['weights'].copy()
+            self.bias = state['bias']
+        self._solve()
+        return True
+
+    def decision_function(self, features):
+        return np.asarray(features) @ self.weights + self.bias
+
+    def apply_to(self, model):
+        model.weights = self.weights.copy()
+        model.bias = self.bias
+        # saved with the model, so the next session adapts from here; not while the statistics are too
+        # few to be used
+        if np.all(self._count > 0) and np.all(self._count >= self.min_count):
+            model.stats = {'count': self._count.copy(), 'sum': self._sum.copy(), 'outer': self._outer.copy()}
+
+
+class TrialAdapter(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to adapt a MotorImageryModel with the trials accepted during training
+
+    Attributes
+    ----------
+    model : mi_classifier.MotorImageryModel
+        updated in place after every accepted trial
+    learner : AdaptiveLDA
+    costs : list
+        seconds spent by every adaptation, windows and features included
+
+    Methods
+    -------
+    confirm(start, end, action):
+        To adapt on a confirmed live event between two EEG times
+    undo():
+        To remove the last adaptation
+    """
+    _events_ = ['model_adapted']
+
+    def __init__(self, model, cortex_client=None, learner=None, actions=None, forgetting=0.95, skip=0.5,
+                 step=0.25, buffer_seconds=30.0, subscribe=('eeg',)):
+        self.model = model
+        self.actions = list(actions or model.actions)
+        self.skip = skip
+        self.step = step
+        self.subscribe = list(subscribe)
+        self.learner = learner or AdaptiveLDA.from_model(model, forgetting)
+        self.costs = []
+        self._buffer = TimedRingBuffer(int(buffer_seconds * model.rate), model.filters.shape[1])
+        self._eeg_columns = cortex.EegColumns(model.filters.shape[1])
+        self._trial = -1
+        self._onset = None
+        self._end = None
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_data_labels=self.on_new_data_labels)
+        cortex_client.bind(new_eeg_data=self.on_new_eeg_data)
+        cortex_client.bind(new_sys_data=self.on_new_sys_data)
+
+    def confirm(self, start, end, action):
+        """
+        Parameters
+        ----------
+        start, end : float, required
+            EEG times of the event; it must still be in the buffer
+        action : str, required
+
+        Returns
+        -------
+        int
+            number of windows added, 0 if the event was too short or too old
+        """
+        begin = time.perf_counter()
+        times, values = self._buffer.view()
+        starts = np.arange(start + self.skip, end - self.model.window + 1e-9, self.step)
+        if len(starts) == 0 or len(times) == 0:
+            return 0
+        epochs = extract_epochs(times, values, starts, tmin=0.0, tmax=(self.model.window_samples - 1) / self.model.rate,
+                                rate=self.model.rate, baseline=None)
+        if len(epochs) == 0:
+            return 0
+        self.learner.update(self.model.features(epochs.data), action)
+        self.learner.apply_to(self.model)
+        self.costs.append(time.perf_counter() - begin)
+        self.emit('model_adapted', data={'action': action, 'windows': len(epochs), 'updates': self.learner.updates,
+                                         'time': float(end)})
+        return len(epochs)
+
+    def undo(self):
+        if self.learner.rollback():
+            self.learner.apply_to(self.model)
+            return True
+        return False
+
+    # callbacks functions
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self._buffer.append(data['time'], self._eeg_columns.select(data['eeg']))
+
+    def on_new_sys_data(self, *args, **kwargs):
+        # sys events carry no time: they are stamped with the last eeg sample
+        data = kwargs.get('data')
+        if len(data) < 2:
+            return
+        now = self._buffer.latest_time() if len(self._buffer) else None
+        if data[1] == 'MC_Started':
+            # Train trains the actions in order, trial k is for actions[k % len(actions)]
+            self._trial += 1
+            self._onset, self._end = now, None
+        elif data[1] == 'MC_Succeeded':
+            self._end = now
+        elif data[1] == 'MC_Completed' and self._onset is not None and self._end is not None:
+            self.confirm(self._onset, self._end, self.actions[self._trial % len(self.actions)])
+            self._onset = None
+        elif data[1] in ('MC_Failed', 'MC_Rejected'):
+            self._onset = None
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Train a first model with mi_classifier.py, then python train.py --adapt model.npz:
+#     every accepted trial updates the model in a few milliseconds and it is saved when training ends
+#   - Live: adapter = TrialAdapter(model, cortex) next to mi_classifier.LocalCommandDetector(model, cortex),
+#     adapter.confirm(start, end, 'lift') when the user confirms an event, adapter.undo() to take it back
+#   - python adaptive.py demo shows a model trained on one session following a drifted one
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Online adaptation of the local classifier')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('demo', help='adapt to a drifted synthetic session, trial by trial')
+    args = parser.parse_args()
+    if args.command != 'demo':
+        parser.print_help()
+        return
+
+    import os
+    import tempfile
+    from mi_classifier import session_windows, train_from_sessions
+    from synthetic import SignalGenerator, EEG_OFFSET_UV
+    folder = tempfile.mkdtemp()
+    paths = []
+    for seed in (1, 2):
+        session = SignalGenerator(seed=seed, erd_depth=0.6).generate(600, start_time=0.0)
+        if seed == 2:
+            # drift: electrode gains change between the two days
+            gains = np.random.default_rng(seed).uniform(0.3, 2.0, size=session.eeg.shape[1])
+            session.eeg = (session.eeg - EEG_OFFSET_UV) * gains + EEG_OFFSET_UV
+        paths.append(os.path.join(folder, 'day{0}.log'.format(seed)))
+        session.write_session(paths[-1], streams=('eeg',), sys_events=True)
+
+    model, _ = train_from_sessions(paths[:1], folds=1)
+    windows, labels, trials = session_windows(model, paths[1])
+    features = model.features(windows)
+    fixed = (model.decision_function(windows) > 0) == (labels == model.actions[1])
+
+    # prequential: every trial is scored with the model before it is added, starting from the day 1 statistics
+    learner = AdaptiveLDA.from_model(model)
+    adapted = np.zeros(len(labels), dtype=bool)
+    costs = []
+    for k in np.unique(trials):
+        idx = trials == k
+        adapted[idx] = (learner.decision_function(features[idx]) > 0) == (labels[idx] == model.actions[1])
+        start = time.perf_counter()
+        learner.update(features[idx], labels[idx][0])
+        costs.append(time.perf_counter() - start)
+
+    half = trials >= np.median(trials)
+    # ceiling of an LDA on these CSP filters: fitted on the whole drifted session at once
+    ceiling = AdaptiveLDA(features.shape[1], model.actions).fit(features, labels)
+    best = (ceiling.decision_function(features) > 0) == (labels == model.actions[1])
+    print('drifted session, {0} trials: fixed model {1:.1%}, adapted {2:.1%} ({3:.1%} on the second half), '
+          'LDA fitted on the whole session {4:.1%}'.format(len(np.unique(trials)), fixed.mean(), adapted.mean(),
+                                                           adapted[half].mean(), best.mean()))
+    print('update: median {0:.0f} us per trial'.format(np.median(costs) * 1e6))
+    state = learner.snapshot()
+    before = learner.weights.copy()
+    learner.update(features[:10], model.actions[1])
+    learner.rollback(state)
+    print('rollback restores the discriminant: {0}'.format(np.array_equal(before, learner.weights)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Artifact detection for gating actuation
+
+Blinks, jaw clenches and head movements make high power bursts that Cortex
+often reports as 'lift'. ArtifactDetector combines:
+    - amplitude and slope of the frontal channels (blinks, eye movements), with
+      the electrode offset removed by a slow running mean
+    - high frequency (second difference) power of every channel against its own
+      quiet level (muscle, jaw clench)
+    - deviation of the accelerometer vector of the mot stream from its slow
+      running mean (head movement)
+    - the eyeAct, uAct and lAct detections of the fac stream
+Raw EEG and mot samples are copied into short preallocated blocks and every
+test runs vectorized over a whole block and all channels, so the latency of a
+detection is bounded by one block (62.5 ms by default) and each block costs a
+few tens of microseconds. A detection keeps its source active for `hold`
+seconds; new_artifact_state is emitted whenever the overall flag changes.
+"""
+
+import sys
+import time
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+
+FRONTAL_CHANNELS = ['AF3', 'AF4', 'F7', 'F8']
+SOURCES = ('blink', 'emg', 'motion', 'fac')
+# fac detections that are not artifacts
+FAC_NEUTRAL = ('neutral', '')
+
+
+class ArtifactDetector(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to flag the periods where EEG based detections are not to be trusted
+
+    Attributes
+    ----------
+    active : bool
+        whether an artifact is active at the latest sample time
+    sources : list
+        the sources currently active, among 'blink', 'emg', 'motion' and 'fac'
+    counts : dict
+        number of detections of every source
+    hold : float
+        seconds a detection stays active
+
+    Methods
+    -------
+    push_eeg(times, values):
+        To feed raw EEG samples of shape (n, channels)
+    push_mot(times, acc):
+        To feed accelerometer samples of shape (n, 3)
+    push_fac(t, data):
+        To feed one fac sample as emitted by Cortex
+    is_active(t):
+        To tell whether an artifact covers time t
+    """
+    _events_ = ['new_artifact_state']
+
+    def __init__(self, cortex_client=None, rate=128.0, channels=14, block=8, hold=1.0,
+                 amplitude_uv=70.0, slope_uv_per_s=5000.0, emg_factor=6.0, emg_channels=2,
+                 motion_g=0.1, mot_block=4, fac_power=0.3, dc_seconds=2.0, warmup_seconds=1.0,
+                 subscribe=('eeg', 'mot', 'fac')):
+        self.rate = float(rate)
+        self.channels = channels
+        self.block = block
+        self.hold = hold
+        self.amplitude_uv = amplitude_uv
+        self.slope_uv = slope_uv_per_s / self.rate
+        self.emg_factor = emg_factor
+        self.emg_channels = emg_channels
+        self.motion_g = motion_g
+        self.fac_power = fac_power
+        self.subscribe = list(subscribe)
+        self.active = False
+        self.sources = []
+        self.counts = dict.fromkeys(SOURCES, 0)
+        self._since = dict.fromkeys(SOURCES, np.inf)
+        self._until = dict.fromkeys(SOURCES, -np.inf)
+        self._now = -np.inf
+
+        names = list(cortex.EEG_CHANNELS[:channels])
+        self._frontal = np.array([names.index(ch) for ch in FRONTAL_CHANNELS if ch in names], dtype=np.intp)
+        self._eeg_columns = cortex.EegColumns(channels)
+        # two samples carried over from the previous block for the differences
+        self._eeg = np.zeros((block + 2, channels))
+        self._eeg_fill = 2
+        self._eeg_times = np.zeros(block)
+        self._dc = None
+        self._hf_ref = None
+        self._dc_alpha = min(1.0, block / (dc_seconds * self.rate))
+        self._warmup = max(1, int(round(warmup_seconds * self.rate / block)))
+        self._blocks = 0
+
+        self._acc_columns = [6, 7, 8]
+        self._mot = np.zeros((mot_block, 3))
+        self._mot_fill = 0
+        self._mot_times = np.zeros(mot_block)
+        self._acc_ref = None
+        self._acc_alpha = 0.02
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_data_labels=self.on_new_data_labels)
+        cortex_client.bind(new_eeg_data=self.on_new_eeg_data)
+        cortex_client.bind(new_mot_data=self.on_new_mot_data)
+        cortex_client.bind(new_fe_data=self.on_new_fe_data)
+
+    def is_active(self, t=None):
+        """
+        Parameters
+        ----------
+        t : float, optional
+            time to check, such as the time of a com sample. Default is the latest sample time
+
+        Returns
+        -------
+        bool
+        """
+        t = self._now if t is None else t
+        return any(self._since[s] <= t <= self._until[s] for s in SOURCES)
+
+    # detection
+    def _detect(self, source, t):
+        if t > self._until[source]:
+            self.counts[source] += 1
+            # the artifact may have started up to one block before its detection
+            self._since[source] = t - self.block / self.rate
+        self._until[source] = t + self.hold
+
+    def _update(self, t):
+        self._now = max(self._now, t)
+        sources = [s for s in SOURCES if self._now <= self._until[s]]
+        active = bool(sources)
+        self.sources = sources
+        if active != self.active:
+            self.active = active
+            self.emit('new_artifact_state', data={'active': active, 'sources': sources, 'time': self._now})
+
+    def push_eeg(self, times, values):
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), self.channels)
+        i = 0
+        while i < len(times):
+            take = min(len(times) - i, self.block + 2 - self._eeg_fill)
+            self._eeg[self._eeg_fill:self._eeg_fill + take] = values[i:i + take]
+            self._eeg_times[self._eeg_fill - 2:self._eeg_fill - 2 + take] = times[i:i + take]
+            self._eeg_fill += take
+            i += take
+            if self._eeg_fill == self.block + 2:
+                self._process_eeg()
+
+    def push_eeg_sample(self, t, row):
+        self._eeg[self._eeg_fill] = row
+        self._eeg_times[self._eeg_fill - 2] = t
+        self._eeg_fill += 1
+        if self._eeg_fill == self.block + 2:
+            self._process_eeg()
+
+    def _process_eeg(self):
+        ext = self._eeg
+        x = ext[2:]
+        t = self._eeg_times[-1]
+        if self._dc is None:
+            self._dc = x.mean(axis=0)
+            ext[:2] = x[:1]
+        # frontal amplitude and slope
+        frontal = x[:, self._frontal]
+        amplitude = np.abs(frontal - self._dc[self._frontal]).max()
+        slope = np.abs(np.diff(ext[1:, self._frontal], axis=0)).max()
+        blink = amplitude > self.amplitude_uv or slope > self.slope_uv
+        # high frequency power of every channel from the second difference
+        d2 = ext[2:] - 2.0 * ext[1:-1] + ext[:-2]
+        hf = np.einsum('ij,ij->j', d2, d2) / self.block
+        self._blocks += 1
+        if self._hf_ref is None:
+            self._hf_ref = hf
+        emg = self._blocks > self._warmup and np.count_nonzero(hf > self.emg_factor * self._hf_ref) >= self.emg_channels
+
+        if blink:
+            self._detect('blink', t)
+        if emg:
+            self._detect('emg', t)
+        if not (blink or emg):
+            # the references only follow quiet blocks
+            self._dc += self._dc_alpha * (x.mean(axis=0) - self._dc)
+            alpha = 1.0 / self._blocks if self._blocks <= self._warmup else self._dc_alpha
+            self._hf_ref = self._hf_ref + alpha * (hf - self._hf_ref)
+        ext[:2] = ext[-2:]
+        self._eeg_fill = 2
+        self._update(t)
+
+    def push_mot(self, times, acc):
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        acc = np.asarray(acc, dtype=np.float64).reshape(len(times), 3)
+        for t, row in zip(times, acc):
+            self.push_mot_sample(t, row)
+
+    def push_mot_sample(self, t, acc):
+        self._mot[self._mot_fill] = acc
+        self._mot_times[self._mot_fill] = t
+        self._mot_fill += 1
+        if self._mot_fill == len(self._mot):
+            self._process_mot()
+
+    def _process_mot(self):
+        acc = self._mot
+        t = self._mot_times[-1]
+        if self._acc_ref is None:
+            self._acc_ref = acc.mean(axis=0)
+        deviation = acc - self._acc_ref
+        moving = np.einsum('ij,ij->i', deviation, deviation).max() > self.motion_g ** 2
+        if moving:
+            self._detect('motion', t)
+        else:
+            # follow slow changes of the head orientation
+            self._acc_ref += self._acc_alpha * (acc.mean(axis=0) - self._acc_ref)
+        self._mot_fill = 0
+        self._update(t)
+
+    def push_fac(self, t, data):
+        if (data.get('eyeAct') not in FAC_NEUTRAL
+                or (data.get('uAct') not in FAC_NEUTRAL and data.get('uPow', 0) >= self.fac_power)
+                or (data.get('lAct') not in FAC_NEUTRAL and data.get('lPow', 0) >= self.fac_power)):
+            self._detect('fac', t)
+        self._update(t)
+
+    # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        labels = data['labels']
+        if data['streamName'] == 'eeg':
+            if self._eeg_columns.update(labels):
+                names = self._eeg_columns.names
+                self._frontal = np.array([names.index(ch) for ch in FRONTAL_CHANNELS if ch in names],
+                                         dtype=np.intp)
+        elif data['streamName'] == 'mot' and all(label in labels for label in ('ACCX', 'ACCY', 'ACCZ')):
+            self._acc_columns = [labels.index(label) for label in ('ACCX', 'ACCY', 'ACCZ')]
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push_eeg_sample(data['time'], self._eeg_columns.select(data['eeg']))
+
+    def on_new_mot_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        row = data['mot']
+        self.push_mot_sample(data['time'], [row[i] for i in self._acc_columns])
+
+    def on_new_fe_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push_fac(data['time'], data)
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - artifacts = ArtifactDetector(cortex) subscribes 'eeg', 'mot' and 'fac' when the session is created
+#   - artifacts.is_active(data['time']) in on_new_com_data tells whether a lift may come from a blink,
+#     a clench or a head movement; python live.py --artifacts suppresses those lifts
+#   - artifacts.bind(new_artifact_state=...) gets {'active', 'sources', 'time'} on every change
+#   - python artifacts.py scores the detector on synthetic blinks and benchmarks it
+#
+# -----------------------------------------------------------
+
+def main():
+    from synthetic import SignalGenerator
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 300.0
+    session = SignalGenerator(seed=3, blink_rate=0.2).generate(seconds, start_time=0.0)
+    detector = ArtifactDetector(rate=128.0, channels=len(session.channels))
+    changes = []
+
+    def on_new_artifact_state(*args, **kwargs):
+        data = kwargs.get('data')
+        changes.append((data['time'], data['active']))
+    detector.bind(new_artifact_state=on_new_artifact_state)
+
+    start = time.perf_counter()
+    for t, row in zip(session.eeg_times, session.eeg):
+        detector.push_eeg_sample(t, row)
+    per_sample = time.perf_counter() - start
+    start = time.perf_counter()
+    for t, row in zip(session.mot_times, session.mot[:, 4:7]):
+        detector.push_mot_sample(t, row)
+    mot_per_sample = time.perf_counter() - start
+
+    block = ArtifactDetector(rate=128.0, channels=len(session.channels))
+    start = time.perf_counter()
+    block.push_eeg(session.eeg_times, session.eeg)
+    per_block = (time.perf_counter() - start) / (len(session.eeg) / block.block)
+
+    # a blink is caught when the flag is up 100 ms after its peak
+    times = np.array([t for t, _ in changes] + [np.inf])
+    states = np.array([False] + [active for _, active in changes])
+    caught = states[np.searchsorted(times, session.blink_times + 0.1, side='right')]
+    onsets = times[:-1][states[1:]]
+    delays = [onsets[(onsets >= b - 0.2)][0] - b for b in session.blink_times[caught]
+              if np.any(onsets >= b - 0.2)]
+    active_time = np.sum(np.diff(np.append(times[:-1], session.eeg_times[-1]))[states[1:]])
+    print('{0:.0f} s, {1} blinks: {2} caught, flag raised {3} times, up {4:.1f}% of the time'.format(
+        seconds, len(session.blink_times), int(caught.sum()), len(onsets), active_time / seconds * 100))
+    if delays:
+        print('flag raised relative to the blink peak: median {0:+.0f} ms'.format(np.median(delays) * 1000))
+    print('eeg: {0:.1f} us per block of {1} samples, {2:.1f} us per sample including the copy, '
+          'mot: {3:.1f} us per sample'.format(per_block * 1e6, block.block, per_sample / len(session.eeg) * 1e6,
+                                              mot_per_sample / len(session.mot) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Streaming statistics of the com power with automatic threshold calibration
+
+ComStats follows the com stream with constant time and memory per sample:
+
+    - per action, an exponentially weighted mean and variance of the power
+      (time-based half-life, so irregular sample times are handled) and P²
+      quantile estimates (Jain & Chlamtac, 1985), five markers per quantile
+    - a neutral baseline of the 'lift' power (0 for any other action) taken
+      while the user rests: it counts the up-crossings of a fixed grid of
+      thresholds with exponentially decaying weights
+
+A threshold's up-crossings during rest are the false triggers it would give, so
+the recommended threshold is the lowest grid level whose decayed crossing rate
+is below the target number of false triggers per minute. An up-crossing of
+every level between the previous and the current power is one interval of the
+grid, added in O(1) to a difference array; the rates are its prefix sum,
+computed only when the recommendation is published.
+
+Rest is known from the com stream alone: a period of rest starts once no
+sustained 'lift' (longer than min_lift) has been seen for settle seconds. Short
+'lift' episodes inside rest are what false triggers are made of and stay in the
+baseline; their samples are held back until the episode ends, so an episode
+that turns out to be sustained is dropped as a whole.
+"""
+
+import math
+import sys
+import time
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+from adjust_sensitivity import get_current_threshold
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+# samples further apart are a gap in the stream, not rest time
+MAX_GAP = 1.0
+
+
+class EwmaStats():
+    """
+    Exponentially weighted mean and variance with a half-life in seconds
+
+    The weight of a sample is 1 - 2 ** (-dt / half_life) where dt is the time since the
+    previous sample, so the estimates forget at the same speed whatever the sample rate.
+    """
+    def __init__(self, half_life=300.0):
+        self.half_life = half_life
+        self.mean = None
+        self.var = 0.0
+        self.count = 0
+        self._last = None
+
+    def push(self, t, x):
+        self.count += 1
+        if self.mean is None:
+            self.mean = x
+            self._last = t
+            return
+        alpha = 1.0 - 2.0 ** (-max(t - self._last, 0.0) / self.half_life)
+        self._last = t
+        diff = x - self.mean
+        increment = alpha * diff
+        self.mean += increment
+        self.var = (1.0 - alpha) * (self.var + diff * increment)
+
+    @property
+    def std(self):
+        return math.sqrt(self.var)
+
+
+class P2Quantile():
+    """
+    P² estimate of one quantile: five markers whose heights follow the quantile, O(1) per sample
+    """
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._q = []
+        self._n = [0, 1, 2, 3, 4]
+        self._desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self._step = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def push(self, x):
+        self.count += 1
+        q, n = self._q, self._n
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._step[i]
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # piecewise parabolic prediction, linear when it leaves the neighbours
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        if not self._q:
+            return None
+        if self.count < 5:
+            # exact quantile of the few samples seen
+            return self._q[min(len(self._q) - 1, int(round(self.p * (len(self._q) - 1))))]
+        return self._q[2]
+
+
+class NeutralBaseline():
+    """
+    Decayed rate of up-crossings of a grid of thresholds by the 'lift' power during rest
+
+    Attributes
+    ----------
+    levels : numpy.ndarray
+        thresholds of the grid, 0 to 1 - 1 / resolution
+    resting : bool
+        whether the last sample belonged to a period of rest
+    held : int
+        samples of a short lift during rest, held back until the lift ends or turns out sustained
+    """
+    def __init__(self, resolution=100, half_life=1800.0, settle=2.0, min_lift=1.0):
+        self.resolution = resolution
+        self.levels = np.arange(resolution) / resolution
+        self.half_life = half_life
+        self.settle = settle
+        self.min_lift = min_lift
+        self._crossings = np.zeros(resolution + 1)
+        self._minutes = 0.0
+        self.seconds = 0.0
+        self._origin = None
+        self._weight = 1.0
+        self._last_time = None
+        self._last_power = 0.0
+        self._busy_until = None
+        self._episode = None
+        self._sustained = False
+        self._pending = []
+        self.resting = False
+
+    @property
+    def held(self):
+        return len(self._pending)
+
+    def _level_index(self, power):
+        # first level at or above power
+        return min(self.resolution, max(0, int(math.ceil(power * self.resolution - 1e-9))))
+
+    def _add(self, t, dt, low, high):
+        # weights grow with time instead of every counter decaying, rescaled once in a while
+        self._weight = 2.0 ** ((t - self._origin) / self.half_life)
+        if self._weight > 1e100:
+            self._crossings /= self._weight
+            self._minutes /= self._weight
+            self._origin = t
+            self._weight = 1.0
+        self._minutes += self._weight * dt / 60.0
+        self.seconds += dt
+        if high > low:
+            self._crossings[low] += self._weight
+            self._crossings[high] -= self._weight
+
+    def push(self, t, power):
+        """
+        Parameters
+        ----------
+        t : float
+            sample time
+        power : float
+            'lift' power of the sample, 0 for any other action
+        """
+        if self._origin is None:
+            self._origin = t
+        dt = 0.0 if self._last_time is None else min(max(t - self._last_time, 0.0), MAX_GAP)
+        # up-crossing of the levels in [previous power, power)
+        low, high = self._level_index(self._last_power), self._level_index(power)
+        self._last_time, self._last_power = t, power
+
+        if power > 0.0:
+            if self._episode is None:
+                self._episode = t
+            if t - self._episode >= self.min_lift:
+                # a sustained lift: the user is not resting, the held back samples go
+                self._sustained = True
+                self._pending = []
+                self.resting = False
+            elif self.resting:
+                self._pending.append((t, dt, low, high))
+            return
+
+        if self._episode is not None:
+            if self._sustained:
+                self._busy_until = t + self.settle
+            for sample in self._pending:
+                self._add(*sample)
+            self._episode = None
+            self._sustained = False
+            self._pending = []
+        if not self.resting:
+            if self._busy_until is None:
+                self._busy_until = t + self.settle
+            if t < self._busy_until:
+                return
+            self._busy_until = None
+            self.resting = True
+        self._add(t, dt, low, high)
+
+    def rates(self):
+        """
+        Returns
+        -------
+        numpy.ndarray or None
+            false triggers per minute of rest at every level, None before any rest
+        """
+        if self._minutes <= 0.0:
+            return None
+        # the prefix sums of added and removed weights are not exactly 0 where they should be
+        return np.maximum(np.cumsum(self._crossings[:-1]), 0.0) / self._minutes
+
+    def threshold_for(self, false_per_minute):
+        """
+        Returns
+        -------
+        float or None
+            lowest level whose up-crossing rate is at most false_per_minute
+        """
+        rates = self.rates()
+        if rates is None:
+            return None
+        below = np.flatnonzero(rates <= false_per_minute)
+        return float(self.levels[below[0]]) if len(below) else 1.0
+
+
+class ComStats(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to keep streaming statistics of the com power and recommend a lift threshold
+
+    Attributes
+    ----------
+    target_false_per_minute : float
+        false triggers per minute of rest the recommended threshold aims at
+    threshold_range : tuple
+        bounds of the recommended threshold
+    min_rest_seconds : float
+        seconds of rest before a threshold is recommended
+    stats : dict
+        EwmaStats of every action seen
+    quantiles : dict
+        P2Quantile of every action seen, by quantile
+    baseline : NeutralBaseline
+        up-crossing rates of the 'lift' power during rest
+    latest : dict or None
+        the last published data
+
+    Methods
+    -------
+    push(t, action, power):
+        To feed one com sample
+    recommended_threshold():
+        To get the threshold at the target false trigger rate, None while the baseline is too short
+    false_per_minute(threshold):
+        To get the false trigger rate of a threshold during rest
+    summary(t):
+        To build and publish the data of new_com_stats
+    """
+    _events_ = ['new_com_stats']
+
+    def __init__(self, cortex_client=None, target_false_per_minute=0.5, half_life=300.0,
+                 baseline_half_life=1800.0, quantiles=DEFAULT_QUANTILES, lift_action='lift', settle=2.0,
+                 min_lift=1.0, min_rest_seconds=60.0, threshold_range=(0.2, 0.95), publish_every=1.0,
+                 subscribe=()):
+        self.target_false_per_minute = target_false_per_minute
+        self.half_life = half_life
+        self.quantile_levels = tuple(quantiles)
+        self.lift_action = lift_action
+        self.min_rest_seconds = min_rest_seconds
+        self.threshold_range = threshold_range
+        self.publish_every = publish_every
+        self.subscribe = list(subscribe)
+        self.stats = {}
+        self.quantiles = {}
+        self.baseline = NeutralBaseline(half_life=baseline_half_life, settle=settle, min_lift=min_lift)
+        self.latest = None
+        self._next_publish = None
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_com_data=self.on_new_com_data)
+
+    def push(self, t, action, power):
+        """
+        Returns
+        -------
+        dict or None
+            the published data when it is time to publish, None otherwise
+        """
+        if action not in self.stats:
+            self.stats[action] = EwmaStats(self.half_life)
+            self.quantiles[action] = {p: P2Quantile(p) for p in self.quantile_levels}
+        self.stats[action].push(t, power)
+        for quantile in self.quantiles[action].values():
+            quantile.push(power)
+        self.baseline.push(t, power if action == self.lift_action else 0.0)
+        if self._next_publish is None:
+            self._next_publish = t
+        if t < self._next_publish:
+            return None
+        self._next_publish = t + self.publish_every
+        return self.summary(t)
+
+    def recommended_threshold(self):
+        if self.baseline.seconds < self.min_rest_seconds:
+            return None
+        threshold = self.baseline.threshold_for(self.target_false_per_minute)
+        return round(min(max(threshold, self.threshold_range[0]), self.threshold_range[1]), 3)
+
+    def false_per_minute(self, threshold):
+        rates = self.baseline.rates()
+        if rates is None:
+            return None
+        return float(rates[min(self.baseline._level_index(threshold), len(rates) - 1)])
+
+    def summary(self, t):
+        threshold = self.recommended_threshold()
+        self.latest = {
+            'time': t,
+            'actions': {action: {'mean': s.mean, 'std': s.std, 'count': s.count,
+                                 'quantiles': {p: q.value() for p, q in self.quantiles[action].items()}}
+                        for action, s in self.stats.items()},
+            'rest_seconds': self.baseline.seconds,
+            'resting': self.baseline.resting,
+            'threshold': threshold,
+            'false_per_minute': None if threshold is None else self.false_per_minute(threshold),
+        }
+        self.emit('new_com_stats', data=self.latest)
+        return self.latest
+
+    # callbacks functions
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push(data['time'], data['action'], data['power'])
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - stats = ComStats(cortex, target_false_per_minute=0.5) follows the com stream; 'com' is subscribed
+#     by live.py after loading the profile, pass subscribe=('com',) to subscribe it at session creation
+#   - stats.bind(new_com_stats=handler) receives the statistics once per second, with the recommended
+#     'threshold' once 60 s of rest have been seen (None before, get_current_threshold() is the fallback)
+#   - python live.py --auto-threshold 0.5 replaces the fixed 0.5 lift threshold by the recommendation
+#   - python com_stats.py runs on a synthetic hour of com and checks the false trigger rate reached
+#
+# -----------------------------------------------------------
+
+def main():
+    from synthetic import SignalGenerator, score_detections
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    session = SignalGenerator(seed=4, false_lift_rate=0.05).generate(3600, start_time=0.0)
+    stats = ComStats(target_false_per_minute=target)
+    samples = list(zip(session.com_times.tolist(), session.com_actions.tolist(), session.com_power.tolist()))
+    thresholds = []
+    start = time.perf_counter()
+    for t, action, power in samples:
+        data = stats.push(t, action, power)
+        if data is not None and data['threshold'] is not None:
+            thresholds.append(data['threshold'])
+    elapsed = time.perf_counter() - start
+    print('{0} com samples: {1:.1f} us per sample'.format(len(samples), elapsed / len(samples) * 1e6))
+    for action, s in stats.latest['actions'].items():
+        print('{0}: mean {1:.3f}, std {2:.3f}, quantiles {3}'.format(action, s['mean'], s['std'], ', '.join(
+            '{0}: {1:.3f}'.format(p, q) for p, q in s['quantiles'].items())))
+
+    threshold = thresholds[-1] if thresholds else get_current_threshold()
+    print('recommended threshold at {0} false triggers per minute: {1:.2f} (first {2:.2f} after {3:.0f} s of rest)'.format(
+        target, threshold, thresholds[0] if thresholds else float('nan'), stats.min_rest_seconds))
+    # false triggers the threshold gives against the ground truth, rising edges outside the lifts
+    lift_power = np.where(session.com_actions == 'lift', session.com_power, 0.0)
+    above = lift_power > threshold
+    rising = above & ~np.concatenate([[False], above[:-1]])
+    score = score_detections(session.com_times[rising], session.lift_onsets, session.lift_offsets, tolerance=1.0)
+    rest_minutes = (session.com_times[-1] - np.sum(session.lift_offsets - session.lift_onsets)) / 60.0
+    print('at that threshold: {0:.2f} false triggers per minute, {1} hits, {2} misses'.format(
+        score['false_triggers'] / rest_minutes, score['hits'], score['misses']))
+
+if __name__ == '__main__':
+    main()
@@ -59,6 +59,76 @@ HEADSET_CANNOT_WORK_WITH_BTLE = 112
 HEADSET_CANNOT_CONNECT_DISABLE_MOTION = 113
 HEADSET_SCANNING_FINISHED = 142
 
+# define default Cortex service url
+CORTEX_URL = "wss://localhost:6868"
+
+# define EPOC channel and band-power labels
+EEG_CHANNELS = ['AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4']
+POW_BANDS = ['theta', 'alpha', 'betaL', 'betaH', 'gamma']
+
+
+class EegColumns():
+    """
+    Positions of the EPOC channels in the rows of the eeg stream
+
+    Until the eeg labels of the subscription are known, the channels are taken as the columns 2 to
+    2 + channels, after COUNTER and INTERPOLATED (every column when channels is None).
+
+    Attributes
+    ----------
+    channels : int or None
+        number of channels expected, None for any
+    columns : slice or list
+        the channel columns
+    names : list or None
+        the channel labels, once known
+
+    Methods
+    -------
+    update(labels):
+        To find the channel columns in the eeg labels, returns whether they were found
+    select(row):
+        To get the channel values of one eeg row
+    """
+    def __init__(self, channels=None):
+        self.channels = channels
+        self.columns = slice(None) if channels is None else slice(2, 2 + channels)
+        self.names = None
+
+    def update(self, labels):
+        columns = [i for i, label in enumerate(labels) if label in EEG_CHANNELS]
+        if not columns or (self.channels is not None and len(columns) != self.channels):
+            return False
+        self.columns = columns
+        self.names = [labels[i] for i in columns]
+        return True
+
+    def select(self, row):
+        if isinstance(self.columns, slice):
+            return row[self.columns]
+        return [row[i] for i in self.columns]
+
+
+class CortexConsumer():
+    """
+    Mixin of the classes fed by a Cortex, self.c
+
+    Once the session is created, the streams of self.subscribe are subscribed. When the class
+    keeps an EegColumns in self._eeg_columns, it follows the eeg labels of the subscription.
+    """
+    _eeg_columns = None
+
+    # callbacks functions
+    def on_create_session_done(self, *args, **kwargs):
+        if self.subscribe:
+            self.c.sub_request(self.subscribe)
+
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['streamName'] == 'eeg' and self._eeg_columns is not None:
+            self._eeg_columns.update(data['labels'])
+
+
 class Cortex(Dispatcher):
 
     _events_ = ['inform_error','create_session_done', 'query_profile_done', 'load_unload_profile_done', 
@@ -75,6 +145,11 @@ class Cortex(Dispatcher):
         self.debit = 10
         self.license = ''
         self.isHeadsetConnected = False
+        # settings of the connected headset from queryHeadsets, such as its eegRate
+        self.headset_settings = {}
+        self.url = CORTEX_URL
+        # time source of the waits and of the consumers' "now"; replay.ReplayCortex swaps in its virtual clock
+        self.clock = time
 
         if client_id == '':
             raise ValueError('Empty your_app_client_id. Please fill in your_app_client_id before running the example.')
@@ -94,11 +169,12 @@ class Cortex(Dispatcher):
                 self.debit == value
             elif  key == 'headset_id':
                 self.headset_id = value
+            elif key == 'url':
+                self.url = value
 
     def open(self):
-        url = "wss://localhost:6868"
         # websocket.enableTrace(True)
-        self.ws = websocket.WebSocketApp(url, 
+        self.ws = websocket.WebSocketApp(self.url, 
                                         on_message=self.on_message,
                                         on_open = self.on_open,
                                         on_error=self.on_error,
@@ -171,6 +247,7 @@ class Cortex(Dispatcher):
             self.headset_list = result_dic
             found_headset = False
             headset_status = ''
+            headset_settings = {}
             for ele in self.headset_list:
                 hs_id = ele['id']
                 status = ele['status']
@@ -179,6 +256,7 @@ class Cortex(Dispatcher):
                 if self.headset_id != '' and self.headset_id == hs_id:
                     found_headset = True
                     headset_status = status
+                    headset_settings = ele.get('settings') or {}
 
             if len(self.headset_list) == 0:
                 self.isHeadsetConnected = False
@@ -193,13 +271,14 @@ class Cortex(Dispatcher):
             elif found_headset == True:
                 if headset_status == 'connected':
                     self.isHeadsetConnected = True
+                    self.headset_settings = headset_settings
                     # create session with the headset
                     self.create_session()
                 elif headset_status == 'discovered':
                     self.connect_headset(self.headset_id)
                 elif headset_status == 'connecting':
                     # wait 3 seconds and query headset again
-                    time.sleep(3)
+                    self.clock.sleep(3)
                     self.query_headset()
                 else:
                     warnings.warn('query_headset resp: Invalid connection status ' + headset_status)
@@ -293,6 +372,7 @@ class Cortex(Dispatcher):
         elif req_id == EXPORT_RECORD_ID:
             # handle data lable
             success_export = []
+            failure_export = []
             for record in result_dic['success']:
                 record_id = record['recordId']
                 success_export.append(record_id)
@@ -301,8 +381,9 @@ class Cortex(Dispatcher):
                 record_id = record['recordId']
                 failure_msg = record['message']
                 print('export_record resp failure cases: '+ record_id + ":" + failure_msg)
+                failure_export.append({'recordId': record_id, 'message': failure_msg})
 
-            self.emit('export_record_done', data=success_export)
+            self.emit('export_record_done', data=success_export, failure=failure_export)
         elif req_id == INJECT_MARKER_REQUEST_ID:
             self.emit('inject_marker_done', data=result_dic['marker'])
         elif req_id == INJECT_MARKER_REQUEST_ID:
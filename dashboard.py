@@ -0,0 +1,293 @@
+"""
+Rate-limited terminal dashboard for live.py and train.py
+
+Dashboard binds to the Cortex events and only updates counters in the
+callbacks; a separate thread redraws a curses screen at a fixed rate, so the
+redraw cost does not depend on the sample rates. While it runs, everything
+printed by the app and by Cortex is captured into the last lines of a log panel
+instead of being written to the terminal line by line. When stdout is not a
+terminal, one status line is printed per refresh instead.
+"""
+
+import curses
+import io
+import sys
+import threading
+import time
+from collections import deque
+
+import cortex
+
+STREAMS = ('com', 'eeg', 'mot', 'pow', 'met', 'dev', 'fac', 'sys')
+
+
+class _LogCapture(io.TextIOBase):
+    # stdout replacement keeping the last complete lines
+    def __init__(self, lines):
+        self.lines = deque(maxlen=lines)
+        self._partial = ''
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self._lock:
+            self.written += 1
+            parts = (self._partial + text).split('\n')
+            self._partial = parts.pop()
+            self.lines.extend(parts)
+        return len(text)
+
+    def tail(self, n):
+        with self._lock:
+            return list(self.lines)[-n:]
+
+
+class Dashboard(cortex.CortexConsumer):
+    """
+    A class to show the state of a Cortex app in a terminal at a fixed refresh rate
+
+    Attributes
+    ----------
+    decision : DecisionEngine or None
+        engine whose new_decision events are counted as the triggers, and whose threshold is shown
+    threshold : float
+        threshold shown, the decision engine's when it has one; without an engine, a non neutral action
+        rising above it counts as a trigger
+    window : float
+        seconds of the rolling trigger counts
+    status : dict
+        free lines set by the app, shown as "key: value"
+
+    Methods
+    -------
+    start():
+        To start redrawing and capturing the output
+    stop():
+        To restore the terminal
+    watch(name, fn):
+        To show the value returned by fn, such as the depth of a queue
+    """
+    def __init__(self, cortex, refresh=4.0, threshold=0.5, window=10.0, log_lines=200, subscribe=('dev',),
+                 decision=None):
+        self.c = cortex
+        self.refresh = refresh
+        self.subscribe = list(subscribe)
+        self._threshold = threshold
+        self.decision = decision
+        self.window = window
+        self.status = {}
+        self._gauges = {}
+        self._log = _LogCapture(log_lines)
+        self._stdout = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._counts = dict.fromkeys(STREAMS, 0)
+        self._last_counts = dict.fromkeys(STREAMS, 0)
+        self._rates = dict.fromkeys(STREAMS, 0.0)
+        self._lags = dict.fromkeys(STREAMS, None)
+        self._last_rate_time = time.monotonic()
+        self._action = None
+        self._power = 0.0
+        self._triggers = {}
+        self._trigger_times = deque()
+        self._above = False
+        self._dev = None
+        self._training = None
+        self._training_counts = {}
+
+        self.c.bind(create_session_done=self.on_create_session_done)
+        self.c.bind(new_com_data=self.on_new_com_data)
+        self.c.bind(new_eeg_data=self.on_new_eeg_data)
+        self.c.bind(new_mot_data=self.on_new_mot_data)
+        self.c.bind(new_pow_data=self.on_new_pow_data)
+        self.c.bind(new_met_data=self.on_new_met_data)
+        self.c.bind(new_dev_data=self.on_new_dev_data)
+        self.c.bind(new_fe_data=self.on_new_fe_data)
+        self.c.bind(new_sys_data=self.on_new_sys_data)
+        if decision is not None:
+            decision.bind(new_decision=self.on_new_decision)
+
+    @property
+    def threshold(self):
+        # read on every refresh, so that --auto-threshold and policy changes show up
+        if self.decision is not None and self.decision.threshold is not None:
+            return self.decision.threshold
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, threshold):
+        self._threshold = threshold
+
+    def watch(self, name, fn):
+        self._gauges[name] = fn
+
+    def start(self):
+        self._stdout = sys.stdout
+        interactive = self._stdout.isatty()
+        sys.stdout = self._log
+        target = self._run_curses if interactive else self._run_plain
+        self._thread = threading.Thread(target=target, name='Dashboard', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._stdout is not None:
+            sys.stdout = self._stdout
+            self._stdout = None
+            for line in self._log.tail(10):
+                print(line)
+
+    # callbacks functions
+    # the stream callbacks only count, they never format or draw
+    def _count(self, stream, data_time=None):
+        self._counts[stream] += 1
+        if data_time is not None:
+            # the cortex clock, so that a replayed session shows its recorded lags
+            self._lags[stream] = self.c.clock.time() - data_time
+
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self._count('com', data['time'])
+        self._action = data['action']
+        self._power = data['power']
+        if self.decision is not None:
+            return
+        # one trigger per rise above the threshold, not one per sample
+        above = data['action'] != 'neutral' and data['power'] > self.threshold
+        if above and not self._above:
+            self._trigger(data['action'])
+        self._above = above
+
+    def on_new_decision(self, *args, **kwargs):
+        self._trigger(kwargs.get('data')['action'])
+
+    def _trigger(self, action):
+        self._trigger_times.append(time.monotonic())
+        self._triggers[action] = self._triggers.get(action, 0) + 1
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        self._count('eeg', kwargs.get('data')['time'])
+
+    def on_new_mot_data(self, *args, **kwargs):
+        self._count('mot', kwargs.get('data')['time'])
+
+    def on_new_pow_data(self, *args, **kwargs):
+        self._count('pow', kwargs.get('data')['time'])
+
+    def on_new_met_data(self, *args, **kwargs):
+        self._count('met', kwargs.get('data')['time'])
+
+    def on_new_fe_data(self, *args, **kwargs):
+        self._count('fac', kwargs.get('data')['time'])
+
+    def on_new_dev_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self._count('dev', data['time'])
+        self._dev = data
+
+    def on_new_sys_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self._count('sys')
+        if len(data) > 1:
+            self._training = data[1]
+            self._training_counts[data[1]] = self._training_counts.get(data[1], 0) + 1
+
+    def _update_rates(self):
+        now = time.monotonic()
+        elapsed = now - self._last_rate_time
+        if elapsed <= 0:
+            return
+        for stream in STREAMS:
+            count = self._counts[stream]
+            self._rates[stream] = (count - self._last_counts[stream]) / elapsed
+            self._last_counts[stream] = count
+        self._last_rate_time = now
+        while self._trigger_times and self._trigger_times[0] < now - self.window:
+            self._trigger_times.popleft()
+
+    def lines(self):
+        """
+        Returns
+        -------
+        list
+            the text lines of the dashboard, without the log panel
+        """
+        self._update_rates()
+        lines = []
+        power_bar = '#' * int(round(self._power * 20))
+        lines.append('action: {0:<10} power: {1:4.2f} [{2:<20}] threshold: {3:.2f}'.format(
+            str(self._action), self._power, power_bar, self.threshold))
+        lines.append('triggers: {0} in the last {1:.0f} s, total {2}'.format(
+            len(self._trigger_times), self.window,
+            ', '.join('{0} {1}'.format(k, v) for k, v in self._triggers.items()) or '0'))
+        if self._dev is not None:
+            cq = self._dev['dev']
+            lines.append('headset: battery {0}%  signal {1}  contact {2}'.format(
+                self._dev['batteryPercent'], self._dev['signal'],
+                ' '.join(str(int(v)) if isinstance(v, (int, float)) else '?' for v in cq)))
+        else:
+            lines.append('headset: no dev data')
+        if self._training is not None:
+            lines.append('training: last event {0}  ({1})'.format(self._training, ', '.join(
+                '{0} {1}'.format(k, v) for k, v in self._training_counts.items())))
+        lines.append('')
+        lines.append('stream   rate/s   lag ms   total')
+        for stream in STREAMS:
+            if self._counts[stream] == 0:
+                continue
+            lag = self._lags[stream]
+            lines.append('{0:<6} {1:8.1f} {2:8} {3:7}'.format(
+                stream, self._rates[stream], '-' if lag is None else '{0:.0f}'.format(lag * 1000),
+                self._counts[stream]))
+        for name, fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                value = 'error: {0}'.format(e)
+            lines.append('{0}: {1}'.format(name, value))
+        for key, value in self.status.items():
+            lines.append('{0}: {1}'.format(key, value))
+        return lines
+
+    def _run_plain(self):
+        while not self._stopping.wait(1.0 / self.refresh):
+            lines = self.lines()
+            self._stdout.write(' | '.join(line for line in lines[:2]) + '\n')
+            self._stdout.flush()
+
+    def _run_curses(self):
+        screen = curses.initscr()
+        try:
+            curses.noecho()
+            curses.cbreak()
+            curses.curs_set(0)
+            screen.nodelay(True)
+            while not self._stopping.wait(1.0 / self.refresh):
+                if screen.getch() == ord('q'):
+                    self.c.close()
+                    break
+                self._draw(screen)
+        finally:
+            curses.nocbreak()
+            curses.echo()
+            curses.endwin()
+
+    def _draw(self, screen):
+        height, width = screen.getmaxyx()
+        lines = self.lines()
+        log_rows = max(0, height - len(lines) - 3)
+        lines += ['', '-- log (q to quit) ' + '-' * max(0, width - 20)]
+        lines += self._log.tail(log_rows)
+        screen.erase()
+        for row, line in enumerate(lines[:height]):
+            try:
+                screen.addnstr(row, 0, line, width - 1)
+            except curses.error:
+                pass
+        screen.refresh()
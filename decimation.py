@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Multi-resolution min/max/mean pyramid of long recordings
+
+Level 1 summarizes every `base` samples by their min, max and mean per channel
+(float32), level k + 1 summarizes `factor` bins of level k, and so on until a
+level has a single bin. With the defaults the pyramid is about a tenth of the
+raw float64 samples; it is built incrementally while samples arrive and keeps
+no raw samples. query(t0, t1, width) returns the coarsest level that still has at
+least `width` bins in the span, so a plot of any span reads about `width` bins.
+
+A pyramid is stored as a folder next to the session (meta.json plus one .npy
+per level and field) and loaded memory-mapped.
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+PYRAMID_SUFFIX = '.pyramid'
+PYRAMID_VERSION = 1
+FIELDS = ('time', 'min', 'max', 'mean')
+
+
+class _Growable():
+    # append-only array with amortized doubling
+    def __init__(self, shape_tail, dtype):
+        self.size = 0
+        self.data = np.empty((16,) + shape_tail, dtype=dtype)
+
+    def extend(self, rows):
+        n = len(rows)
+        if self.size + n > len(self.data):
+            grown = np.empty((max(2 * len(self.data), self.size + n),) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size + n] = rows
+        self.size += n
+
+    def view(self):
+        return self.data[:self.size]
+
+
+class PyramidLevel():
+    """
+    Bins of one level
+
+    Attributes
+    ----------
+    time : numpy.ndarray
+        time of the first sample of each bin, shape (n_bins,)
+    min, max, mean : numpy.ndarray
+        shape (n_bins, width)
+    samples : int
+        number of samples per bin
+    """
+    def __init__(self, time, mn, mx, mean, samples):
+        self.time = time
+        self.min = mn
+        self.max = mx
+        self.mean = mean
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.time)
+
+
+class DecimationPyramid():
+    """
+    A min/max/mean pyramid of a multichannel signal
+
+    Attributes
+    ----------
+    width : int
+        number of channels
+    base : int
+        samples per bin of level 1
+    factor : int
+        bins of level k per bin of level k + 1
+    labels : list
+        channel labels, stored with the pyramid
+    count : int
+        number of samples summarized
+
+    Methods
+    -------
+    append(times, values):
+        To add a block of samples
+    query(t0, t1, width):
+        To get the bins of the level fitting a span and a pixel width
+    save(folder):
+        To store the pyramid
+    """
+    def __init__(self, width, base=16, factor=4, labels=None):
+        if factor < 2 or base < 1:
+            raise ValueError('base must be at least 1 and factor at least 2.')
+        self.width = width
+        self.base = base
+        self.factor = factor
+        self.labels = list(labels) if labels is not None else []
+        self.count = 0
+        self.readonly = False
+        self._pending_times = np.empty(0)
+        self._pending_values = np.empty((0, width))
+        # per level: growable time, min, max, mean, and the number of bins already summarized above
+        self._levels = []
+        self._consumed = []
+
+    @classmethod
+    def from_arrays(cls, times, values, base=16, factor=4, labels=None):
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values[:, None]
+        pyramid = cls(values.shape[1], base, factor, labels)
+        pyramid.append(times, values)
+        return pyramid
+
+    def _level(self, k):
+        while len(self._levels) <= k:
+            self._levels.append([_Growable((), np.float64)] +
+                                [_Growable((self.width,), np.float32) for _ in range(3)])
+            self._consumed.append(0)
+        return self._levels[k]
+
+    def append(self, times, values):
+        """
+        Parameters
+        ----------
+        times : array-like, required
+            sample times, increasing
+        values : array-like, required
+            shape (n_samples, width)
+        """
+        if self.readonly:
+            raise ValueError('A loaded pyramid is read-only.')
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), self.width)
+        self.count += len(times)
+        if len(self._pending_times):
+            times = np.concatenate([self._pending_times, times])
+            values = np.concatenate([self._pending_values, values])
+        f = self.base
+        full = len(times) // f * f
+        self._pending_times = times[full:].copy()
+        self._pending_values = values[full:].copy()
+        if full == 0:
+            return
+        blocks = values[:full].reshape(-1, f, self.width)
+        self._push(0, times[:full:f], blocks.min(axis=1), blocks.max(axis=1), blocks.mean(axis=1))
+
+    def _push(self, k, t, mn, mx, mean):
+        level = self._level(k)
+        for field, rows in zip(level, (t, mn, mx, mean)):
+            field.extend(rows)
+        # summarize the new full groups of this level into the next one
+        f = self.factor
+        start = self._consumed[k]
+        full = (level[0].size - start) // f * f
+        if full == 0:
+            return
+        stop = start + full
+        self._consumed[k] = stop
+        t, mn, mx, mean = (field.view()[start:stop] for field in level)
+        self._push(k + 1, t[::f], mn.reshape(-1, f, self.width).min(axis=1),
+                   mx.reshape(-1, f, self.width).max(axis=1), mean.reshape(-1, f, self.width).mean(axis=1))
+
+    @property
+    def levels(self):
+        """Levels from the finest (index 0, `base` samples per bin) to the coarsest"""
+        return [PyramidLevel(*(field.view() for field in level), self.base * self.factor ** k)
+                for k, level in enumerate(self._levels)]
+
+    def query(self, t0, t1, width):
+        """
+        Parameters
+        ----------
+        t0, t1 : float, required
+            time span
+        width : int, required
+            number of pixels, or of bins wanted
+
+        Returns
+        -------
+        PyramidLevel
+            the bins in [t0, t1) of the coarsest level with at least `width` bins there,
+            or of the finest level when none has enough
+        """
+        levels = self.levels
+        if not levels:
+            return PyramidLevel(np.empty(0), np.empty((0, self.width)), np.empty((0, self.width)),
+                                np.empty((0, self.width)), self.base)
+        chosen = None
+        for level in reversed(levels):
+            start, stop = np.searchsorted(level.time, [t0, t1])
+            if stop - start >= width:
+                chosen = level, start, stop
+                break
+        if chosen is None:
+            level = levels[0]
+            start, stop = np.searchsorted(level.time, [t0, t1])
+            chosen = level, start, stop
+        level, start, stop = chosen
+        return PyramidLevel(level.time[start:stop], level.min[start:stop], level.max[start:stop],
+                            level.mean[start:stop], level.samples)
+
+    def nbytes(self):
+        return sum(field.view().nbytes for level in self._levels for field in level)
+
+    def save(self, folder):
+        """
+        To write the pyramid into a folder, replacing it atomically.
+        The samples of an incomplete level 1 bin are not stored.
+        """
+        tmp_dir = folder + '.tmp{0}'.format(os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for k, level in enumerate(self._levels):
+            for name, field in zip(FIELDS, level):
+                np.save(os.path.join(tmp_dir, '{0}_{1}.npy'.format(k, name)), field.view())
+        meta = {'version': PYRAMID_VERSION, 'width': self.width, 'base': self.base, 'factor': self.factor,
+                'levels': len(self._levels), 'count': self.count, 'labels': self.labels}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.replace(tmp_dir, folder)
+
+
+class _MappedField():
+    # a loaded field, same interface as _Growable
+    def __init__(self, array):
+        self.array = array
+        self.size = len(array)
+
+    def view(self):
+        return self.array
+
+
+def load_pyramid(folder):
+    """
+    To load a pyramid written by DecimationPyramid.save, memory-mapped and read-only
+
+    Returns
+    -------
+    DecimationPyramid
+    """
+    with open(os.path.join(folder, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != PYRAMID_VERSION:
+        raise ValueError('Unsupported pyramid version in {0}'.format(folder))
+    pyramid = DecimationPyramid(meta['width'], meta['base'], meta['factor'], meta['labels'])
+    pyramid.count = meta['count']
+    pyramid.readonly = True
+    for k in range(meta['levels']):
+        pyramid._levels.append([_MappedField(np.load(os.path.join(folder, '{0}_{1}.npy'.format(k, name)),
+                                                     mmap_mode='r')) for name in FIELDS])
+    return pyramid
+
+
+class PyramidRecorder():
+    """
+    A class to build the pyramids of the eeg, pow and com streams while a Cortex streams,
+    and store them next to the session as <path>.pyramid/<stream>/
+
+    Methods
+    -------
+    bind(cortex):
+        To build pyramids from the streams emitted by a Cortex instance
+    close():
+        To save the pyramids
+    """
+    def __init__(self, path, base=16, factor=4, block_rows=64):
+        self.folder = path + PYRAMID_SUFFIX
+        self.base = base
+        self.factor = factor
+        self.block_rows = block_rows
+        self.pyramids = {}
+        self.labels = {'com': ['power']}
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def bind(self, cortex):
+        cortex.bind(new_eeg_data=self.on_new_eeg_data)
+        cortex.bind(new_pow_data=self.on_new_pow_data)
+        cortex.bind(new_com_data=self.on_new_com_data)
+        cortex.bind(new_data_labels=self.on_new_data_labels)
+
+    def add(self, stream, t, row):
+        # samples are batched so the pyramid is updated with vectorized blocks
+        pending = self._pending.setdefault(stream, ([], []))
+        pending[0].append(t)
+        pending[1].append(row)
+        if len(pending[0]) >= self.block_rows:
+            self._flush_stream(stream)
+
+    def _flush_stream(self, stream):
+        times, rows = self._pending.get(stream, ([], []))
+        if not times:
+            return
+        values = np.asarray(rows, dtype=np.float64)
+        pyramid = self.pyramids.get(stream)
+        if pyramid is None:
+            pyramid = DecimationPyramid(values.shape[1], self.base, self.factor, self.labels.get(stream))
+            self.pyramids[stream] = pyramid
+        pyramid.append(times, values)
+        self._pending[stream] = ([], [])
+
+    def close(self):
+        for stream in list(self._pending):
+            self._flush_stream(stream)
+        os.makedirs(self.folder, exist_ok=True)
+        for stream, pyramid in self.pyramids.items():
+            pyramid.save(os.path.join(self.folder, stream))
+
+    # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.labels[data['streamName']] = list(data['labels'])
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.add('eeg', data['time'], data['eeg'])
+
+    def on_new_pow_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.add('pow', data['time'], data['pow'])
+
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.add('com', data['time'], [data['power']])
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - While recording: recorder = PyramidRecorder('sessions/s1.log'); recorder.bind(cortex);
+#     recorder.close() when the session ends. python live.py --pyramid sessions/s1.log does this,
+#     and python replay.py sessions/s1.log --speed 0 --pyramid builds them for a recorded session
+#   - Offline: DecimationPyramid.from_arrays(*load_export(path).eeg()[:2]).save(path + '.pyramid/eeg')
+#   - Viewing: level = load_pyramid('sessions/s1.log.pyramid/eeg').query(t0, t1, 1200)
+#     then plot level.min / level.max as an envelope over level.time
+#   - python decimation.py benchmarks a pyramid of 2 hours of synthetic EEG
+#
+# -----------------------------------------------------------
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    rate = 128
+    n = int(hours * 3600 * rate)
+    rng = np.random.default_rng(0)
+    times = 1.7e9 + np.arange(n) / rate
+    values = np.cumsum(rng.standard_normal((n, 14)), axis=0)
+
+    start = time.perf_counter()
+    pyramid = DecimationPyramid(14)
+    for i in range(0, n, 64):
+        pyramid.append(times[i:i + 64], values[i:i + 64])
+    build = time.perf_counter() - start
+
+    folder = os.path.join(os.getcwd(), 'decimation_benchmark' + PYRAMID_SUFFIX)
+    pyramid.save(folder)
+    loaded = load_pyramid(folder)
+    start = time.perf_counter()
+    level = loaded.query(times[0], times[-1], 1200)
+    query = time.perf_counter() - start
+    shutil.rmtree(folder)
+
+    print('{0:.1f} h of 14 channels: {1:.1f} MB raw, pyramid {2:.1f} MB with {3} levels'.format(
+        hours, values.nbytes / 1e6, pyramid.nbytes() / 1e6, len(pyramid.levels)))
+    print('incremental build: {0:.2f} s ({1:.1f} M samples/s)'.format(build, n / build / 1e6))
+    print('query of the whole session at 1200 px: {0} bins of {1} samples, {2:.1f} KB read in {3:.2f} ms'.format(
+        len(level), level.samples, 3 * level.min.nbytes / 1e3 + level.time.nbytes / 1e3, query * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Decision engine turning the com stream into lift decisions
+
+A policy sees the 'lift' power of every com sample (0 for any other action) and
+decides when the arm should move. Every policy is O(1) per sample and returns
+the time of the first sample supporting a decision, so the engine reports the
+decision latency from that sample:
+
+    ThresholdPolicy     power above the threshold, once per crossing
+    HysteresisPolicy    switches off only below threshold - hysteresis, and
+                        optionally decides after a minimum hold time
+    VotingPolicy        n of the last m samples above the threshold
+    SprtPolicy          Wald's sequential probability ratio test between a
+                        rest and a lift power level, deciding as soon as the
+                        evidence reaches the error rates asked for
+    RefractoryPolicy    wraps any policy, no decision within refractory
+                        seconds of the previous one
+
+HysteresisPolicy with a RefractoryPolicy around it is the policy simulated by
+policy_sim.py, so its --apply output loads with load_policy. Policies with a
+threshold follow set_threshold, for com_stats.ComStats recommendations.
+"""
+
+import json
+import math
+import sys
+import time
+from collections import deque
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+from adjust_sensitivity import get_current_threshold
+
+
+class ThresholdPolicy():
+    """
+    A decision when the power goes above the threshold, once until it drops back
+    """
+    name = 'threshold'
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self._above = False
+
+    def set_threshold(self, threshold):
+        self.threshold = threshold
+
+    def update(self, t, power):
+        """
+        Returns
+        -------
+        float or None
+            time of the first supporting sample when a decision is taken, None otherwise
+        """
+        above = power > self.threshold
+        fired = above and not self._above
+        self._above = above
+        return t if fired else None
+
+    def reset(self):
+        self._above = False
+
+
+class HysteresisPolicy(ThresholdPolicy):
+    """
+    A decision once the power has stayed on for hold seconds; on above the threshold, off at or
+    below threshold - hysteresis
+    """
+    name = 'hysteresis'
+
+    def __init__(self, threshold=0.5, hysteresis=0.1, hold=0.0):
+        super().__init__(threshold)
+        self.hysteresis = hysteresis
+        self.hold = hold
+        self._on_since = None
+        self._fired = False
+
+    def update(self, t, power):
+        if power > self.threshold:
+            if self._on_since is None:
+                self._on_since = t
+                self._fired = False
+        elif power <= max(self.threshold - self.hysteresis, 0.0):
+            self._on_since = None
+        if self._on_since is None or self._fired or t - self._on_since < self.hold:
+            return None
+        self._fired = True
+        return self._on_since
+
+    def reset(self):
+        self._on_since = None
+        self._fired = False
+
+
+class VotingPolicy(ThresholdPolicy):
+    """
+    A decision when n of the last m samples are above the threshold, again once none of them is
+    """
+    name = 'vote'
+
+    def __init__(self, threshold=0.5, n=3, m=5):
+        if not 0 < n <= m:
+            raise ValueError('VotingPolicy needs 0 < n <= m.')
+        super().__init__(threshold)
+        self.n = n
+        self.m = m
+        self.reset()
+
+    def update(self, t, power):
+        self._index += 1
+        while self._support and self._support[0][0] <= self._index - self.m:
+            self._support.popleft()
+        if power > self.threshold:
+            self._support.append((self._index, t))
+        if not self._support:
+            self._armed = True
+        elif self._armed and len(self._support) >= self.n:
+            self._armed = False
+            return self._support[0][1]
+        return None
+
+    def reset(self):
+        # (sample index, time) of the samples above the threshold among the last m
+        self._support = deque()
+        self._index = 0
+        self._armed = True
+
+
+class SprtPolicy():
+    """
+    Sequential probability ratio test between a rest power level and a lift power level
+
+    Powers are taken as gaussian with standard deviation sigma around rest_level or lift_level.
+    The log-likelihood ratio is accumulated sample by sample; a decision is taken when it reaches
+    log((1 - beta) / alpha), and the test restarts from 0 when it falls to log(beta / (1 - alpha)).
+    After a decision, the next one needs the test to have gone back to rest first.
+    """
+    name = 'sprt'
+    threshold = None
+
+    def __init__(self, rest_level=0.05, lift_level=0.6, sigma=0.25, alpha=0.01, beta=0.05):
+        self.rest_level = rest_level
+        self.lift_level = lift_level
+        self.sigma = sigma
+        self.alpha = alpha
+        self.beta = beta
+        self._upper = math.log((1.0 - beta) / alpha)
+        self._lower = math.log(beta / (1.0 - alpha))
+        self._slope = (lift_level - rest_level) / sigma ** 2
+        self._middle = (lift_level + rest_level) / 2.0
+        self.reset()
+
+    def set_threshold(self, threshold):
+        pass
+
+    def update(self, t, power):
+        step = self._slope * (power - self._middle)
+        if self._start is None and step > 0:
+            self._start = t
+        self.llr += step
+        if self.llr <= self._lower:
+            # rest: the test starts again
+            self.llr = 0.0
+            self._start = None
+            self._armed = True
+        elif self.llr >= self._upper:
+            self.llr = self._upper
+            if self._armed:
+                self._armed = False
+                return self._start if self._start is not None else t
+        return None
+
+    def reset(self):
+        self.llr = 0.0
+        self._start = None
+        self._armed = True
+
+
+class RefractoryPolicy():
+    """
+    Any policy with no decision within refractory seconds of the previous decision
+    """
+    def __init__(self, policy, refractory=2.0):
+        self.policy = policy
+        self.refractory = refractory
+        self.name = '{0}+refractory'.format(policy.name)
+        self._last = None
+
+    @property
+    def threshold(self):
+        return self.policy.threshold
+
+    def set_threshold(self, threshold):
+        self.policy.set_threshold(threshold)
+
+    def update(self, t, power):
+        first = self.policy.update(t, power)
+        if first is None or (self._last is not None and t - self._last < self.refractory):
+            return None
+        self._last = t
+        return first
+
+    def reset(self):
+        self.policy.reset()
+        self._last = None
+
+
+POLICIES = {policy.name: policy for policy in (ThresholdPolicy, HysteresisPolicy, VotingPolicy, SprtPolicy)}
+
+
+def make_policy(name, refractory=0.0, **params):
+    """
+    To build a policy by name, wrapped in a RefractoryPolicy when refractory > 0
+
+    Raises
+    ------
+    ValueError
+        for an unknown name
+    """
+    if name not in POLICIES:
+        raise ValueError('Unknown policy {0}, expected one of {1}.'.format(name, ', '.join(POLICIES)))
+    policy = POLICIES[name](**params)
+    return RefractoryPolicy(policy, refractory) if refractory > 0 else policy
+
+
+def load_policy(path):
+    """
+    To load a policy saved by policy_sim.py --apply, or a json dict with a 'policy' name and its parameters
+    """
+    with open(path, 'r') as f:
+        saved = json.load(f)
+    if 'policy' in saved:
+        params = dict(saved)
+        return make_policy(params.pop('policy'), **params)
+    return make_policy('hysteresis', threshold=saved['threshold'], hysteresis=saved['hysteresis'],
+                       hold=saved['hold'], refractory=saved['refractory'])
+
+
+def parse_policy(spec, threshold=None):
+    """
+    To build a policy from a command line spec: a json file, or name[:key=value,...] such as
+    hysteresis:hysteresis=0.1,hold=0.5,refractory=2. threshold is used when the spec has none.
+    """
+    if spec.endswith('.json'):
+        return load_policy(spec)
+    name, _, items = spec.partition(':')
+    params = {}
+    for item in filter(None, items.split(',')):
+        key, _, value = item.partition('=')
+        params[key] = int(value) if key in ('n', 'm') else float(value)
+    if name != 'sprt' and 'threshold' not in params:
+        params['threshold'] = get_current_threshold() if threshold is None else threshold
+    return make_policy(name, **params)
+
+
+class DecisionEngine(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to run a policy on the com stream and publish its decisions
+
+    Attributes
+    ----------
+    policy : object
+        the policy, swappable at any time
+    action : str
+        the action whose power feeds the policy, every other action is power 0
+    latencies : list
+        seconds between the first supporting sample and the decision, last keep_latencies decisions
+    latest : dict or None
+        the last decision
+
+    Methods
+    -------
+    push(t, action, power):
+        To feed one com sample, returns the decision or None
+    set_policy(policy):
+        To swap the policy
+    set_threshold(threshold):
+        To change the threshold of the policy, when it has one
+    """
+    _events_ = ['new_decision']
+
+    def __init__(self, cortex_client=None, policy=None, action='lift', subscribe=(), keep_latencies=1000):
+        self.policy = policy if policy is not None else ThresholdPolicy(get_current_threshold())
+        self.action = action
+        self.subscribe = list(subscribe)
+        self.latencies = []
+        self._keep_latencies = keep_latencies
+        self.latest = None
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_com_data=self.on_new_com_data)
+
+    @property
+    def threshold(self):
+        return self.policy.threshold
+
+    def set_threshold(self, threshold):
+        self.policy.set_threshold(threshold)
+
+    def set_policy(self, policy):
+        self.policy = policy
+
+    def push(self, t, action, power):
+        """
+        Returns
+        -------
+        dict or None
+            {'action', 'power', 'time', 'first_support', 'latency', 'policy'} when a decision is taken
+        """
+        first = self.policy.update(t, power if action == self.action else 0.0)
+        if first is None:
+            return None
+        self.latest = {'action': self.action, 'power': power, 'time': t, 'first_support': first,
+                       'latency': t - first, 'policy': self.policy.name}
+        self.latencies.append(t - first)
+        if len(self.latencies) > self._keep_latencies:
+            del self.latencies[:-self._keep_latencies]
+        self.emit('new_decision', data=self.latest)
+        return self.latest
+
+    # callbacks functions
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push(data['time'], data['action'], data['power'])
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - engine = DecisionEngine(cortex, policy=make_policy('hysteresis', threshold=0.5, hold=0.5, refractory=2))
+#     publishes new_decision events; without a cortex, engine.push(t, action, power) returns the decision
+#   - live.py takes its lift decisions from a DecisionEngine, --policy picks the policy:
+#     threshold (default, at adjust_sensitivity.py's threshold), hysteresis:hold=0.5, vote:n=3,m=5,
+#     sprt:alpha=0.01, any of them with refractory=2, or the .current_policy.json of policy_sim.py --apply
+#   - python decision.py compares the policies on a synthetic hour of com
+#
+# -----------------------------------------------------------
+
+def main():
+    from synthetic import SignalGenerator, score_detections
+    session = SignalGenerator(seed=7).generate(3600, start_time=0.0)
+    samples = list(zip(session.com_times.tolist(), session.com_actions.tolist(), session.com_power.tolist()))
+    rest_minutes = (session.com_times[-1] - np.sum(session.lift_offsets - session.lift_onsets)) / 60.0
+    specs = sys.argv[1:] or ['threshold:threshold=0.5', 'hysteresis:threshold=0.5,hysteresis=0.2,hold=0.5',
+                             'vote:threshold=0.5,n=3,m=5', 'sprt', 'hysteresis:threshold=0.5,hold=0.25,refractory=3']
+    for spec in specs:
+        engine = DecisionEngine(policy=parse_policy(spec), keep_latencies=len(samples))
+        decisions = []
+        start = time.perf_counter()
+        for t, action, power in samples:
+            decision = engine.push(t, action, power)
+            if decision is not None:
+                decisions.append(decision['time'])
+        elapsed = time.perf_counter() - start
+        score = score_detections(decisions, session.lift_onsets, session.lift_offsets, tolerance=1.0)
+        print('{0}: {1} hits, {2} misses, {3:.2f} false/min, latency from onset {4:.2f} s, '
+              'from first support {5:.2f} s, {6:.1f} us per sample'.format(
+                  spec, score['hits'], score['misses'], score['false_triggers'] / rest_minutes,
+                  np.nanmedian(score['latencies']), np.median(engine.latencies) if engine.latencies else float('nan'),
+                  elapsed / len(samples) * 1e6))
+
+if __name__ == '__main__':
+    main()
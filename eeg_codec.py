@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Compact lossless codec for the numeric Cortex streams (eeg, mot, pow, met)
+
+Values are quantized to the decimal resolution Cortex reports them with,
+delta and zigzag encoded per channel, byte-shuffled and packed in chunks with
+zlib. Every chunk carries its own header, so chunks can be decoded on their own
+and in parallel. A column that is not exactly representable at the chosen
+resolution (NaN, booleans turned to floats, extra precision) is stored raw,
+so decoding always gives back exactly the values that were written.
+"""
+
+import io
+import json
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+CHUNK_MAGIC = b'EZC1'
+ARCHIVE_MAGIC = b'EZA1'
+
+# number of decimals Cortex uses for each stream, the time column included
+DEFAULT_DECIMALS = {
+    'time': 6,
+    'eeg': 6,
+    'mot': 6,
+    'pow': 6,
+    'met': 6,
+}
+
+DEFAULT_CHUNK_ROWS = 4096
+
+_UINT_TYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+_MAX_EXACT_INT = 2 ** 53
+
+
+def _encode_int_column(q):
+    """delta + gcd + zigzag encode one int64 column, returns (spec, bytes)"""
+    first = int(q[0])
+    deltas = np.diff(q)
+    step = int(np.gcd.reduce(deltas)) if len(deltas) else 0
+    if step == 0:
+        step = 1
+    if step != 1:
+        deltas = deltas // step
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+    peak = int(zigzag.max()) if len(zigzag) else 0
+    for utype in _UINT_TYPES:
+        if peak <= np.iinfo(utype).max:
+            break
+    packed = zigzag.astype(utype)
+    width = packed.dtype.itemsize
+    # byte shuffle: all low bytes first, then the next bytes, ... which zlib likes
+    shuffled = packed.view(np.uint8).reshape(-1, width).T.tobytes()
+    spec = {'mode': 'int', 'first': first, 'gcd': step, 'width': width}
+    return spec, shuffled
+
+
+def _decode_int_column(spec, buf, rows):
+    width = spec['width']
+    utype = np.dtype('<u{0}'.format(width))
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(width, rows - 1).T
+    zigzag = np.ascontiguousarray(raw).view(utype).ravel().astype(np.int64)
+    deltas = (zigzag >> 1) ^ -(zigzag & 1)
+    if spec['gcd'] != 1:
+        deltas *= spec['gcd']
+    q = np.empty(rows, dtype=np.int64)
+    q[0] = spec['first']
+    np.cumsum(deltas, out=q[1:])
+    q[1:] += spec['first']
+    return q
+
+
+def encode_chunk(stream, times, values, decimals=None, level=6):
+    """
+    To encode one block of samples of a stream into a self-contained chunk
+
+    Parameters
+    ----------
+    stream : str, required
+        stream name such as 'eeg', 'mot', 'pow' or 'met'
+    times : array-like, required
+        sample times, shape (n_samples,)
+    values : array-like, required
+        sample values, shape (n_samples, n_channels)
+    decimals : int, optional
+        decimal resolution of the values. Default is DEFAULT_DECIMALS[stream]
+    level : int, optional
+        zlib compression level
+
+    Returns
+    -------
+    bytes
+        the encoded chunk
+    """
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    if len(times) != len(values):
+        raise ValueError('times and values must have the same number of rows.')
+    if len(times) == 0:
+        raise ValueError('Cannot encode an empty chunk.')
+
+    if decimals is None:
+        decimals = DEFAULT_DECIMALS.get(stream, 6)
+    table = np.column_stack([times, values])
+    scales = np.full(table.shape[1], 10.0 ** decimals)
+    scales[0] = 10.0 ** DEFAULT_DECIMALS['time']
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = np.rint(table * scales)
+        exact = (scaled / scales == table) & (np.abs(scaled) < _MAX_EXACT_INT)
+    int_cols = exact.all(axis=0)
+    quantized = np.where(exact, scaled, 0).astype(np.int64)
+
+    columns = []
+    parts = []
+    for col in range(table.shape[1]):
+        if int_cols[col] and len(table) > 1:
+            spec, buf = _encode_int_column(quantized[:, col])
+            spec['scale'] = float(scales[col])
+        elif int_cols[col]:
+            spec, buf = {'mode': 'int', 'first': int(quantized[0, col]), 'gcd': 1,
+                         'width': 1, 'scale': float(scales[col])}, b''
+        else:
+            column = np.ascontiguousarray(table[:, col]).astype('<f8')
+            spec = {'mode': 'raw', 'width': 8}
+            buf = column.view(np.uint8).reshape(-1, 8).T.tobytes()
+        spec['size'] = len(buf)
+        columns.append(spec)
+        parts.append(buf)
+
+    header = json.dumps({'stream': stream, 'rows': len(table), 'cols': values.shape[1],
+                         'columns': columns}, separators=(',', ':')).encode('utf-8')
+    payload = zlib.compress(b''.join(parts), level)
+    return b''.join([CHUNK_MAGIC, struct.pack('<II', len(header), len(payload)), header, payload])
+
+
+def decode_chunk(chunk):
+    """
+    To decode a chunk produced by encode_chunk
+
+    Parameters
+    ----------
+    chunk : bytes, required
+        the encoded chunk
+
+    Returns
+    -------
+    tuple
+        (stream, times, values) with times shape (n_samples,) and values shape (n_samples, n_channels)
+    """
+    view = memoryview(chunk)
+    if bytes(view[:4]) != CHUNK_MAGIC:
+        raise ValueError('Not an EEG codec chunk.')
+    header_len, payload_len = struct.unpack_from('<II', view, 4)
+    header = json.loads(bytes(view[12:12 + header_len]).decode('utf-8'))
+    payload = zlib.decompress(view[12 + header_len:12 + header_len + payload_len])
+
+    rows = header['rows']
+    table = np.empty((rows, header['cols'] + 1), dtype=np.float64)
+    offset = 0
+    for col, spec in enumerate(header['columns']):
+        buf = payload[offset:offset + spec['size']]
+        offset += spec['size']
+        if spec['mode'] == 'raw':
+            raw = np.frombuffer(buf, dtype=np.uint8).reshape(8, rows).T
+            table[:, col] = np.ascontiguousarray(raw).view('<f8').ravel()
+        elif rows == 1:
+            table[0, col] = spec['first'] / spec['scale']
+        else:
+            table[:, col] = _decode_int_column(spec, buf, rows) / spec['scale']
+    return header['stream'], table[:, 0], table[:, 1:]
+
+
+def events_to_arrays(events, stream):
+    """
+    To turn a list of Cortex stream data (as emitted by new_eeg_data, new_mot_data, ...)
+    into (times, values) arrays
+
+    Parameters
+    ----------
+    events : list, required
+        list of data dicts, for example [{'eeg': [...], 'time': 1590736942.8479}, ...]
+    stream : str, required
+        key of the values in each dict ('eeg', 'mot', 'pow' or 'met')
+
+    Returns
+    -------
+    tuple
+        (times, values)
+    """
+    times = np.fromiter((e['time'] for e in events), dtype=np.float64, count=len(events))
+    values = np.array([e[stream] for e in events], dtype=np.float64)
+    return times, values
+
+
+class ArchiveWriter():
+    """
+    A class to write stream samples into a chunked archive file.
+    It can be bound to a Cortex instance to archive the streams while recording.
+
+    Attributes
+    ----------
+    path : str
+        archive file path
+    chunk_rows : int
+        number of samples per chunk
+
+    Methods
+    -------
+    write(stream, times, values):
+        To append a block of samples of a stream
+    append_event(stream, data):
+        To append one sample as emitted by Cortex
+    bind(cortex):
+        To archive the numeric streams emitted by a Cortex instance
+    close():
+        To flush the pending samples and close the file
+    """
+    def __init__(self, path, chunk_rows=DEFAULT_CHUNK_ROWS, decimals=None, level=6):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.decimals = decimals or {}
+        self.level = level
+        self.bytes_written = 0
+        self._pending = {}
+        self._file = open(path, 'wb')
+        self._file.write(ARCHIVE_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_chunk(self, stream, times, values):
+        chunk = encode_chunk(stream, times, values, self.decimals.get(stream), self.level)
+        self._file.write(struct.pack('<I', len(chunk)))
+        self._file.write(chunk)
+        self.bytes_written += len(chunk) + 4
+
+    def write(self, stream, times, values):
+        """
+        To append a block of samples of a stream. Full chunks are written immediately.
+
+        Parameters
+        ----------
+        stream : str, required
+            stream name
+        times : array-like, required
+            sample times
+        values : array-like, required
+            sample values, shape (n_samples, n_channels)
+
+        Returns
+        -------
+        None
+        """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values[:, None]
+        for start in range(0, len(times), self.chunk_rows):
+            stop = start + self.chunk_rows
+            self._write_chunk(stream, times[start:stop], values[start:stop])
+
+    def append_event(self, stream, data):
+        """
+        To append one sample as emitted by Cortex, for example
+        append_event('eeg', {'eeg': [...], 'time': 1590736942.8479})
+        """
+        pending = self._pending.setdefault(stream, [])
+        pending.append(data)
+        if len(pending) >= self.chunk_rows:
+            self._flush_stream(stream)
+
+    def _flush_stream(self, stream):
+        pending = self._pending.get(stream)
+        if pending:
+            times, values = events_to_arrays(pending, stream)
+            self._write_chunk(stream, times, values)
+            self._pending[stream] = []
+
+    def bind(self, cortex):
+        """
+        To archive the eeg, mot, pow and met streams emitted by a Cortex instance
+
+        Parameters
+        ----------
+        cortex : Cortex, required
+            the Cortex instance. The streams still have to be subscribed.
+
+        Returns
+        -------
+        None
+        """
+        # Dispatcher keeps weak references, so bind methods rather than lambdas
+        cortex.bind(new_eeg_data=self.on_new_eeg_data)
+        cortex.bind(new_mot_data=self.on_new_mot_data)
+        cortex.bind(new_pow_data=self.on_new_pow_data)
+        cortex.bind(new_met_data=self.on_new_met_data)
+
+    # callbacks functions
+    def on_new_eeg_data(self, *args, **kwargs):
+        self.append_event('eeg', kwargs.get('data'))
+
+    def on_new_mot_data(self, *args, **kwargs):
+        self.append_event('mot', kwargs.get('data'))
+
+    def on_new_pow_data(self, *args, **kwargs):
+        self.append_event('pow', kwargs.get('data'))
+
+    def on_new_met_data(self, *args, **kwargs):
+        self.append_event('met', kwargs.get('data'))
+
+    def close(self):
+        if self._file.closed:
+            return
+        for stream in list(self._pending):
+            self._flush_stream(stream)
+        self._file.close()
+
+
+def iter_chunks(path):
+    """
+    To iterate over the raw chunks of an archive without decoding them
+
+    Returns
+    -------
+    generator of memoryview
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != ARCHIVE_MAGIC:
+        raise ValueError('Not an EEG codec archive: ' + str(path))
+    view = memoryview(data)
+    offset = 4
+    while offset < len(data):
+        size, = struct.unpack_from('<I', view, offset)
+        offset += 4
+        yield view[offset:offset + size]
+        offset += size
+
+
+def read_archive(path, streams=None, workers=None):
+    """
+    To read an archive, decoding the chunks in parallel
+
+    Parameters
+    ----------
+    path : str, required
+        archive file path
+    streams : list, optional
+        only return these streams. Chunks of other streams are still scanned but not decoded
+    workers : int, optional
+        number of decoding threads. Default lets ThreadPoolExecutor decide
+
+    Returns
+    -------
+    dict
+        {stream: (times, values)} with the chunks of each stream concatenated in order
+    """
+    chunks = []
+    for chunk in iter_chunks(path):
+        if streams is not None:
+            header_len, = struct.unpack_from('<I', chunk, 4)
+            stream = json.loads(bytes(chunk[12:12 + header_len]))['stream']
+            if stream not in streams:
+                continue
+        chunks.append(chunk)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        decoded = list(pool.map(decode_chunk, chunks))
+
+    result = {}
+    for stream, times, values in decoded:
+        result.setdefault(stream, ([], []))
+        result[stream][0].append(times)
+        result[stream][1].append(values)
+    return {stream: (np.concatenate(t), np.concatenate(v)) for stream, (t, v) in result.items()}
+
+
+def benchmark(seconds=600, channels=14, rate=128, seed=0):
+    """
+    To measure compression ratio and encode/decode throughput against CSV on synthetic EEG
+
+    Returns
+    -------
+    dict
+        sizes in bytes and throughputs in samples per second
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * rate)
+    times = np.round(1590736942.0 + np.arange(n) / rate, 4)
+    # random walk around the EPOC baseline, in LSB of 0.128205128 uV, rounded to 6 decimals like Cortex
+    counts = 32768 + np.cumsum(rng.integers(-40, 41, size=(n, channels)), axis=0)
+    values = np.round(counts * 0.128205128, 6)
+
+    csv_buf = io.StringIO()
+    np.savetxt(csv_buf, np.column_stack([times, values]), delimiter=',', fmt='%.6f')
+    csv_text = csv_buf.getvalue()
+
+    start = time.perf_counter()
+    chunks = [encode_chunk('eeg', times[i:i + DEFAULT_CHUNK_ROWS], values[i:i + DEFAULT_CHUNK_ROWS])
+              for i in range(0, n, DEFAULT_CHUNK_ROWS)]
+    encode_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor() as pool:
+        decoded = list(pool.map(decode_chunk, chunks))
+    decode_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    np.loadtxt(io.StringIO(csv_text), delimiter=',')
+    csv_s = time.perf_counter() - start
+
+    restored = np.concatenate([d[2] for d in decoded])
+    if not np.array_equal(restored, values):
+        raise RuntimeError('Codec round trip is not lossless.')
+
+    return {
+        'samples': n,
+        'channels': channels,
+        'csv_bytes': len(csv_text),
+        'codec_bytes': sum(len(c) for c in chunks),
+        'encode_samples_per_s': n / encode_s,
+        'decode_samples_per_s': n / decode_s,
+        'csv_parse_samples_per_s': n / csv_s,
+    }
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Archive the streams while recording:
+#         writer = ArchiveWriter('session.eza')
+#         writer.bind(cortex)        # then subscribe ['eeg', 'mot', 'pow', 'met']
+#         ...
+#         writer.close()
+#   - Load them back with read_archive('session.eza')
+# RESULT
+#   - Run this file to see the compression ratio and throughput on synthetic EEG
+#
+# -----------------------------------------------------------
+
+def main():
+    result = benchmark()
+    print('samples: {0} x {1} channels'.format(result['samples'], result['channels']))
+    print('CSV size:   {0:.2f} MB'.format(result['csv_bytes'] / 1e6))
+    print('codec size: {0:.2f} MB (x{1:.1f} smaller)'.format(
+        result['codec_bytes'] / 1e6, result['csv_bytes'] / result['codec_bytes']))
+    print('encode: {0:.2f} M samples/s'.format(result['encode_samples_per_s'] / 1e6))
+    print('decode: {0:.2f} M samples/s'.format(result['decode_samples_per_s'] / 1e6))
+    print('CSV parse: {0:.2f} M samples/s'.format(result['csv_parse_samples_per_s'] / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Event-locked epoching of EEG around markers and training events
+
+extract_epochs cuts the windows around a list of event times out of a recorded
+or live buffer (a (times, values) pair such as export_loader.EmotivExport.eeg()
+or ring_buffer.TimedRingBuffer.view()) and returns them stacked as
+(n_epochs, n_samples, n_channels). The windows are gathered through one strided
+view of the buffer, so there is a single copy for all epochs; baseline
+correction and rejection are vectorized over epochs and channels.
+EventCollector gathers the events live from a Cortex: sys training events and
+injected markers.
+"""
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from feature_cache import file_fingerprint
+from replay import read_session
+
+
+class Epochs():
+    """
+    Epochs extracted around events
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        shape (n_epochs, n_samples, n_channels)
+    times : numpy.ndarray
+        sample times relative to the event, shape (n_samples,)
+    event_times : numpy.ndarray
+        times of the kept events
+    labels : numpy.ndarray
+        labels of the kept events
+    dropped : dict
+        reason -> indexes (in the given event list) of the dropped events:
+        'edge' (window outside the buffer), 'amplitude' and 'flat'
+    """
+    def __init__(self, data, times, event_times, labels, dropped):
+        self.data = data
+        self.times = times
+        self.event_times = event_times
+        self.labels = labels
+        self.dropped = dropped
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, label):
+        # epochs of one label
+        return self.data[self.labels == label]
+
+    def average(self, label=None):
+        data = self.data if label is None else self[label]
+        return data.mean(axis=0)
+
+
+def _sample_rate(times):
+    return 1.0 / np.median(np.diff(times[:1024]))
+
+
+def extract_epochs(times, values, event_times, tmin=-0.5, tmax=1.0, labels=None, rate=None,
+                   baseline=(None, 0.0), reject=None, flat=None):
+    """
+    Parameters
+    ----------
+    times : array, required
+        sample times of the buffer, increasing
+    values : array, required
+        buffer values, shape (n_samples, n_channels). Can be a memory-mapped array
+    event_times : array, required
+        event times in the same clock as times
+    tmin, tmax : float, optional
+        window around each event in seconds; tmin is negative for a pre-event window
+    labels : list, optional
+        one label per event
+    rate : float, optional
+        sample rate. Default is estimated from times
+    baseline : tuple or None, optional
+        (start, end) in seconds relative to the event, None meaning the window edge.
+        The mean of that interval is subtracted per epoch and channel. None disables it
+    reject : float, optional
+        drop epochs whose peak-to-peak amplitude exceeds it on any channel
+    flat : float, optional
+        drop epochs whose peak-to-peak amplitude is below it on any channel
+
+    Returns
+    -------
+    Epochs
+    """
+    times = np.asarray(times, dtype=np.float64)
+    event_times = np.asarray(event_times, dtype=np.float64).reshape(-1)
+    labels = np.asarray(labels if labels is not None else [''] * len(event_times))
+    if values.ndim == 1:
+        values = values[:, None]
+    if rate is None:
+        rate = _sample_rate(times)
+
+    offset = int(round(tmin * rate))
+    n_samples = int(round(tmax * rate)) - offset + 1
+    onsets = np.searchsorted(times, event_times - 0.5 / rate)
+    starts = onsets + offset
+    inside = (starts >= 0) & (starts + n_samples <= len(times)) & (onsets < len(times))
+    # an onset is the first sample at or after the event, it must be close to the event
+    inside[inside] &= np.abs(times[onsets[inside]] - event_times[inside]) <= 1.0 / rate
+    dropped = {'edge': np.flatnonzero(~inside)}
+    kept = np.flatnonzero(inside)
+
+    # (n_windows, n_samples, n_channels) read-only view of every window, gathered once
+    windows = as_strided(values, (max(len(values) - n_samples + 1, 0), n_samples, values.shape[1]),
+                         (values.strides[0],) + values.strides, writeable=False)
+    data = windows[starts[kept]].astype(np.float64, copy=False)
+    epoch_times = (offset + np.arange(n_samples)) / rate
+
+    if baseline is not None and len(kept):
+        b0 = 0 if baseline[0] is None else int(np.searchsorted(epoch_times, baseline[0] - 0.5 / rate))
+        b1 = n_samples if baseline[1] is None else int(np.searchsorted(epoch_times, baseline[1] + 0.5 / rate))
+        if b1 > b0:
+            data -= data[:, b0:b1].mean(axis=1, keepdims=True)
+
+    keep = np.ones(len(kept), dtype=bool)
+    if (reject is not None or flat is not None) and len(kept):
+        ptp = data.max(axis=1) - data.min(axis=1)
+        if reject is not None:
+            bad = (ptp > reject).any(axis=1)
+            dropped['amplitude'] = kept[bad]
+            keep &= ~bad
+        if flat is not None:
+            bad = (ptp < flat).any(axis=1) & keep
+            dropped['flat'] = kept[bad]
+            keep &= ~bad
+    if not keep.all():
+        data = data[keep]
+        kept = kept[keep]
+
+    return Epochs(data, epoch_times, event_times[kept], labels[kept], dropped)
+
+
+def sys_trial_events(sys_times, sys_events, actions, start_event='MC_Started'):
+    """
+    To turn training sys events into labelled trial onsets.
+    Train trains the actions in order, so trial k is for actions[k % len(actions)].
+
+    Parameters
+    ----------
+    sys_times : list, required
+        time of each sys event
+    sys_events : list, required
+        sys event data such as ['mentalCommand', 'MC_Started']
+    actions : list, required
+        trained actions in order, for example ['neutral', 'lift']
+
+    Returns
+    -------
+    tuple
+        (onset times, action labels)
+    """
+    onsets = [t for t, e in zip(sys_times, sys_events) if e[1] == start_event]
+    labels = [actions[k % len(actions)] for k in range(len(onsets))]
+    return np.array(onsets, dtype=np.float64), np.array(labels)
+
+
+def session_events(path, cache=None):
+    """
+    To read the sys events and the eeg samples of a session recorded with replay.SessionRecorder
+
+    Parameters
+    ----------
+    cache : feature_cache.FeatureCache, optional
+        with a cache, the session is parsed once and its arrays are loaded memory-mapped afterwards
+
+    Returns
+    -------
+    tuple
+        (sys times, sys events, eeg times, eeg values)
+    """
+    if cache is not None:
+        arrays = cache.stage('epochs.session_events', version=1)(_session_arrays)(
+            os.path.abspath(path), file_fingerprint(path))
+        return (arrays['sys_times'], [json.loads(e) for e in arrays['sys_events']], arrays['eeg_times'],
+                arrays['eeg'])
+    sys_times, sys_events, eeg_times, eeg_rows = [], [], [], []
+    for _, message in read_session(path):
+        if '"sys"' not in message and '"eeg"' not in message:
+            continue
+        data = json.loads(message)
+        if 'time' not in data:
+            # a response such as the subscription result
+            continue
+        if 'sys' in data:
+            sys_times.append(data['time'])
+            sys_events.append(data['sys'])
+        elif 'eeg' in data:
+            # drop MARKERS like Cortex.handle_stream_data
+            eeg_times.append(data['time'])
+            eeg_rows.append(data['eeg'][:-1])
+    return (np.array(sys_times), sys_events, np.array(eeg_times),
+            np.array(eeg_rows, dtype=np.float64))
+
+
+def _session_arrays(path, fingerprint):
+    # the cached form of session_events; fingerprint only keys the entry, so an edited log is read again
+    sys_times, sys_events, eeg_times, eeg = session_events(path)
+    return {'sys_times': sys_times, 'sys_events': np.array([json.dumps(e) for e in sys_events], dtype=str),
+            'eeg_times': eeg_times, 'eeg': eeg}
+
+
+def session_markers(path):
+    """
+    To read the markers injected while a session was recorded with replay.SessionRecorder
+
+    Returns
+    -------
+    tuple
+        (marker times, marker labels)
+    """
+    times, labels = [], []
+    for _, message in read_session(path):
+        if '"marker"' not in message:
+            continue
+        marker = json.loads(message).get('result', {}).get('marker')
+        if not isinstance(marker, dict):
+            continue
+        try:
+            times.append(datetime.fromisoformat(marker['startDatetime']).timestamp())
+        except (KeyError, TypeError, ValueError):
+            continue
+        labels.append(marker.get('label', ''))
+    return np.array(times, dtype=np.float64), np.array(labels)
+
+
+class EventCollector():
+    """
+    A class to collect events from a Cortex while it streams.
+    sys events carry no time, so they are stamped with the time of the last eeg sample.
+
+    Attributes
+    ----------
+    times : list
+        event times
+    labels : list
+        event labels: the sys event name, such as 'MC_Started', or the marker label
+
+    Methods
+    -------
+    add(t, label):
+        To add an event
+    mark(label, value):
+        To inject a marker into the record and collect it
+    ready(latest_time, tmax):
+        To get the events whose post-event window has been received
+    """
+    def __init__(self, cortex, events=('MC_Started', 'MC_Succeeded', 'MC_Failed')):
+        self.c = cortex
+        self.events = events
+        self.times = []
+        self.labels = []
+        self.last_time = None
+        self._consumed = 0
+        self.c.bind(new_eeg_data=self.on_new_eeg_data)
+        self.c.bind(new_sys_data=self.on_new_sys_data)
+        self.c.bind(inject_marker_done=self.on_inject_marker_done)
+
+    def add(self, t, label):
+        self.times.append(t)
+        self.labels.append(label)
+
+    def mark(self, label, value=1):
+        # Cortex expects the marker time in milliseconds
+        now = self.c.clock.time()
+        self.c.inject_marker_request(int(now * 1000), value, label)
+        return now
+
+    def ready(self, latest_time, tmax):
+        """
+        Returns
+        -------
+        tuple
+            (times, labels) of the new events whose window ends before latest_time
+        """
+        end = self._consumed
+        while end < len(self.times) and self.times[end] + tmax <= latest_time:
+            end += 1
+        times = np.array(self.times[self._consumed:end])
+        labels = np.array(self.labels[self._consumed:end])
+        self._consumed = end
+        return times, labels
+
+    # callbacks functions
+    def on_new_eeg_data(self, *args, **kwargs):
+        self.last_time = kwargs.get('data')['time']
+
+    def on_new_sys_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if len(data) > 1 and data[1] in self.events:
+            self.add(self.last_time if self.last_time is not None else self.c.clock.time(), data[1])
+
+    def on_inject_marker_done(self, *args, **kwargs):
+        marker = kwargs.get('data')
+        try:
+            t = datetime.fromisoformat(marker['startDatetime']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            t = self.last_time if self.last_time is not None else self.c.clock.time()
+        self.add(t, marker.get('label', ''))
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Offline, from an export: times, eeg, channels = load_export(path).eeg()
+#     epochs = extract_epochs(times, eeg, marker_times, tmin=-0.5, tmax=2.0, labels=marker_labels, reject=150)
+#   - From a session recorded while training:
+#     python epochs.py session.log neutral lift
+#   - Live: collector = EventCollector(cortex), keep eeg in a ring_buffer.TimedRingBuffer,
+#     and cut collector.ready(buffer.latest_time(), tmax) with extract_epochs(*buffer.view(), ...)
+#
+# -----------------------------------------------------------
+
+def main():
+    if len(sys.argv) < 3:
+        print('usage: python epochs.py session.log action [action ...]')
+        return
+    sys_times, sys_events, eeg_times, eeg = session_events(sys.argv[1])
+    onsets, labels = sys_trial_events(sys_times, sys_events, sys.argv[2:])
+    start = time.perf_counter()
+    # columns 2..15 are the 14 EPOC channels after COUNTER and INTERPOLATED
+    epochs = extract_epochs(eeg_times, eeg[:, 2:16], onsets, tmin=-0.5, tmax=2.0, labels=labels, reject=500.0)
+    elapsed = time.perf_counter() - start
+    print('{0} epochs of {1} samples x {2} channels in {3:.2f} ms, dropped: {4}'.format(
+        len(epochs), epochs.data.shape[1], epochs.data.shape[2], elapsed * 1000,
+        {k: len(v) for k, v in epochs.dropped.items()}))
+    for action in sys.argv[2:]:
+        print('{0}: {1} epochs'.format(action, len(epochs[action])))
+
+if __name__ == '__main__':
+    main()
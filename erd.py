@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Event-related desynchronization (ERD/ERS) of the pow stream
+
+The pow stream already carries theta/alpha/betaL/betaH/gamma power for every
+channel. ErdEngine keeps a rolling reference of that power taken only from
+settled neutral periods of the com stream, and a short moving average of the
+current power. Both are running sums over fixed-size ring buffers, so every pow
+sample costs a constant number of vector operations over all channel-band
+pairs. The relative change (current - reference) / reference is negative for a
+desynchronization, which is expected over the sensorimotor channels while a
+motor imagery is held, and positive for a synchronization.
+
+lift_score is the desynchronization averaged over the channels and bands
+closest to the motor cortex, sign flipped; it is a cheap second opinion to a
+'lift' from the com stream.
+"""
+
+import time
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+
+# EPOC has no central electrodes, FC5/FC6 are the closest to the motor cortex
+MOTOR_CHANNELS = ['FC5', 'FC6', 'F3', 'F4']
+MOTOR_BANDS = ['alpha', 'betaL', 'betaH']
+
+
+class RunningMean():
+    """
+    Mean of the last `capacity` rows, updated in O(1) per row with a running sum
+
+    The sum is recomputed from the buffer once per `capacity` rows, so rounding
+    errors of the additions and subtractions do not accumulate.
+    """
+    def __init__(self, capacity, width):
+        self.capacity = int(capacity)
+        self._rows = np.zeros((self.capacity, width))
+        self._sum = np.zeros(width)
+        self._next = 0
+        self.count = 0
+
+    def push(self, row):
+        if self.count == self.capacity:
+            self._sum -= self._rows[self._next]
+        else:
+            self.count += 1
+        self._rows[self._next] = row
+        self._sum += row
+        self._next += 1
+        if self._next == self.capacity:
+            self._next = 0
+            self._sum = self._rows.sum(axis=0)
+
+    def mean(self):
+        return self._sum / max(self.count, 1)
+
+    def clear(self):
+        self._sum[:] = 0.0
+        self._next = 0
+        self.count = 0
+
+
+class ErdEngine(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to compute the relative band power change of every channel against a neutral reference
+
+    Attributes
+    ----------
+    channels, bands : list
+        names of the rows and columns of data['erd']
+    settle : float
+        seconds of continuous neutral com before pow samples enter the reference
+    min_reference : int
+        pow samples in the reference before anything is emitted
+    latest : dict or None
+        the last emitted data
+
+    Methods
+    -------
+    push(t, powers, neutral):
+        To feed one pow sample of channels x bands values
+    lift_score():
+        To get the desynchronization over the motor channels, positive for a lift
+    confirms_lift(min_score):
+        To tell whether the pow stream supports a 'lift' from the com stream
+    reset_reference():
+        To forget the neutral reference, after moving the headset for example
+    """
+    _events_ = ['new_erd_data']
+
+    def __init__(self, cortex_client=None, reference_seconds=30.0, smooth_seconds=1.0, pow_rate=8.0,
+                 settle=1.0, min_reference=None, motor_channels=None, motor_bands=None,
+                 subscribe=('pow',)):
+        self.channels = list(cortex.EEG_CHANNELS)
+        self.bands = list(cortex.POW_BANDS)
+        self.settle = settle
+        self.subscribe = list(subscribe)
+        width = len(self.channels) * len(self.bands)
+        self._reference = RunningMean(max(1, round(reference_seconds * pow_rate)), width)
+        self._current = RunningMean(max(1, round(smooth_seconds * pow_rate)), width)
+        self.min_reference = min_reference if min_reference is not None else max(1, round(2 * pow_rate))
+        self._motor_channels = motor_channels or MOTOR_CHANNELS
+        self._motor_bands = motor_bands or MOTOR_BANDS
+        self._set_order(None)
+        self._action = None
+        self._neutral_since = None
+        self.latest = None
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_data_labels=self.on_new_data_labels)
+        cortex_client.bind(new_pow_data=self.on_new_pow_data)
+        cortex_client.bind(new_com_data=self.on_new_com_data)
+
+    def _set_order(self, labels):
+        # pow labels are 'AF3/theta', ...; order maps them to channel-major (channels, bands)
+        if labels is None:
+            self._order = None
+        else:
+            position = {label: i for i, label in enumerate(labels)}
+            self._order = np.array([position['{0}/{1}'.format(ch, band)]
+                                    for ch in self.channels for band in self.bands])
+        motor = np.zeros((len(self.channels), len(self.bands)), dtype=bool)
+        for ch in self._motor_channels:
+            for band in self._motor_bands:
+                motor[self.channels.index(ch), self.bands.index(band)] = True
+        self._motor = motor.reshape(-1)
+
+    def push(self, t, powers, neutral):
+        """
+        Parameters
+        ----------
+        t : float
+            sample time
+        powers : array-like
+            channels x bands power in the order of the pow stream labels
+        neutral : bool
+            whether the sample belongs to a settled neutral period
+
+        Returns
+        -------
+        dict or None
+            the emitted data, None while the reference is too short
+        """
+        row = np.asarray(powers, dtype=np.float64).reshape(-1)
+        if self._order is not None:
+            row = row[self._order]
+        self._current.push(row)
+        if neutral:
+            self._reference.push(row)
+        if self._reference.count < self.min_reference:
+            return None
+        reference = self._reference.mean()
+        erd = (self._current.mean() - reference) / np.maximum(reference, 1e-12)
+        self.latest = {'time': t, 'erd': erd.reshape(len(self.channels), len(self.bands)),
+                       'channels': self.channels, 'bands': self.bands,
+                       'lift_score': -float(erd[self._motor].mean()),
+                       'reference_count': self._reference.count}
+        self.emit('new_erd_data', data=self.latest)
+        return self.latest
+
+    def lift_score(self):
+        return None if self.latest is None else self.latest['lift_score']
+
+    def confirms_lift(self, min_score=0.1):
+        """
+        Returns
+        -------
+        bool or None
+            None while there is no reference yet, so callers can fall back to com alone
+        """
+        score = self.lift_score()
+        return None if score is None else score >= min_score
+
+    def reset_reference(self):
+        self._reference.clear()
+        self.latest = None
+
+    # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['streamName'] == 'pow':
+            self._set_order(data['labels'])
+
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['action'] == 'neutral':
+            if self._action != 'neutral':
+                self._neutral_since = data['time']
+        else:
+            self._neutral_since = None
+        self._action = data['action']
+
+    def on_new_pow_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        t = data['time']
+        neutral = self._neutral_since is not None and t - self._neutral_since >= self.settle
+        self.push(t, data['pow'], neutral)
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - erd = ErdEngine(cortex) subscribes 'pow' when the session is created and follows the com stream,
+#     so 'com' must be subscribed too (live.py does it after loading the profile)
+#   - erd.confirms_lift() is True when the motor channels desynchronize against the neutral reference,
+#     None until 2 s of settled neutral pow data have been seen
+#   - python live.py --erd prints this second opinion for every lift
+#   - python erd.py benchmarks the cost per pow sample
+#
+# -----------------------------------------------------------
+
+def main():
+    pow_rate = 8.0
+    seconds = 600
+    n = int(pow_rate * seconds)
+    rng = np.random.default_rng(0)
+    engine = ErdEngine(pow_rate=pow_rate)
+    motor = engine._motor.reshape(len(engine.channels), len(engine.bands))
+    powers = rng.gamma(20.0, 0.5, size=(n, len(engine.channels), len(engine.bands)))
+    # alternate 10 s of neutral and 10 s of lift with a 30% motor desynchronization
+    lift = (np.arange(n) // int(10 * pow_rate)) % 2 == 1
+    powers[lift] *= np.where(motor, 0.7, 1.0)
+
+    scores = {True: [], False: []}
+    start = time.perf_counter()
+    for i in range(n):
+        data = engine.push(i / pow_rate, powers[i], not lift[i])
+        if data is not None and i % int(10 * pow_rate) >= pow_rate:
+            scores[bool(lift[i])].append(data['lift_score'])
+    elapsed = time.perf_counter() - start
+
+    print('{0} pow samples of {1} values: {2:.1f} us per sample ({3:.4f}% of one core at {4:.0f} Hz)'.format(
+        n, powers[0].size, elapsed / n * 1e6, elapsed / seconds * 100, pow_rate))
+    print('lift score: neutral {0:.3f}, lift {1:.3f}'.format(np.mean(scores[False]), np.mean(scores[True])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Loader for the CSV files written by Cortex.export_record(..., export_format='CSV')
+
+The CSV is parsed in chunks into typed NumPy columns and written once as a
+columnar cache next to it (one .npy per column plus meta.json, keyed by the CSV
+size and mtime). Each chunk is appended to the column files as soon as it is
+parsed, so building the cache holds one chunk in memory, not the whole file.
+The EEG channels are also stored together as one contiguous (rows, channels)
+.npy. A column that turns out to hold text keeps its cells as written in the
+CSV: the numeric rows before its first text chunk are read again from the file
+rather than formatted back from their floats. Later loads memory-map the
+cache, so they take milliseconds and do not copy the data.
+"""
+
+import csv
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+import cortex
+
+CACHE_SUFFIX = '.npcache'
+CACHE_VERSION = 3
+DEFAULT_CHUNK_ROWS = 65536
+
+
+def _parse_metadata(line):
+    # "title:foo, start timestamp:1590736942.8, ..., labels:Timestamp EEG.AF3 ..." -> dict
+    metadata = {}
+    for item in line.split(','):
+        if ':' in item:
+            key, value = item.split(':', 1)
+            metadata[key.strip()] = value.strip()
+    return metadata
+
+
+def _is_numeric_row(row):
+    try:
+        float(row[0])
+        return True
+    except (ValueError, IndexError):
+        return False
+
+
+def read_header(f):
+    """
+    To read the metadata and the column names of an Emotiv CSV export.
+    V2 exports have a metadata line and a header line, V1 exports list the columns in the
+    metadata 'labels' entry, and plain CSV files start with the header line.
+
+    Returns
+    -------
+    tuple
+        (metadata dict, column names, first data row or None)
+    """
+    reader = csv.reader(f)
+    first = next(reader, None)
+    if first is None:
+        raise ValueError('Empty CSV file.')
+    metadata = {}
+    if any(':' in cell for cell in first) and not _is_numeric_row(first):
+        metadata = _parse_metadata(','.join(first))
+        second = next(reader, None)
+        if second is not None and _is_numeric_row(second) and 'labels' in metadata:
+            return metadata, metadata['labels'].split(), second
+        if second is None:
+            raise ValueError('CSV file has no header line.')
+        return metadata, [name.strip() for name in second], None
+    return metadata, [name.strip() for name in first], None
+
+
+def _convert_chunk(rows, n_cols):
+    # list of string rows -> (list of column arrays, float64 where possible, and the text table)
+    for i, row in enumerate(rows):
+        if len(row) != n_cols:
+            rows[i] = (row + [''] * n_cols)[:n_cols]
+    table = np.array(rows, dtype=str)
+    columns = []
+    for col in range(n_cols):
+        column = table[:, col]
+        try:
+            columns.append(np.where(column == '', 'nan', column).astype(np.float64))
+        except ValueError:
+            columns.append(column)
+    return columns, table
+
+
+def iter_chunks(path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    To parse an export chunk by chunk without loading the whole file
+
+    Returns
+    -------
+    generator
+        yields (column names, list of column arrays) per chunk
+    """
+    for names, columns, _ in _iter_tables(path, chunk_rows):
+        yield names, columns
+
+
+def _iter_rows(f):
+    # the data rows of an open export, after its header
+    _, _, pending = read_header(f)
+    if pending is not None:
+        yield pending
+    for row in csv.reader(f):
+        if row:
+            yield row
+
+
+def _iter_tables(path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # iter_chunks, with the text table of each chunk
+    with open(path, 'r', newline='') as f:
+        metadata, names, pending = read_header(f)
+        reader = csv.reader(f)
+        rows = [pending] if pending is not None else []
+        for row in reader:
+            if not row:
+                continue
+            rows.append(row)
+            if len(rows) >= chunk_rows:
+                yield (names,) + _convert_chunk(rows, len(names))
+                rows = []
+        if rows:
+            yield (names,) + _convert_chunk(rows, len(names))
+
+
+def _iter_text(path, col, stop, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # the cells of one column as written in the export, rows [0, stop), chunk by chunk
+    with open(path, 'r', newline='') as f:
+        cells = []
+        for i, row in enumerate(_iter_rows(f)):
+            if i >= stop:
+                break
+            cells.append(row[col] if col < len(row) else '')
+            if len(cells) >= chunk_rows:
+                yield np.array(cells, dtype=str)
+                cells = []
+        if cells:
+            yield np.array(cells, dtype=str)
+
+
+def _cache_key(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'version': CACHE_VERSION}
+
+
+def cache_dir(path):
+    return path + CACHE_SUFFIX
+
+
+def _cache_is_fresh(path):
+    meta_path = os.path.join(cache_dir(path), 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta.get('key') != _cache_key(path):
+        return None
+    return meta
+
+
+def _eeg_columns(names):
+    # (channel names, column indices) of the EPOC channels present as EEG.<name> or <name>
+    index = {name: i for i, name in enumerate(names)}
+    channels = [ch for ch in cortex.EEG_CHANNELS if 'EEG.' + ch in index or ch in index]
+    return channels, [index['EEG.' + ch] if 'EEG.' + ch in index else index[ch] for ch in channels]
+
+
+def _write_npy(raw_path, npy_path, dtype, shape):
+    # raw C-ordered data -> .npy file, copied block by block
+    with open(npy_path, 'wb') as out:
+        np.lib.format.write_array_header_1_0(out, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                   'fortran_order': False, 'shape': shape})
+        with open(raw_path, 'rb') as raw:
+            shutil.copyfileobj(raw, out, 1 << 22)
+    os.remove(raw_path)
+
+
+class _ColumnWriter():
+    # appends the chunks of one column to a raw float64 file; a column with text switches to one .npy of the
+    # cells per chunk, joined at the end at the widest text width
+    def __init__(self, folder, col, source):
+        self.folder = folder
+        self.col = col
+        self.source = source
+        self.raw_path = os.path.join(folder, '{0}.raw'.format(col))
+        self.raw = open(self.raw_path, 'wb')
+        self.rows = 0
+        # ('raw', start, stop) or ('text', .npy path) segments, in row order
+        self.segments = []
+
+    def append(self, column, text):
+        if column.dtype.kind == 'f' and not any(kind == 'text' for kind, *_ in self.segments):
+            self.raw.write(np.ascontiguousarray(column, dtype=np.float64).tobytes())
+            if self.segments and self.segments[-1][0] == 'raw':
+                self.segments[-1] = ('raw', self.segments[-1][1], self.rows + len(column))
+            else:
+                self.segments.append(('raw', self.rows, self.rows + len(column)))
+        else:
+            part = os.path.join(self.folder, '{0}.part{1}.npy'.format(self.col, len(self.segments)))
+            np.save(part, text)
+            self.segments.append(('text', part))
+        self.rows += len(column)
+
+    def _parts(self):
+        for segment in self.segments:
+            if segment[0] == 'raw':
+                # numbers only come before the first text chunk: their cells are read again as written
+                for text in _iter_text(self.source, self.col, segment[2]):
+                    yield text
+            else:
+                yield np.load(segment[1])
+
+    def finish(self):
+        """
+        Returns
+        -------
+        str
+            dtype string of the column written as <col>.npy
+        """
+        self.raw.close()
+        npy_path = os.path.join(self.folder, '{0}.npy'.format(self.col))
+        if not any(kind == 'text' for kind, *_ in self.segments):
+            _write_npy(self.raw_path, npy_path, np.float64, (self.rows,))
+            return np.dtype(np.float64).str
+        width = max([1] + [part.dtype.itemsize // 4 for part in self._parts()])
+        out = np.lib.format.open_memmap(npy_path, mode='w+', dtype='<U{0}'.format(width), shape=(self.rows,))
+        offset = 0
+        for part in self._parts():
+            out[offset:offset + len(part)] = part
+            offset += len(part)
+        out.flush()
+        del out
+        for segment in self.segments:
+            if segment[0] == 'text':
+                os.remove(segment[1])
+        os.remove(self.raw_path)
+        return np.dtype('<U{0}'.format(width)).str
+
+
+def build_cache(path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    To parse an export and write its columnar cache, unless a fresh cache exists.
+    Chunks are written as they are parsed, the memory used is that of one chunk.
+
+    Parameters
+    ----------
+    path : str, required
+        CSV export path
+    chunk_rows : int, optional
+        rows parsed per chunk
+
+    Returns
+    -------
+    dict
+        the cache metadata: key, rows, columns, dtypes, the EEG channels of eeg.npy and source metadata
+    """
+    meta = _cache_is_fresh(path)
+    if meta is not None:
+        return meta
+
+    key = _cache_key(path)
+    with open(path, 'r', newline='') as f:
+        metadata, names, _ = read_header(f)
+
+    target = cache_dir(path)
+    tmp_dir = target + '.tmp{0}'.format(os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    writers = [_ColumnWriter(tmp_dir, col, path) for col in range(len(names))]
+    channels, eeg_cols = _eeg_columns(names)
+    eeg_raw_path = os.path.join(tmp_dir, 'eeg.raw')
+    try:
+        with open(eeg_raw_path, 'wb') as eeg_raw:
+            for _, columns, table in _iter_tables(path, chunk_rows):
+                for writer, column in zip(writers, columns):
+                    writer.append(column, table[:, writer.col])
+                if channels and all(columns[i].dtype.kind == 'f' for i in eeg_cols):
+                    eeg_raw.write(np.column_stack([columns[i] for i in eeg_cols]).tobytes())
+                else:
+                    channels = []
+        dtypes = [writer.finish() for writer in writers]
+    except BaseException:
+        for writer in writers:
+            writer.raw.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    rows = writers[0].rows if writers else 0
+    if channels:
+        _write_npy(eeg_raw_path, os.path.join(tmp_dir, 'eeg.npy'), np.float64, (rows, len(channels)))
+    else:
+        os.remove(eeg_raw_path)
+
+    meta = {'key': key, 'rows': rows, 'columns': names, 'dtypes': dtypes, 'eeg_channels': channels,
+            'metadata': metadata}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.replace(tmp_dir, target)
+    return meta
+
+
+class EmotivExport():
+    """
+    A loaded Emotiv CSV export. Columns are memory-mapped from the cache.
+
+    Attributes
+    ----------
+    path : str
+        CSV export path
+    metadata : dict
+        entries of the export metadata line, such as 'title' or 'start timestamp'
+    columns : list
+        column names in file order
+
+    Methods
+    -------
+    column(name):
+        To get a column array, also available as export[name]
+    stack(names):
+        To stack several columns into a (n_rows, n_names) array, an in-memory copy
+    eeg():
+        To get (times, values, channel names) of the EEG channels, memory-mapped from eeg.npy
+    """
+    def __init__(self, path, meta):
+        self.path = path
+        self.metadata = meta['metadata']
+        self.columns = meta['columns']
+        self.rows = meta['rows']
+        self.eeg_channels = meta.get('eeg_channels', [])
+        self._eeg = None
+        self._index = {name: i for i, name in enumerate(self.columns)}
+        self._arrays = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def column(self, name):
+        if name not in self._arrays:
+            if name not in self._index:
+                raise KeyError('No column {0} in {1}'.format(name, self.path))
+            file_path = os.path.join(cache_dir(self.path), '{0}.npy'.format(self._index[name]))
+            self._arrays[name] = np.load(file_path, mmap_mode='r')
+        return self._arrays[name]
+
+    def stack(self, names):
+        # the columns are separate files, so this copies them into memory
+        return np.column_stack([self.column(name) for name in names])
+
+    def eeg(self, channels=None):
+        """
+        Parameters
+        ----------
+        channels : list, optional
+            channel names without prefix. Default is every EPOC channel present as EEG.<name>
+
+        Returns
+        -------
+        tuple
+            (times, values of shape (n_rows, n_channels), channel names). The values are memory-mapped
+            when channels is None or the channels of the cache, and an in-memory copy otherwise
+        """
+        if channels is None or list(channels) == self.eeg_channels:
+            if self.eeg_channels:
+                if self._eeg is None:
+                    self._eeg = np.load(os.path.join(cache_dir(self.path), 'eeg.npy'), mmap_mode='r')
+                return self.column(self._time_column()), self._eeg, list(self.eeg_channels)
+        if channels is None:
+            channels = [ch for ch in cortex.EEG_CHANNELS if 'EEG.' + ch in self._index or ch in self._index]
+        names = ['EEG.' + ch if 'EEG.' + ch in self._index else ch for ch in channels]
+        return self.column(self._time_column()), self.stack(names), list(channels)
+
+    def _time_column(self):
+        for name in ('Timestamp', 'OriginalTimestamp', 'TIMESTAMP', 'Time'):
+            if name in self._index:
+                return name
+        return self.columns[0]
+
+
+def load_export(path, use_cache=True, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    To load an Emotiv CSV export, building its cache on first use
+
+    Parameters
+    ----------
+    path : str, required
+        CSV export path
+    use_cache : bool, optional
+        with False the cache is rebuilt even if it is fresh
+    chunk_rows : int, optional
+        rows parsed per chunk when the cache is built
+
+    Returns
+    -------
+    EmotivExport
+    """
+    if not use_cache and os.path.exists(cache_dir(path)):
+        shutil.rmtree(cache_dir(path))
+    return EmotivExport(path, build_cache(path, chunk_rows))
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - export = load_export('exports/my_record.csv')
+#   - times, eeg, channels = export.eeg()
+#   - export['EEG.AF3'], export.metadata['title'], ...
+#   - python export_loader.py exports/*.csv prints cold and warm load times
+#
+# -----------------------------------------------------------
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: python export_loader.py export.csv [export.csv ...]')
+        return
+    for path in sys.argv[1:]:
+        start = time.perf_counter()
+        export = load_export(path)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        export = load_export(path)
+        export.eeg()
+        warm = time.perf_counter() - start
+        print('{0}: {1} rows x {2} columns, first load {3:.3f} s, cached load {4:.4f} s'.format(
+            path, len(export), len(export.columns), first, warm))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Content-addressed on-disk cache of derived features
+
+A cached stage is a function of arrays and parameters, for example a band-pass
+filter of (times, eeg) with (low, high, order). Its results are stored under a
+key hashing the stage name and version, the fingerprints of the input arrays
+and the parameters, as .npy files loaded back memory-mapped. Results of cached
+stages remember their key, so chaining stages does not hash the data again, and
+a parameter sweep only recomputes the stages whose inputs or parameters changed.
+The least recently used entries are evicted when the cache exceeds its size
+budget.
+
+    cache = FeatureCache('.feature_cache', max_bytes=2e9)
+
+    @cache.stage('bandpass', version=1)
+    def bandpass(eeg, rate, low, high):
+        ...
+        return filtered
+
+    filtered = bandpass(eeg, rate=128, low=8.0, high=30.0)   # computed, then served from disk
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import time
+import weakref
+
+import numpy as np
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# returned by get on a miss inside the stages, so that None is a result like any other
+_MISSING = object()
+
+
+def _hash_array(array):
+    array = np.ascontiguousarray(array)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(array.dtype.str.encode('ascii'))
+    h.update(repr(array.shape).encode('ascii'))
+    h.update(memoryview(array.reshape(-1)).cast('B'))
+    return h.hexdigest()
+
+
+def file_fingerprint(path):
+    """Fingerprint of a file by path, size and modification time, without reading it"""
+    st = os.stat(path)
+    return 'file:{0}:{1}:{2}'.format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def _read_only(array):
+    # an array that cannot change in place: neither it nor any array it is a view of is writeable
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return True
+
+
+def _canonical(value):
+    # parameters -> json-compatible values with a stable representation
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, float):
+        return repr(value)
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    raise TypeError('Cannot use {0} as a cached stage parameter.'.format(type(value).__name__))
+
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class FeatureCache():
+    """
+    A content-addressed cache of arrays on disk with a least-recently-used size budget
+
+    Attributes
+    ----------
+    folder : str
+        cache folder
+    max_bytes : int
+        size budget; the least recently used entries are evicted above it
+    hits, misses : int
+        counters of this instance
+
+    Methods
+    -------
+    stage(name, version):
+        Decorator making a function a cached stage
+    fingerprint(value):
+        To get the fingerprint of an array argument
+    get(key) / put(key, result, meta):
+        Low level access by key
+    stats():
+        To get the number of entries and bytes on disk
+    clear():
+        To remove every entry
+    """
+    def __init__(self, folder='.feature_cache', max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._known = {}
+        self._size = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    # keys
+    def _remember(self, array, fingerprint):
+        # id -> (weak reference, fingerprint); the weak reference tells when the id is reused.
+        # Only read-only arrays, such as the memory-mapped results, are remembered: a writeable one
+        # can be changed in place and is hashed again every time
+        if not _read_only(array):
+            return
+        try:
+            ref = weakref.ref(array, lambda _, key=id(array): self._known.pop(key, None))
+        except TypeError:
+            return
+        self._known[id(array)] = (ref, fingerprint)
+
+    def fingerprint(self, value):
+        known = self._known.get(id(value))
+        if known is not None and known[0]() is value:
+            return known[1]
+        if isinstance(value, np.ndarray):
+            fingerprint = _hash_array(value)
+            self._remember(value, fingerprint)
+            return fingerprint
+        raise TypeError('Cannot fingerprint {0}.'.format(type(value).__name__))
+
+    def make_key(self, name, version, arrays, params):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(json.dumps([CACHE_VERSION, name, version, [self.fingerprint(a) for a in arrays],
+                             _canonical(params)], sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    # storage
+    def get(self, key, default=None):
+        """
+        Returns
+        -------
+        object
+            the stored result with memory-mapped arrays, default on a miss
+        """
+        entry = self._entry(key)
+        meta_path = os.path.join(entry, 'meta.json')
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            arrays = [np.load(os.path.join(entry, '{0}.npy'.format(i)), mmap_mode='r')
+                      for i in range(meta['arrays'])]
+            # the modification time of meta.json is the last use of the entry
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return default
+        for i, array in enumerate(arrays):
+            self._remember(array, '{0}/{1}'.format(key, i))
+        return self._unpack(meta, arrays)
+
+    def put(self, key, result, meta=None):
+        """
+        To store a result: an array, a tuple or list of arrays, a dict of arrays, or json-compatible values
+
+        Returns
+        -------
+        object
+            the result as it will be served from the cache
+        """
+        meta = dict(meta or {})
+        arrays, layout = self._pack(result)
+        meta.update({'arrays': len(arrays), 'layout': layout, 'created': time.time()})
+        entry = self._entry(key)
+        tmp_dir = '{0}.tmp{1}'.format(entry, os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        size = 0
+        for i, array in enumerate(arrays):
+            path = os.path.join(tmp_dir, '{0}.npy'.format(i))
+            np.save(path, array)
+            size += os.path.getsize(path)
+        meta['bytes'] = size
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.replace(tmp_dir, entry)
+        except OSError:
+            # written by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            if self._size is not None:
+                self._size += size
+            self._evict(keep=key)
+        stored = self.get(key, _MISSING)
+        return result if stored is _MISSING else stored
+
+    def _pack(self, result):
+        if isinstance(result, np.ndarray):
+            return [result], 'array'
+        if isinstance(result, (tuple, list)) and all(isinstance(r, np.ndarray) for r in result):
+            return list(result), 'tuple' if isinstance(result, tuple) else 'list'
+        if isinstance(result, dict) and all(isinstance(r, np.ndarray) for r in result.values()):
+            names = list(result)
+            return [result[name] for name in names], {'dict': names}
+        return [], {'json': _to_json(result)}
+
+    def _unpack(self, meta, arrays):
+        layout = meta['layout']
+        if layout == 'array':
+            return arrays[0]
+        if layout == 'tuple':
+            return tuple(arrays)
+        if layout == 'list':
+            return arrays
+        if 'dict' in layout:
+            return dict(zip(layout['dict'], arrays))
+        return layout['json']
+
+    def _entries(self):
+        # (last use, bytes, key) of every entry
+        entries = []
+        for prefix in os.scandir(self.folder):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if '.tmp' in entry.name:
+                    continue
+                meta_path = os.path.join(entry.path, 'meta.json')
+                try:
+                    with open(meta_path, 'r') as f:
+                        size = json.load(f)['bytes']
+                    entries.append((os.path.getmtime(meta_path), size, entry.name))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def _evict(self, keep=None):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        if self._size <= self.max_bytes:
+            return
+        # scan only when over budget, then go down to 90% so the next inserts do not scan again
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            self._size -= size
+
+    def stats(self):
+        entries = self._entries()
+        return {'entries': len(entries), 'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        for prefix in os.scandir(self.folder):
+            if prefix.is_dir():
+                shutil.rmtree(prefix.path, ignore_errors=True)
+        self._size = 0
+
+    # pipeline
+    def stage(self, name, version=1):
+        """
+        Decorator making a function a cached stage. Array arguments are fingerprinted,
+        the other arguments must be json-compatible parameters. Bump version when the
+        function changes.
+        """
+        def decorator(fn):
+            signature = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            def cached(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arrays, params = [], {}
+                for arg_name, value in bound.arguments.items():
+                    if isinstance(value, np.ndarray):
+                        arrays.append(value)
+                        params[arg_name] = '<array {0}>'.format(len(arrays) - 1)
+                    else:
+                        params[arg_name] = value
+                key = self.make_key(name, version, arrays, params)
+                result = self.get(key, _MISSING)
+                if result is not _MISSING:
+                    self.hits += 1
+                    return result
+                self.misses += 1
+                result = fn(*args, **kwargs)
+                return self.put(key, result, {'stage': name, 'version': version, 'params': _canonical(params)})
+            cached.uncached = fn
+            return cached
+        return decorator
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Decorate the stages of an analysis with @cache.stage('name', version=1), see the module docstring
+#   - The first run computes and stores every stage, later runs with the same data and parameters
+#     load the results memory-mapped; changing a parameter only recomputes the stages after it
+#   - python feature_cache.py stats [folder] / python feature_cache.py clear [folder]
+#
+# -----------------------------------------------------------
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('stats', 'clear'):
+        print('usage: python feature_cache.py stats|clear [folder]')
+        return
+    cache = FeatureCache(sys.argv[2] if len(sys.argv) > 2 else '.feature_cache')
+    if sys.argv[1] == 'clear':
+        cache.clear()
+    stats = cache.stats()
+    print('{0}: {1} entries, {2:.1f} MB of {3:.1f} MB'.format(
+        cache.folder, stats['entries'], stats['bytes'] / 1e6, stats['max_bytes'] / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 import cortex
 from cortex import Cortex
+import argparse
 import os
+import warnings
 from dotenv import load_dotenv
+from adjust_sensitivity import get_current_threshold, save_threshold
+from decision import DecisionEngine, ThresholdPolicy
 
 class LiveAdvance():
     """
@@ -12,6 +16,12 @@ class LiveAdvance():
     ----------
     c : Cortex
         Cortex communicate with Emotiv Cortex Service
+    decision : DecisionEngine
+        decision.py engine turning com samples into lift decisions
+    premotion : PreMotionController or None
+        premotion.py controller preparing the arm ahead of the lift decisions
+    verbose : bool
+        whether every com sample is printed, off while the dashboard shows them
 
     Methods
     -------
@@ -28,8 +38,28 @@ class LiveAdvance():
     set_sensitivity(profile_name):
         To set the sensitivity of the active mental command actions.
     """
-    def __init__(self, app_client_id, app_client_secret, **kwargs):
-        self.c = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
+    def __init__(self, app_client_id, app_client_secret, cortex=None, **kwargs):
+        # an already constructed Cortex, such as replay.ReplayCortex, can be passed instead
+        if cortex is None:
+            cortex = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
+        self.c = cortex
+        # optional erd.ErdEngine giving a second opinion on lift
+        self.erd = None
+        # optional artifacts.ArtifactDetector suppressing lifts during blinks, clenches and head movements
+        self.artifacts = None
+        # EEG rate the eeg consumers were built for, checked against the headset once the session is created
+        self.eeg_rate = None
+        # lift decisions from the com samples, at the threshold adjust_sensitivity.py saved by default;
+        # with com_stats.ComStats bound to on_new_com_stats the threshold follows its recommendation
+        self.decision = DecisionEngine(policy=ThresholdPolicy(get_current_threshold()))
+        # optional com_stats.ComStats recommending the threshold
+        self.com_stats = None
+        # optional premotion.PreMotionController preparing the arm while the lift power rises
+        self.premotion = None
+        # optional sensitivity_optimizer.SensitivityOptimizer choosing and saving the sensitivity instead of the fixed values
+        self.sensitivity_optimizer = None
+        # per-sample prints, off under the dashboard: formatting them costs more than the dashboard itself
+        self.verbose = True
         self.c.bind(create_session_done=self.on_create_session_done)
         self.c.bind(query_profile_done=self.on_query_profile_done)
         self.c.bind(load_unload_profile_done=self.on_load_unload_profile_done)
@@ -185,6 +215,10 @@ class LiveAdvance():
     # callbacks functions
     def on_create_session_done(self, *args, **kwargs):
         print('on_create_session_done')
+        headset_rate = self.c.headset_settings.get('eegRate')
+        if self.eeg_rate is not None and headset_rate and float(headset_rate) != self.eeg_rate:
+            warnings.warn('The headset streams eeg at {0} Hz but the eeg consumers expect {1:g} Hz, '
+                          'run again with --eeg-rate {0}'.format(headset_rate, self.eeg_rate))
         self.c.query_profile()
 
     def on_query_profile_done(self, *args, **kwargs):
@@ -210,6 +244,9 @@ class LiveAdvance():
 
     def on_save_profile_done (self, *args, **kwargs):
         print('Save profile ' + self.profile_name + " successfully")
+        if self.sensitivity_optimizer is not None and self.sensitivity_optimizer.state != 'idle':
+            # the optimizer subscribed 'com' before its blocks
+            return
         # subscribe mental command data
         stream = ['com']
         self.c.sub_request(stream)
@@ -224,17 +261,61 @@ class LiveAdvance():
              the format such as {'action': 'lift', 'power': 0.85, 'time': 1590736942.8479}
         """
         data = kwargs.get('data')
-        print('Mental Command detected: {}'.format(data))
+        if self.verbose:
+            print('Mental Command detected: {}'.format(data))
+        if self.sensitivity_optimizer is not None and self.sensitivity_optimizer.active:
+            # the samples of the guided blocks are scored by the optimizer, nothing is decided nor prepared
+            return
         
-        # Check if lift command is detected with sufficient power
-        if data.get('action') == 'lift' and data.get('power', 0) > 0.5:
+        # Check if the decision engine takes a lift decision on this sample
+        decision = self.decision.push(data['time'], data.get('action'), data.get('power', 0))
+        ignored = decision is not None and self.artifacts is not None and self.artifacts.is_active(data['time'])
+        if self.premotion is not None:
+            lift_power = data.get('power', 0) if data.get('action') == self.decision.action else 0.0
+            if ignored:
+                self.premotion.cancel(data['time'])
+            self.premotion.push(data['time'], lift_power, decided=decision is not None and not ignored,
+                                threshold=self.decision.threshold)
+        if ignored:
+            print(f"🚫 LIFT with power {data.get('power'):.2f} ignored during an artifact: {', '.join(self.artifacts.sources)}")
+        elif decision is not None:
             print(f"🎯 LIFT command detected with power: {data.get('power'):.2f}")
-            print("This would trigger the grab script in Node-RED")
+            print("{0} decision {1:.0f} ms after the first supporting sample".format(
+                decision['policy'], decision['latency'] * 1000))
+            if self.premotion is None:
+                print("This would trigger the grab script in Node-RED")
+            if self.erd is not None:
+                confirmed = self.erd.confirms_lift()
+                if confirmed is None:
+                    print("ERD: no neutral reference yet")
+                else:
+                    print("ERD: lift score {0:.2f}, {1}".format(
+                        self.erd.lift_score(), 'confirmed' if confirmed else 'not confirmed'))
+        elif not self.verbose:
+            return
         elif data.get('action') == 'neutral':
             print(f"😐 Neutral state - no action")
         else:
             print(f"📊 Other command: {data.get('action')} with power: {data.get('power'):.2f}")
 
+    def on_new_com_stats(self, *args, **kwargs):
+        data = kwargs.get('data')
+        threshold = data.get('threshold')
+        current = self.decision.threshold
+        if threshold is not None and current is not None and abs(threshold - current) >= 0.01:
+            print('Lift threshold {0:.2f} -> {1:.2f} ({2:.2f} false triggers per minute of rest)'.format(
+                current, threshold, data['false_per_minute']))
+            self.decision.set_threshold(threshold)
+
+    def on_premotion(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['command'] == 'prepare':
+            print('Arm prepared {0:.0f}% towards the grab'.format(data['percent']))
+        elif data['command'] == 'cancel':
+            print('Arm pre-motion cancelled')
+        elif data.get('hidden'):
+            print('Grab committed, {0:.0f} ms of travel done ahead'.format(data['hidden'] * 1000))
+
     def on_get_mc_active_action_done(self, *args, **kwargs):
         data = kwargs.get('data')
         print('on_get_mc_active_action_done: {}'.format(data))
@@ -243,6 +324,9 @@ class LiveAdvance():
     def on_mc_action_sensitivity_done(self, *args, **kwargs):
         data = kwargs.get('data')
         print('on_mc_action_sensitivity_done: {}'.format(data))
+        if self.sensitivity_optimizer is not None:
+            # the optimizer sets the sensitivities and saves the profile itself
+            return
         if isinstance(data, list):
             # get sensitivity - for our 2-command system, we need to send 4 values to satisfy the API
             # Set sensitivity for each command (higher = more sensitive, lower = less sensitive)
@@ -293,10 +377,47 @@ class LiveAdvance():
 #    you can run live mode with the trained profile. the data as below:
 #    {'action': 'lift', 'power': 0.85, 'time': 1647525819.0223}
 #    {'action': 'neutral', 'power': 0.0, 'time': 1647525819.1473}
+#    With --viz PORT, EEG, band power, com power and contact quality are shown on http://localhost:PORT/
+#    With --dashboard, a terminal dashboard refreshed 4 times per second replaces the per-sample output, and shows
+#       the depths of the viz, com_stats and premotion buffers when they run
+#    With --local-model model.npz (see mi_classifier.py, experimental), eeg is subscribed and lifts come from the local
+#       classifier, gated by its DEFAULT_LOCAL_POLICY decision policy unless --policy is given
+#    With --artifacts, eeg, mot and fac are subscribed too and lifts during blinks, clenches or head movements are ignored
+#    --eeg-rate 256 is needed with --artifacts or --local-model on headsets streaming eeg at 256 Hz
+#    With --erd, the pow stream is subscribed too and every lift is checked against the motor desynchronization
+#    Lifts are decided once per crossing of adjust_sensitivity.py's threshold; --policy picks another decision.py policy,
+#       such as hysteresis:hold=0.5,refractory=2, vote:n=3,m=5, sprt or the .current_policy.json of policy_sim.py --apply
+#    With --auto-threshold RATE, the lift threshold follows com_stats.ComStats, aiming at RATE false triggers per minute of rest,
+#       measured on the stream the lifts are decided on (the local classifier's with --local-model). The calibrated
+#       threshold only lasts for the session, unless --save-threshold saves it at the end like adjust_sensitivity.py
+#    With --premotion PORT, the arm on that serial port starts closing while the lift power rises and the lift decisions
+#       complete the grab (see premotion.py); --premotion dry only prints the commands. live.py then grabs itself:
+#       disable the Grab Script node of the Node-RED flow, it would open the same port (see CONFIGURATION.md)
+#    With --optimize-sensitivity, guided relax / imagine blocks choose the lift sensitivity before live mode
+#       instead of the fixed values of on_mc_action_sensitivity_done (see sensitivity_optimizer.py)
+#    With --pyramid PATH, the streams received are also stored as min/max/mean pyramids in PATH.pyramid/<stream>,
+#       to browse hours of data later with decimation.load_pyramid
 # 
 # -----------------------------------------------------------
 
 def main():
+    parser = argparse.ArgumentParser(description='Live mental command detection')
+    parser.add_argument('--viz', type=int, metavar='PORT', help='serve a live view in the browser on this port')
+    parser.add_argument('--dashboard', action='store_true', help='show a terminal dashboard instead of printing every sample')
+    parser.add_argument('--local-model', metavar='MODEL', help='experimental: handle lifts from a mi_classifier.py model instead of the Cortex com stream')
+    parser.add_argument('--artifacts', action='store_true', help='ignore lifts during blinks, clenches and head movements')
+    parser.add_argument('--eeg-rate', type=float, default=128.0, help='EEG sample rate of the headset, 128 or 256 Hz, for --artifacts and --local-model')
+    parser.add_argument('--erd', action='store_true', help='check every lift against the band power desynchronization')
+    parser.add_argument('--policy', help='lift decision policy, name[:key=value,...] or a policy json file (see decision.py)')
+    parser.add_argument('--auto-threshold', type=float, metavar='RATE', help='calibrate the lift threshold for RATE false triggers per minute')
+    parser.add_argument('--save-threshold', action='store_true', help="with --auto-threshold, save the last threshold for later runs as adjust_sensitivity.py does")
+    parser.add_argument('--premotion', metavar='PORT', help="prepare the arm on this serial port ahead of the lift decisions, 'dry' to only print the commands")
+    parser.add_argument('--premotion-horizon', type=float, default=0.4, help='seconds ahead the rising lift power is predicted')
+    parser.add_argument('--premotion-percent', type=float, default=30.0, help='share of the grab done ahead, the cost of a wrong guess')
+    parser.add_argument('--optimize-sensitivity', action='store_true', help='tune the lift sensitivity with guided blocks, then save the profile')
+    parser.add_argument('--pyramid', metavar='PATH', help='store min/max/mean pyramids of the received streams in PATH.pyramid for viewing')
+    args = parser.parse_args()
+
     # Load environment variables from .env file
     load_dotenv()
     
@@ -305,10 +426,116 @@ def main():
     your_app_client_secret = os.environ['CLIENT_SECRET']
     
     # Init live advance
-    l = LiveAdvance(your_app_client_id, your_app_client_secret)
+    if args.dashboard:
+        # no request/response dumps: the dashboard captures the output anyway
+        l = LiveAdvance(your_app_client_id, your_app_client_secret,
+                        cortex=Cortex(your_app_client_id, your_app_client_secret, debug_mode=False))
+    else:
+        l = LiveAdvance(your_app_client_id, your_app_client_secret)
+
+    # the eeg consumers below are built for this rate, LiveAdvance warns if the headset streams another one
+    l.eeg_rate = args.eeg_rate
+    detector = None
+    if args.local_model:
+        from decision import parse_policy
+        from mi_classifier import DEFAULT_LOCAL_POLICY, LocalCommandDetector, MotorImageryModel
+        print('--local-model is experimental: about 1 false trigger per minute of rest on synthetic data')
+        # local_com has the shape of new_com_data, so the same handler runs on the local decisions,
+        # through a stricter policy than the Cortex com stream needs (an explicit --policy replaces it)
+        model = MotorImageryModel.load(args.local_model)
+        if model.rate != args.eeg_rate:
+            print('{0} was trained on eeg at {1:g} Hz, not {2:g} Hz'.format(args.local_model, model.rate, args.eeg_rate))
+            return
+        l.c.unbind(l.on_new_com_data)
+        detector = LocalCommandDetector(model, l.c)
+        detector.bind(local_com=l.on_new_com_data)
+        l.decision.set_policy(parse_policy(DEFAULT_LOCAL_POLICY))
+
+    if args.artifacts:
+        from artifacts import ArtifactDetector
+        l.artifacts = ArtifactDetector(l.c, rate=args.eeg_rate)
+
+    if args.erd:
+        from erd import ErdEngine
+        l.erd = ErdEngine(l.c)
+
+    if args.policy:
+        from decision import parse_policy
+        try:
+            l.decision.set_policy(parse_policy(args.policy))
+        except (OSError, KeyError, ValueError) as e:
+            print('Invalid policy {0}: {1}'.format(args.policy, e))
+            return
+
+    if args.auto_threshold is not None:
+        from com_stats import ComStats
+        if detector is not None:
+            # calibrate on the stream the lifts are decided on, the local decisions
+            l.com_stats = ComStats(target_false_per_minute=args.auto_threshold)
+            detector.bind(local_com=l.com_stats.on_new_com_data)
+        else:
+            l.com_stats = ComStats(l.c, target_false_per_minute=args.auto_threshold)
+        l.com_stats.bind(new_com_stats=l.on_new_com_stats)
+
+    if args.premotion:
+        from premotion import ArmLink, PreMotionController
+        link = ArmLink(None if args.premotion == 'dry' else args.premotion)
+        try:
+            link.open()
+        except (ImportError, OSError) as e:
+            print('Cannot open {0}: {1}. Is the Node-RED grab script holding the port?'.format(args.premotion, e))
+            return
+        l.premotion = PreMotionController(link, horizon=args.premotion_horizon, percent=args.premotion_percent)
+        l.premotion.bind(premotion=l.on_premotion)
+
+    viz = None
+    if args.viz is not None:
+        from viz_server import VizServer
+        viz = VizServer(l.c, port=args.viz)
+        viz.start()
+
+    pyramid = None
+    if args.pyramid:
+        from decimation import PyramidRecorder
+        pyramid = PyramidRecorder(args.pyramid)
+        pyramid.bind(l.c)
+
+    dashboard = None
+    if args.dashboard:
+        from dashboard import Dashboard
+        # triggers are the lift decisions, the threshold is read from the engine on every refresh
+        dashboard = Dashboard(l.c, threshold=get_current_threshold(), decision=l.decision)
+        l.verbose = False
+        # depths of the buffers between the callbacks and their consumers
+        if viz is not None:
+            dashboard.watch('viz eeg rows queued', lambda: viz.pending_rows)
+        if l.com_stats is not None:
+            dashboard.watch('rest samples held back', lambda: l.com_stats.baseline.held)
+        if l.premotion is not None:
+            dashboard.watch('arm bytes queued', lambda: l.premotion.link.out_waiting)
+        dashboard.start()
 
     trained_profile_name = 'TRAW spins' # Please set a trained profile name here
-    l.start(trained_profile_name)
+    if args.optimize_sensitivity:
+        from sensitivity_optimizer import SensitivityOptimizer
+        l.sensitivity_optimizer = SensitivityOptimizer(l.c, trained_profile_name,
+                                                       threshold=l.decision.threshold or get_current_threshold())
+    try:
+        l.start(trained_profile_name)
+    finally:
+        if dashboard is not None:
+            dashboard.stop()
+        if viz is not None:
+            viz.stop()
+        if l.premotion is not None:
+            l.premotion.link.close()
+        if pyramid is not None:
+            pyramid.close()
+            print('Stream pyramids saved in {0}'.format(pyramid.folder))
+        if args.save_threshold and l.com_stats is not None and l.decision.threshold is not None:
+            # only on request and once: the calibrated threshold replaces the user's for every later run
+            save_threshold(l.decision.threshold)
+            print('Lift threshold {0:.2f} saved'.format(l.decision.threshold))
 
 if __name__ =='__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+"""
+Local motor imagery classifier: band-pass, CSP, log-variance, LDA
+
+Training is offline, from sessions recorded with replay.SessionRecorder while
+training: trials come from the sys events (MC_Started up to the end of the
+trial, labelled in training order like epochs.sys_trial_events) or from
+injected markers, and are cut into overlapping windows with
+epochs.extract_epochs. The band-pass is applied to the spectrum of each window,
+weighted by the squared magnitude response of the filters.design_bandpass
+Butterworth filter, which gives band-limited covariances directly. Common
+spatial patterns (CSP) are fitted on the trace-normalized covariances, followed
+by a shrinkage LDA on the normalized log band power of the CSP components.
+
+Online, LocalCommandDetector projects every raw EEG sample on the CSP filters
+and keeps the n_filters virtual channels in a ring buffer. Projection and
+band-pass are both linear, so they commute: a decision is one real FFT of the
+last window of the virtual channels and two small products, with no per-sample
+filtering. Decisions are emitted as local_com events shaped like new_com_data,
+so they can drive LiveAdvance.on_new_com_data in place of the Cortex detection.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from pydispatch import Dispatcher
+
+import cortex
+from epochs import extract_epochs, session_events, session_markers, sys_trial_events
+from feature_cache import file_fingerprint
+from filters import design_bandpass, frequency_response
+from ring_buffer import TimedRingBuffer
+
+DEFAULT_ACTIONS = ('neutral', 'lift')
+# decision.py policy gating the local decisions: a window-by-window classifier flickers, so a lift needs
+# a confident output held for 0.75 s. On the synthetic demo this takes the false triggers from about
+# 11 to under 1 per minute of rest, for about 0.9 s more latency
+DEFAULT_LOCAL_POLICY = 'hysteresis:threshold=0.8,hysteresis=0.3,hold=0.75'
+TRIAL_END_EVENTS = ('MC_Succeeded', 'MC_Failed', 'MC_Completed')
+
+
+def band_covariances(windows, weights):
+    """
+    Trace-normalized band-limited covariance of every window
+
+    Parameters
+    ----------
+    windows : array, required
+        shape (n_windows, n_samples, n_channels)
+    weights : array, required
+        weight of every rfft frequency of a window, the squared band-pass response
+
+    Returns
+    -------
+    numpy.ndarray
+        shape (n_windows, n_channels, n_channels)
+    """
+    spectrum = np.fft.rfft(windows, axis=1)
+    cov = np.einsum('nfc,nfd->ncd', spectrum * weights[:, None], spectrum.conj()).real
+    return cov / np.trace(cov, axis1=1, axis2=2)[:, None, None]
+
+
+def shrink_covariance(cov, shrinkage):
+    """
+    To shrink a covariance towards the identity scaled by its mean eigenvalue
+
+    Parameters
+    ----------
+    cov : numpy.ndarray
+        shape (n, n)
+    shrinkage : float
+        weight of the scaled identity, 0 keeps cov unchanged
+
+    Returns
+    -------
+    numpy.ndarray
+        shape (n, n)
+    """
+    n = cov.shape[0]
+    return (1.0 - shrinkage) * cov + shrinkage * np.trace(cov) / n * np.eye(n)
+
+
+def fit_csp(cov_a, cov_b, n_filters=6, shrinkage=0.05):
+    """
+    Common spatial patterns of two classes, without scipy: whiten the composite
+    covariance, then diagonalize class a in the whitened space.
+
+    Parameters
+    ----------
+    cov_a, cov_b : array, required
+        window covariances of each class, shape (n, channels, channels)
+    n_filters : int, optional
+        filters kept, half from each end of the spectrum
+
+    Returns
+    -------
+    numpy.ndarray
+        spatial filters as rows, shape (n_filters, channels)
+    """
+    ca = shrink_covariance(cov_a.mean(axis=0), shrinkage)
+    cb = shrink_covariance(cov_b.mean(axis=0), shrinkage)
+    evals, evecs = np.linalg.eigh(ca + cb)
+    whitening = evecs / np.sqrt(evals)
+    ratios, rotation = np.linalg.eigh(whitening.T @ ca @ whitening)
+    filters = (whitening @ rotation).T
+    half = n_filters // 2
+    pick = list(range(half)) + list(range(len(ratios) - (n_filters - half), len(ratios)))
+    return filters[pick]
+
+
+def log_band_power(components, weights):
+    """Normalized log band power features of (..., n_samples, n_filters) components"""
+    spectrum = np.fft.rfft(components, axis=-2)
+    power = np.einsum('f,...fc->...c', weights, spectrum.real ** 2 + spectrum.imag ** 2)
+    return np.log(power / power.sum(axis=-1, keepdims=True))
+
+
+def fit_lda(features, y, shrinkage=0.1):
+    """
+    Returns
+    -------
+    tuple
+        (weights, bias) such that features @ weights + bias > 0 predicts class 1
+    """
+    mu0 = features[y == 0].mean(axis=0)
+    mu1 = features[y == 1].mean(axis=0)
+    centered = np.concatenate([features[y == 0] - mu0, features[y == 1] - mu1])
+    cov = shrink_covariance(centered.T @ centered / max(len(centered) - 2, 1), shrinkage)
+    weights = np.linalg.solve(cov, mu1 - mu0)
+    prior = np.log(np.mean(y == 1) / np.mean(y == 0))
+    return weights, -weights @ (mu0 + mu1) / 2.0 + prior
+
+
+class MotorImageryModel():
+    """
+    A trained band-pass + CSP + LDA pipeline
+
+    Attributes
+    ----------
+    rate : float
+        EEG sample rate
+    band : tuple
+        band-pass edges in Hz
+    order : int
+        band-pass Butterworth order
+    window : float
+        seconds of EEG per decision
+    actions : list
+        [rest action, imagery action], such as ['neutral', 'lift']
+    filters : numpy.ndarray
+        CSP filters, shape (n_filters, channels)
+    weights, bias :
+        LDA on the log-variance features
+    stats : dict or None
+        LDA sufficient statistics of the training features per action, {'count', 'sum', 'outer'},
+        which adaptive.AdaptiveLDA starts from
+
+    Methods
+    -------
+    fit(windows, labels):
+        To fit CSP and LDA on raw EEG windows of window_samples samples
+    predict_proba(windows):
+        To get the probability of the imagery action for raw EEG windows
+    save(path) / load(path):
+        To store the model as .npz
+    """
+    def __init__(self, rate=128.0, band=(8.0, 30.0), order=4, window=1.0, actions=DEFAULT_ACTIONS,
+                 n_filters=6, shrinkage=0.1):
+        self.rate = float(rate)
+        self.band = tuple(band)
+        self.order = order
+        self.window = window
+        self.actions = list(actions)
+        self.n_filters = n_filters
+        self.shrinkage = shrinkage
+        self.filters = None
+        self.weights = None
+        self.bias = 0.0
+        self.stats = None
+
+    @property
+    def window_samples(self):
+        return int(round(self.window * self.rate))
+
+    def spectral_weights(self):
+        # squared response of the Butterworth band-pass at the rfft frequencies of a window, no DC
+        freqs = np.fft.rfftfreq(self.window_samples, 1.0 / self.rate)
+        weights = np.abs(frequency_response(design_bandpass(self.band[0], self.band[1], self.rate, self.order),
+                                            freqs, self.rate)) ** 2
+        weights[0] = 0.0
+        return weights
+
+    def fit(self, windows, labels):
+        y = (np.asarray(labels) == self.actions[1]).astype(np.int64)
+        if y.min() == y.max():
+            raise ValueError('Training needs windows of both {0} and {1}.'.format(*self.actions))
+        cov = band_covariances(windows, self.spectral_weights())
+        self.filters = fit_csp(cov[y == 0], cov[y == 1], self.n_filters)
+        features = self.features(windows)
+        self.weights, self.bias = fit_lda(features, y, self.shrinkage)
+        self.stats = {'count': np.array([np.count_nonzero(y == k) for k in (0, 1)], dtype=np.float64),
+                      'sum': np.stack([features[y == k].sum(axis=0) for k in (0, 1)]),
+                      'outer': np.stack([features[y == k].T @ features[y == k] for k in (0, 1)])}
+        return self
+
+    def features(self, windows):
+        return log_band_power(windows @ self.filters.T, self.spectral_weights())
+
+    def decision_function(self, windows):
+        return self.features(windows) @ self.weights + self.bias
+
+    def predict_proba(self, windows):
+        return 1.0 / (1.0 + np.exp(-self.decision_function(windows)))
+
+    def save(self, path):
+        params = {'rate': self.rate, 'band': self.band, 'order': self.order, 'window': self.window,
+                  'actions': self.actions, 'n_filters': self.n_filters, 'shrinkage': self.shrinkage}
+        stats = {} if self.stats is None else {'stats_' + name: value for name, value in self.stats.items()}
+        np.savez(path, filters=self.filters, weights=self.weights, bias=self.bias, params=json.dumps(params), **stats)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            model = cls(**json.loads(str(f['params'])))
+            model.filters = f['filters']
+            model.weights = f['weights']
+            model.bias = float(f['bias'])
+            if 'stats_count' in f:
+                model.stats = {name: f['stats_' + name] for name in ('count', 'sum', 'outer')}
+        return model
+
+
+def trial_bounds(sys_times, sys_events, marker_times=None, marker_labels=None, actions=DEFAULT_ACTIONS,
+                 trial_seconds=8.0):
+    """
+    To get the labelled trials from the sys events, or from the markers when marker_times is given
+
+    Returns
+    -------
+    tuple
+        (onsets, ends, labels)
+    """
+    if marker_times is not None:
+        keep = np.isin(marker_labels, actions)
+        onsets, labels = marker_times[keep], marker_labels[keep]
+        ends = np.minimum(onsets + trial_seconds, np.append(onsets[1:], np.inf))
+    else:
+        onsets, labels = sys_trial_events(sys_times, sys_events, list(actions))
+        end_times = np.array([t for t, e in zip(sys_times, sys_events) if e[1] in TRIAL_END_EVENTS])
+        following = np.searchsorted(end_times, onsets, side='right')
+        ends = np.where(following < len(end_times),
+                        end_times[np.minimum(following, len(end_times) - 1)], onsets + trial_seconds)
+        ends = np.minimum(ends, onsets + trial_seconds)
+    return onsets, ends, labels
+
+
+def trial_intervals(path, actions=DEFAULT_ACTIONS, markers=False, trial_seconds=8.0, cache=None):
+    """
+    To get the labelled trials of a recorded session
+
+    Parameters
+    ----------
+    markers : bool, optional
+        with True, trials start at the injected markers whose label is one of the actions
+        and last trial_seconds or up to the next marker; otherwise they follow the sys events
+    cache : feature_cache.FeatureCache, optional
+        to parse the session once, see epochs.session_events
+
+    Returns
+    -------
+    tuple
+        (onsets, ends, labels, eeg times, eeg values of the EPOC channels)
+    """
+    sys_times, sys_events, eeg_times, eeg = session_events(path, cache)
+    values = eeg[:, 2:2 + len(cortex.EEG_CHANNELS)]
+    marker_times, marker_labels = session_markers(path) if markers else (None, None)
+    onsets, ends, labels = trial_bounds(sys_times, sys_events, marker_times, marker_labels, actions, trial_seconds)
+    return onsets, ends, labels, eeg_times, values
+
+
+def trial_windows(model, eeg_times, values, onsets, ends, labels, step=0.25, skip=0.5):
+    """
+    To cut the raw windows of labelled trials out of an EEG recording
+
+    Parameters
+    ----------
+    step : float, optional
+        seconds between two windows of a trial
+    skip : float, optional
+        seconds ignored at the start of each trial, while the user reacts to the cue
+
+    Returns
+    -------
+    tuple
+        (windows of shape (n, window_samples, channels), labels, trial index of each window)
+    """
+    starts, window_labels, trials = [], [], []
+    for k, (onset, end, label) in enumerate(zip(onsets, ends, labels)):
+        t = np.arange(onset + skip, end - model.window + 1e-9, step)
+        starts.append(t)
+        window_labels += [label] * len(t)
+        trials += [k] * len(t)
+    starts = np.concatenate(starts) if starts else np.zeros(0)
+    epochs = extract_epochs(eeg_times, values, starts, tmin=0.0, tmax=(model.window_samples - 1) / model.rate,
+                            labels=window_labels, rate=model.rate, baseline=None)
+    kept = np.searchsorted(starts, epochs.event_times)
+    return epochs.data, epochs.labels, np.asarray(trials, dtype=np.int64)[kept]
+
+
+def session_windows(model, path, markers=False, step=0.25, skip=0.5, cache=None):
+    """
+    To cut the raw training windows of a recorded session, see trial_windows
+
+    Parameters
+    ----------
+    cache : feature_cache.FeatureCache, optional
+        with a cache, the windows of a session are cut once for a window length and rate,
+        then loaded memory-mapped
+
+    Returns
+    -------
+    tuple
+        (windows of shape (n, window_samples, channels), labels, trial index of each window)
+    """
+    if cache is not None:
+        windows = cache.stage('mi_classifier.session_windows', version=1)(_session_windows)(
+            os.path.abspath(path), file_fingerprint(path), model.rate, model.window, list(model.actions),
+            markers, step, skip)
+        return windows['windows'], windows['labels'], windows['trials']
+    onsets, ends, labels, eeg_times, values = trial_intervals(path, model.actions, markers)
+    return trial_windows(model, eeg_times, values, onsets, ends, labels, step, skip)
+
+
+def _session_windows(path, fingerprint, rate, window, actions, markers, step, skip):
+    # the cached form of session_windows; the windows only depend on the rate and length of the model
+    model = MotorImageryModel(rate=rate, window=window, actions=actions)
+    windows, labels, trials = session_windows(model, path, markers, step, skip)
+    return {'windows': windows, 'labels': np.asarray(labels, dtype=str), 'trials': trials}
+
+
+def train_from_sessions(paths, folds=5, markers=False, step=0.25, skip=0.5, cache=None, **model_params):
+    """
+    To train a model on recorded sessions, with cross-validation by trial. With a
+    feature_cache.FeatureCache, the windows of the sessions are cut once and reused
+    by later trainings with other bands or shrinkage, see session_windows
+
+    Returns
+    -------
+    tuple
+        (MotorImageryModel fitted on every window, cross-validated window accuracy or None)
+    """
+    model = MotorImageryModel(**model_params)
+    windows, labels, trials = [], [], []
+    offset = 0
+    for path in paths:
+        w, l, k = session_windows(model, path, markers, step, skip, cache)
+        windows.append(w)
+        labels.append(l)
+        trials.append(k + offset)
+        offset += k.max() + 1 if len(k) else 0
+    windows = np.concatenate(windows)
+    labels = np.concatenate(labels)
+    trials = np.concatenate(trials)
+
+    accuracy = None
+    n_trials = len(np.unique(trials))
+    if folds > 1 and n_trials >= folds:
+        correct = 0
+        fold_of_trial = np.arange(n_trials) % folds
+        for fold in range(folds):
+            test = fold_of_trial[trials] == fold
+            fold_model = MotorImageryModel(**model_params).fit(windows[~test], labels[~test])
+            predicted = np.where(fold_model.predict_proba(windows[test]) >= 0.5, model.actions[1], model.actions[0])
+            correct += np.count_nonzero(predicted == labels[test])
+        accuracy = correct / len(labels)
+    return model.fit(windows, labels), accuracy
+
+
+class LocalCommandDetector(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to run a MotorImageryModel on the live EEG and publish its decisions like new_com_data
+
+    Attributes
+    ----------
+    model : MotorImageryModel
+    hop : int
+        EEG samples between two decisions
+    costs : list
+        seconds spent by the last decisions
+
+    Methods
+    -------
+    push_sample(t, row):
+        To feed one EEG sample of the EPOC channels
+    bind_cortex(cortex):
+        To feed the detector from new_eeg_data
+    """
+    _events_ = ['local_com']
+
+    def __init__(self, model, cortex_client=None, hop=16, subscribe=('eeg',), keep_costs=1000):
+        self.model = model
+        self.hop = hop
+        self.subscribe = list(subscribe)
+        self.costs = []
+        self._keep_costs = keep_costs
+        self._n = model.window_samples
+        self._weights = model.spectral_weights()
+        self._buffer = TimedRingBuffer(self._n + hop, len(model.filters))
+        self._since = 0
+        self._eeg_columns = cortex.EegColumns(model.filters.shape[1])
+        self.latest = None
+        self.c = cortex_client
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        self.c = cortex_client
+        cortex_client.bind(create_session_done=self.on_create_session_done)
+        cortex_client.bind(new_data_labels=self.on_new_data_labels)
+        cortex_client.bind(new_eeg_data=self.on_new_eeg_data)
+
+    def push_sample(self, t, row):
+        # projection first: only n_filters virtual channels are buffered
+        self._buffer.append(t, self.model.filters @ np.asarray(row, dtype=np.float64))
+        self._since += 1
+        if self._since < self.hop or self._buffer.count < self._n:
+            return None
+        self._since = 0
+        return self._decide()
+
+    def _decide(self):
+        start = time.perf_counter()
+        times, components = self._buffer.view(self._n)
+        spectrum = np.fft.rfft(components, axis=0)
+        power = self._weights @ (spectrum.real ** 2 + spectrum.imag ** 2)
+        score = np.log(power / power.sum()) @ self.model.weights + self.model.bias
+        p = 1.0 / (1.0 + np.exp(-score))
+        action = self.model.actions[1] if p >= 0.5 else self.model.actions[0]
+        self.latest = {'action': action, 'power': round(float(abs(2.0 * p - 1.0)), 3), 'time': float(times[-1])}
+        self.costs.append(time.perf_counter() - start)
+        if len(self.costs) > self._keep_costs:
+            del self.costs[:-self._keep_costs]
+        self.emit('local_com', data=self.latest)
+        return self.latest
+
+    # callbacks functions
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push_sample(data['time'], self._eeg_columns.select(data['eeg']))
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Record training sessions with replay.SessionRecorder while train.py runs (sys events label the trials)
+#   - python mi_classifier.py train model.npz session1.log session2.log --actions neutral lift
+#     prints the cross-validated accuracy and saves the model
+#   - python mi_classifier.py replay model.npz session.log runs the detector on a recording
+#     and prints the cost per decision
+#   - python live.py --local-model model.npz drives the lift handling from local_com instead of com (experimental),
+#     through the DEFAULT_LOCAL_POLICY decision policy unless --policy is given
+#   - python mi_classifier.py demo trains and scores on synthetic sessions
+#
+# -----------------------------------------------------------
+
+def replay_session(model, path, hop=16):
+    """
+    Returns
+    -------
+    tuple
+        (LocalCommandDetector after the session, list of decisions)
+    """
+    _, _, eeg_times, eeg = session_events(path)
+    detector = LocalCommandDetector(model, hop=hop, keep_costs=len(eeg_times))
+    decisions = []
+    for t, row in zip(eeg_times, eeg[:, 2:2 + model.filters.shape[1]]):
+        decision = detector.push_sample(t, row)
+        if decision is not None:
+            decisions.append(decision)
+    return detector, decisions
+
+
+def _print_costs(detector):
+    costs = np.array(detector.costs) * 1e6
+    print('{0} decisions, cost per decision: median {1:.0f} us, 99th percentile {2:.0f} us, max {3:.0f} us'.format(
+        len(costs), np.median(costs), np.percentile(costs, 99), costs.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local motor imagery classifier')
+    sub = parser.add_subparsers(dest='command')
+    train = sub.add_parser('train', help='train a model on recorded sessions')
+    train.add_argument('model')
+    train.add_argument('sessions', nargs='+')
+    train.add_argument('--actions', nargs=2, default=list(DEFAULT_ACTIONS))
+    train.add_argument('--markers', action='store_true', help='label trials with injected markers')
+    train.add_argument('--band', nargs=2, type=float, default=[8.0, 30.0])
+    train.add_argument('--window', type=float, default=1.0)
+    train.add_argument('--cache', metavar='FOLDER', help='feature cache of the session windows, see feature_cache.py')
+    replay = sub.add_parser('replay', help='run a model on a recorded session')
+    replay.add_argument('model')
+    replay.add_argument('session')
+    sub.add_parser('demo', help='train and score on synthetic sessions')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        start = time.perf_counter()
+        cache = None
+        if args.cache:
+            from feature_cache import FeatureCache
+            cache = FeatureCache(args.cache)
+        model, accuracy = train_from_sessions(args.sessions, markers=args.markers, cache=cache, actions=args.actions,
+                                              band=args.band, window=args.window)
+        print('trained in {0:.2f} s, cross-validated accuracy: {1}'.format(
+            time.perf_counter() - start, 'n/a' if accuracy is None else '{0:.1%}'.format(accuracy)))
+        model.save(args.model)
+    elif args.command == 'replay':
+        detector, decisions = replay_session(MotorImageryModel.load(args.model), args.session)
+        _print_costs(detector)
+        actions = [d['action'] for d in decisions]
+        print(', '.join('{0}: {1}'.format(a, actions.count(a)) for a in sorted(set(actions))))
+    elif args.command == 'demo':
+        import tempfile
+        from decision import DecisionEngine, parse_policy
+        from synthetic import SignalGenerator, score_detections
+        folder = tempfile.mkdtemp()
+        paths = []
+        for seed in (1, 2):
+            session = SignalGenerator(seed=seed, erd_depth=0.6).generate(600, start_time=0.0)
+            paths.append(os.path.join(folder, 'session{0}.log'.format(seed)))
+            session.write_session(paths[-1], streams=('eeg',), sys_events=True)
+        start = time.perf_counter()
+        model, accuracy = train_from_sessions(paths[:1], window=1.0)
+        print('trained on 600 s in {0:.2f} s, cross-validated window accuracy {1:.1%}'.format(
+            time.perf_counter() - start, accuracy))
+        detector, decisions = replay_session(model, paths[1])
+        _print_costs(detector)
+        rest_minutes = (session.eeg_times[-1] - session.eeg_times[0]
+                        - np.sum(session.lift_offsets - session.lift_onsets)) / 60.0
+        # raw: a trigger on every crossing of power 0.5, gated: the decisions of DEFAULT_LOCAL_POLICY
+        for name, spec in (('raw', 'threshold:threshold=0.5'), ('gated', DEFAULT_LOCAL_POLICY)):
+            engine = DecisionEngine(policy=parse_policy(spec))
+            triggers = [d['time'] for d in decisions if engine.push(d['time'], d['action'], d['power'])]
+            score = score_detections(triggers, session.lift_onsets, session.lift_offsets, tolerance=1.0)
+            print('held-out session, {0}: {1} hits, {2} misses, {3} false triggers ({4:.2f} per minute of rest), '
+                  'median latency {5:.2f} s'.format(name, score['hits'], score['misses'], score['false_triggers'],
+                                                    score['false_triggers'] / rest_minutes,
+                                                    np.nanmedian(score['latencies'])))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
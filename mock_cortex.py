@@ -0,0 +1,637 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Emotiv Cortex service
+
+Speaks the JSON-RPC methods cortex.py uses over a plain websocket (or wss with a
+certificate), emits synthetic data streams at configurable rates and plays a
+fault script of warnings, delayed or failing responses, stalls and disconnects.
+Point Cortex at it with Cortex(..., url='ws://localhost:6868').
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import cortex
+from cortex import Cortex
+from ws_server import WebSocketServer, ConnectionClosed
+
+DEFAULT_RATES = {
+    'eeg': 128,
+    'mot': 64,
+    'dev': 2,
+    'pow': 8,
+    'met': 2,
+    'com': 8,
+    'fac': 8,
+}
+
+MOT_COLS = ['COUNTER_MEMS', 'INTERPOLATED_MEMS', 'Q0', 'Q1', 'Q2', 'Q3',
+            'ACCX', 'ACCY', 'ACCZ', 'MAGX', 'MAGY', 'MAGZ']
+MET_COLS = ['eng.isActive', 'eng', 'exc.isActive', 'exc', 'lex', 'str.isActive', 'str',
+            'rel.isActive', 'rel', 'int.isActive', 'int', 'foc.isActive', 'foc']
+
+STREAM_COLS = {
+    'eeg': ['COUNTER', 'INTERPOLATED'] + cortex.EEG_CHANNELS + ['RAW_CQ', 'MARKER_HARDWARE', 'MARKERS'],
+    'mot': MOT_COLS,
+    'dev': ['Battery', 'Signal', cortex.EEG_CHANNELS + ['OVERALL'], 'BatteryPercent'],
+    'pow': ['{0}/{1}'.format(ch, band) for ch in cortex.EEG_CHANNELS for band in cortex.POW_BANDS],
+    'met': MET_COLS,
+    'com': ['act', 'pow'],
+    'fac': ['eyeAct', 'uAct', 'uPow', 'lAct', 'lPow'],
+    'sys': ['data'],
+}
+
+# define JSON-RPC error codes used by the mock
+ERR_METHOD_NOT_FOUND = -32601
+ERR_INVALID_TOKEN = -32014
+ERR_INVALID_PARAMS = -32602
+
+# methods that can be called without a cortexToken
+_PUBLIC_METHODS = ('hasAccessRight', 'requestAccess', 'authorize', 'queryHeadsets',
+                   'controlDevice', 'getCortexInfo')
+
+
+class RandomSource():
+    """
+    Default synthetic data source: plausible random values for every stream.
+    A source is any callable source(stream, t, index) returning the stream row.
+    """
+    def __init__(self, seed=None, lift_probability=0.2):
+        self.rng = random.Random(seed)
+        self.lift_probability = lift_probability
+
+    def __call__(self, stream, t, index):
+        rng = self.rng
+        if stream == 'eeg':
+            values = [round(4200.0 + rng.gauss(0, 20), 6) for _ in cortex.EEG_CHANNELS]
+            return [index % 128, 0] + values + [0, 0, []]
+        if stream == 'mot':
+            return [index % 64, 0, 0.7, 0.0, 0.0, 0.7,
+                    rng.gauss(0, 0.01), rng.gauss(0, 0.01), 1.0 + rng.gauss(0, 0.01),
+                    20.0, -5.0, 40.0]
+        if stream == 'dev':
+            return [4, 1.0, [4] * len(cortex.EEG_CHANNELS) + [100], 90]
+        if stream == 'pow':
+            return [round(abs(rng.gauss(2.0, 1.0)), 6) for _ in STREAM_COLS['pow']]
+        if stream == 'met':
+            return [True, 0.5, True, 0.4, 0.3, True, 0.5, True, 0.4, True, 0.5, True, 0.6]
+        if stream == 'com':
+            if rng.random() < self.lift_probability:
+                return ['lift', round(rng.random(), 3)]
+            return ['neutral', 0.0]
+        if stream == 'fac':
+            return ['neutral', 'neutral', 0.0, 'neutral', 0.0]
+        return []
+
+
+class _RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class _MockSession():
+    # state of one client connection
+    def __init__(self, server, connection):
+        self.server = server
+        self.conn = connection
+        self.token = 'mock-token-' + uuid.uuid4().hex[:8]
+        self.session_id = ''
+        self.headsets = [dict(h) for h in server.headsets]
+        self.profiles = list(server.profiles)
+        self.loaded_profile = None
+        self.sensitivity = [5, 5, 5, 5]
+        self.active_actions = ['neutral', 'lift']
+        self.subscribed = {}
+        self.records = {}
+        self.record_id = None
+        self.streams_paused_until = 0.0
+        self.method_rules = [dict(rule) for rule in server.script if 'method' in rule]
+        self.stopped = threading.Event()
+
+    # ---------------------------------------------------------------- transport
+    def send(self, message):
+        self.conn.send_text(json.dumps(message))
+
+    def send_warning(self, code, message):
+        self.send({'jsonrpc': '2.0', 'warning': {'code': code, 'message': message}})
+
+    def send_sys(self, events):
+        if 'sys' in self.subscribed:
+            self.send({'sid': self.session_id, 'time': time.time(), 'sys': events})
+
+    def run(self):
+        threads = [threading.Thread(target=self._stream_loop, daemon=True),
+                   threading.Thread(target=self._script_loop, daemon=True)]
+        for th in threads:
+            th.start()
+        try:
+            while True:
+                message = self.conn.recv()
+                if message is None:
+                    break
+                self.handle(message)
+        finally:
+            self.stopped.set()
+
+    def later(self, delay, func, *args):
+        timer = threading.Timer(delay, self._guarded, args=(func,) + args)
+        timer.daemon = True
+        timer.start()
+
+    def _guarded(self, func, *args):
+        if self.stopped.is_set():
+            return
+        try:
+            func(*args)
+        except ConnectionClosed:
+            self.stopped.set()
+
+    # ---------------------------------------------------------------- json-rpc
+    def handle(self, message):
+        try:
+            request = json.loads(message)
+        except ValueError:
+            self.send({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'Parse error'}})
+            return
+        self.server.requests_handled += 1
+        req_id = request.get('id')
+        method = request.get('method', '')
+        params = request.get('params', {}) or {}
+
+        delay = 0.0
+        for rule in self.method_rules:
+            if rule['method'] != method or rule.get('times', 1) == 0:
+                continue
+            rule['times'] = rule.get('times', 1) - 1
+            if rule.get('drop'):
+                return
+            delay = rule.get('delay', 0.0)
+            if 'error' in rule:
+                response = {'jsonrpc': '2.0', 'id': req_id, 'error': rule['error']}
+                self.later(delay, self.send, response)
+                return
+            break
+
+        try:
+            handler = getattr(self, 'rpc_' + method, None)
+            if handler is None:
+                raise _RpcError(ERR_METHOD_NOT_FOUND, 'Method not found: ' + method)
+            if method not in _PUBLIC_METHODS and params.get('cortexToken') != self.token:
+                raise _RpcError(ERR_INVALID_TOKEN, 'Invalid Cortex Token.')
+            response = {'jsonrpc': '2.0', 'id': req_id, 'result': handler(params)}
+        except _RpcError as e:
+            response = {'jsonrpc': '2.0', 'id': req_id, 'error': {'code': e.code, 'message': e.message}}
+
+        if delay > 0:
+            self.later(delay, self.send, response)
+        else:
+            self.send(response)
+
+    def rpc_getCortexInfo(self, params):
+        return {'buildNumber': 'mock', 'version': 'mock'}
+
+    def rpc_hasAccessRight(self, params):
+        granted = self.server.access_granted
+        return {'accessGranted': granted,
+                'message': 'The user has granted access right to this application.' if granted
+                           else 'The user has not granted access right to this application.'}
+
+    def rpc_requestAccess(self, params):
+        return {'accessGranted': self.server.access_granted,
+                'message': 'Please approve this application in the mock Cortex service.'}
+
+    def rpc_authorize(self, params):
+        if not params.get('clientId') or not params.get('clientSecret'):
+            raise _RpcError(ERR_INVALID_PARAMS, 'Invalid client id or client secret.')
+        return {'cortexToken': self.token, 'warning': {'code': 6, 'message': 'mock license'}}
+
+    def rpc_queryHeadsets(self, params):
+        return self.headsets
+
+    def _find_headset(self, headset_id):
+        for headset in self.headsets:
+            if headset['id'] == headset_id:
+                return headset
+        raise _RpcError(-32004, 'Headset {0} is unavailable.'.format(headset_id))
+
+    def rpc_controlDevice(self, params):
+        command = params.get('command')
+        if command == 'refresh':
+            return {'command': 'refresh', 'message': 'Refreshing the headset list.'}
+        headset = self._find_headset(params.get('headset'))
+        if command == 'connect':
+            headset['status'] = 'connecting'
+
+            def connected():
+                headset['status'] = 'connected'
+                self.send_warning(cortex.HEADSET_CONNECTED,
+                                  {'headsetId': headset['id'], 'behavior': 'Headset connected.'})
+            self.later(self.server.connect_seconds, connected)
+            return {'command': 'connect', 'message': 'Start connecting to headset ' + headset['id']}
+        if command == 'disconnect':
+            headset['status'] = 'discovered'
+            return {'command': 'disconnect', 'message': 'Disconnect headset ' + headset['id']}
+        raise _RpcError(ERR_INVALID_PARAMS, 'Unknown command ' + str(command))
+
+    def rpc_createSession(self, params):
+        headset = self._find_headset(params.get('headset'))
+        if headset['status'] != 'connected':
+            raise _RpcError(-32152, 'The headset is not connected.')
+        self.session_id = str(uuid.uuid4())
+        return {'id': self.session_id, 'status': 'activated', 'headset': headset,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def rpc_updateSession(self, params):
+        if params.get('status') == 'close':
+            self.subscribed = {}
+        return {'id': self.session_id, 'status': params.get('status')}
+
+    def rpc_subscribe(self, params):
+        success = []
+        failure = []
+        for stream in params.get('streams', []):
+            if stream in STREAM_COLS:
+                self.subscribed.setdefault(stream, 0)
+                success.append({'streamName': stream, 'cols': STREAM_COLS[stream], 'sid': self.session_id})
+            else:
+                failure.append({'streamName': stream, 'code': -32016, 'message': 'Invalid stream name.'})
+        return {'success': success, 'failure': failure}
+
+    def rpc_unsubscribe(self, params):
+        success = []
+        failure = []
+        for stream in params.get('streams', []):
+            if self.subscribed.pop(stream, None) is not None:
+                success.append({'streamName': stream, 'message': 'Unsubscribed successfully'})
+            else:
+                failure.append({'streamName': stream, 'code': -32018, 'message': 'Not subscribed.'})
+        return {'success': success, 'failure': failure}
+
+    def rpc_queryProfile(self, params):
+        return [{'name': name, 'readOnly': False, 'uuid': name} for name in self.profiles]
+
+    def rpc_getCurrentProfile(self, params):
+        return {'name': self.loaded_profile, 'loadedByThisApp': True}
+
+    def rpc_setupProfile(self, params):
+        name = params.get('profile')
+        status = params.get('status')
+        if status == 'create':
+            if name not in self.profiles:
+                self.profiles.append(name)
+        elif status == 'load':
+            if name not in self.profiles:
+                raise _RpcError(-32045, 'The profile {0} does not exist.'.format(name))
+            self.loaded_profile = name
+        elif status == 'unload':
+            self.loaded_profile = None
+        elif status == 'delete':
+            if name in self.profiles:
+                self.profiles.remove(name)
+        elif status != 'save':
+            raise _RpcError(ERR_INVALID_PARAMS, 'Unknown profile status ' + str(status))
+        return {'action': status, 'name': name, 'message': 'mock profile ' + status}
+
+    def rpc_training(self, params):
+        status = params.get('status')
+        if status == 'start':
+            self.send_sys(['mentalCommand', 'MC_Started'])
+            outcome = 'MC_Failed' if self.server.rng.random() < self.server.training_failure_rate else 'MC_Succeeded'
+            self.later(self.server.training_seconds, self.send_sys, ['mentalCommand', outcome])
+        elif status == 'accept':
+            self.later(0.1, self.send_sys, ['mentalCommand', 'MC_Completed'])
+        elif status == 'reject':
+            self.later(0.1, self.send_sys, ['mentalCommand', 'MC_Rejected'])
+        elif status == 'erase':
+            self.later(0.1, self.send_sys, ['mentalCommand', 'MC_DataErased'])
+        elif status == 'reset':
+            self.later(0.1, self.send_sys, ['mentalCommand', 'MC_Reset'])
+        else:
+            raise _RpcError(ERR_INVALID_PARAMS, 'Unknown training status ' + str(status))
+        return {'action': params.get('action'), 'status': status, 'message': 'mock training ' + status}
+
+    def rpc_mentalCommandActiveAction(self, params):
+        if params.get('status') == 'set':
+            self.active_actions = params.get('actions', self.active_actions)
+            return {'actions': self.active_actions, 'message': 'Set active actions successfully.'}
+        return self.active_actions
+
+    def rpc_mentalCommandActionSensitivity(self, params):
+        if params.get('status') == 'set':
+            self.sensitivity = params.get('values', self.sensitivity)
+            return 'success'
+        return self.sensitivity
+
+    def rpc_mentalCommandBrainMap(self, params):
+        return [{'action': action, 'coordinates': [self.server.rng.random(), self.server.rng.random()]}
+                for action in self.active_actions]
+
+    def rpc_mentalCommandTrainingThreshold(self, params):
+        return {'currentThreshold': 0.5, 'lastTrainingScore': round(self.server.rng.random(), 3)}
+
+    def rpc_createRecord(self, params):
+        self.record_id = str(uuid.uuid4())
+        record = {'uuid': self.record_id, 'title': params.get('title', ''),
+                  'startDatetime': time.strftime('%Y-%m-%dT%H:%M:%S'), 'start': time.time(),
+                  'markers': []}
+        self.records[self.record_id] = record
+        return {'record': {k: v for k, v in record.items() if k not in ('start', 'markers')},
+                'sessionId': self.session_id}
+
+    def rpc_stopRecord(self, params):
+        record = self.records.get(self.record_id)
+        if record is None:
+            raise _RpcError(-32020, 'There is no record in progress.')
+        record['stop'] = time.time()
+        record['endDatetime'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.record_id = None
+        return {'record': {k: v for k, v in record.items() if k not in ('start', 'stop', 'markers')},
+                'sessionId': self.session_id}
+
+    def rpc_exportRecord(self, params):
+        success = []
+        failure = []
+        folder = params.get('folder', '')
+        for record_id in params.get('recordIds', []):
+            record = self.records.get(record_id)
+            if record is None or 'stop' not in record:
+                failure.append({'recordId': record_id, 'code': -32021,
+                                'message': 'The record does not exist or is not stopped.'})
+                continue
+            if params.get('format') == 'CSV' and os.path.isdir(folder):
+                self.later(self.server.export_seconds, self.server.write_export_csv, folder, record)
+            success.append({'recordId': record_id})
+        return {'success': success, 'failure': failure}
+
+    def rpc_injectMarker(self, params):
+        marker = {'uuid': str(uuid.uuid4()), 'type': 'instance', 'label': params.get('label'),
+                  'value': params.get('value'), 'startDatetime': params.get('time')}
+        if self.record_id:
+            self.records[self.record_id]['markers'].append(marker)
+        return {'marker': marker}
+
+    def rpc_updateMarker(self, params):
+        return {'marker': {'uuid': params.get('markerId'), 'type': 'interval',
+                           'endDatetime': params.get('time')}}
+
+    # ---------------------------------------------------------------- streams and script
+    def _stream_loop(self):
+        rates = self.server.rates
+        source = self.server.source
+        start = time.perf_counter()
+        sent = {}
+        try:
+            while not self.stopped.is_set():
+                now = time.perf_counter()
+                if now < self.streams_paused_until:
+                    time.sleep(self.streams_paused_until - now)
+                    continue
+                next_due = now + 0.1
+                for stream in list(self.subscribed):
+                    rate = rates.get(stream)
+                    if not rate or stream == 'sys':
+                        continue
+                    due = int((now - start) * rate)
+                    index = sent.get(stream, due)
+                    while index < due:
+                        self.send({'sid': self.session_id, 'time': time.time(),
+                                   stream: source(stream, now, index)})
+                        index += 1
+                        self.server.samples_sent[stream] = self.server.samples_sent.get(stream, 0) + 1
+                    sent[stream] = index
+                    next_due = min(next_due, start + (index + 1) / rate)
+                delay = next_due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except ConnectionClosed:
+            self.stopped.set()
+
+    def _script_loop(self):
+        start = time.perf_counter()
+        for step in sorted((s for s in self.server.script if 'at' in s), key=lambda s: s['at']):
+            if self.stopped.wait(max(0.0, start + step['at'] - time.perf_counter())):
+                return
+            try:
+                if 'warning' in step:
+                    warning = step['warning']
+                    message = warning.get('message')
+                    if warning['code'] == cortex.CORTEX_STOP_ALL_STREAMS and message is None:
+                        message = {'sessionId': self.session_id, 'behavior': 'All subscriptions are stopped.'}
+                        self.subscribed = {}
+                    self.send_warning(warning['code'], message)
+                if 'stall' in step:
+                    self.streams_paused_until = time.perf_counter() + step['stall']
+                if 'disconnect' in step:
+                    if step['disconnect'] == 'abort':
+                        self.conn.abort()
+                    else:
+                        self.conn.close()
+                    return
+            except ConnectionClosed:
+                return
+
+
+class MockCortexServer():
+    """
+    A local mock of the Cortex service
+
+    Attributes
+    ----------
+    rates : dict
+        samples per second of each stream, for example {'eeg': 256, 'com': 8}
+    source : callable
+        source(stream, t, index) returns the data row of a stream sample. Default is RandomSource()
+    script : list
+        fault script played on every connection. Entries are either timed, e.g.
+            {'at': 5.0, 'warning': {'code': 103, 'message': 'Headset disconnected'}}
+            {'at': 8.0, 'stall': 2.0}                # streams pause for 2 seconds
+            {'at': 12.0, 'disconnect': 'close'}      # or 'abort' to drop the socket
+        or attached to a method, e.g.
+            {'method': 'createSession', 'delay': 2.0}
+            {'method': 'authorize', 'error': {'code': -32002, 'message': 'Invalid license'}, 'times': 1}
+            {'method': 'subscribe', 'drop': True}
+    samples_sent : dict
+        number of samples sent per stream, over all connections
+    rng : random.Random
+        random draws of the service itself (training outcomes, brain map, training score), seeded with seed
+
+    Methods
+    -------
+    start():
+        To start serving in a background thread
+    stop():
+        To stop serving
+    """
+    def __init__(self, host='localhost', port=6868, rates=None, source=None, script=None,
+                 training_seconds=8.0, training_failure_rate=0.0, connect_seconds=1.0, export_seconds=0.5,
+                 profiles=None, headsets=None, access_granted=True, certfile=None, keyfile=None, seed=None):
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.rng = random.Random(seed)
+        self.source = source or RandomSource(seed)
+        self.script = script or []
+        self.training_seconds = training_seconds
+        self.training_failure_rate = training_failure_rate
+        self.connect_seconds = connect_seconds
+        self.export_seconds = export_seconds
+        self.profiles = profiles if profiles is not None else ['TRAW spins']
+        self.headsets = headsets or [{'id': 'EPOCX-MOCK0001', 'status': 'connected', 'connectedBy': 'dongle',
+                                      'customName': 'mock', 'settings': {'eegRate': self.rates['eeg']}}]
+        self.access_granted = access_granted
+        self.samples_sent = {}
+        self.requests_handled = 0
+        self.connections = 0
+        self._server = WebSocketServer(self._on_connect, host=host, port=port,
+                                       certfile=certfile, keyfile=keyfile)
+
+    @property
+    def url(self):
+        return self._server.url
+
+    def _on_connect(self, connection):
+        self.connections += 1
+        _MockSession(self, connection).run()
+
+    def write_export_csv(self, folder, record):
+        # Emotiv style export: a metadata line, then the column header, then eeg rows
+        rate = self.rates['eeg']
+        rows = int(min(record['stop'] - record['start'], 600) * rate)
+        path = os.path.join(folder, '{0}_{1}.csv'.format(record['title'] or 'record', record['uuid']))
+        tmp_path = path + '.part'
+        with open(tmp_path, 'w', newline='') as f:
+            f.write('title:{0}, start timestamp:{1:.6f}, version:2.0, sampling rate:eeg_{2}\n'.format(
+                record['title'], record['start'], rate))
+            writer = csv.writer(f)
+            writer.writerow(['Timestamp', 'EEG.Counter', 'EEG.Interpolated'] +
+                            ['EEG.' + ch for ch in cortex.EEG_CHANNELS] + ['EEG.RawCq', 'MarkerIndex'])
+            for index in range(rows):
+                t = record['start'] + index / rate
+                row = self.source('eeg', t, index)[:-1]
+                writer.writerow(['{0:.6f}'.format(t)] + row[:-1] + [''])
+        os.replace(tmp_path, path)
+
+    def start(self):
+        self._server.start()
+        print('Mock Cortex service listening on ' + self.url)
+
+    def serve_forever(self):
+        print('Mock Cortex service listening on ' + self.url)
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.stop()
+
+
+class _StreamCounter():
+    # subscribes the streams once the session is created and counts the received samples
+    def __init__(self, c, streams):
+        self.c = c
+        self.streams = streams
+        self.counts = dict.fromkeys(streams, 0)
+        c.bind(create_session_done=self.on_create_session_done)
+        c.bind(new_eeg_data=self.on_new_eeg_data, new_mot_data=self.on_new_mot_data,
+               new_dev_data=self.on_new_dev_data, new_pow_data=self.on_new_pow_data,
+               new_met_data=self.on_new_met_data, new_com_data=self.on_new_com_data)
+
+    def on_create_session_done(self, *args, **kwargs):
+        self.c.sub_request(self.streams)
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        self.counts['eeg'] += 1
+
+    def on_new_mot_data(self, *args, **kwargs):
+        self.counts['mot'] += 1
+
+    def on_new_dev_data(self, *args, **kwargs):
+        self.counts['dev'] += 1
+
+    def on_new_pow_data(self, *args, **kwargs):
+        self.counts['pow'] += 1
+
+    def on_new_met_data(self, *args, **kwargs):
+        self.counts['met'] += 1
+
+    def on_new_com_data(self, *args, **kwargs):
+        self.counts['com'] += 1
+
+
+def run_self_test(seconds=5.0, rates=None, script=None):
+    """
+    To run a Cortex client against a local mock and report the received stream rates
+
+    Returns
+    -------
+    dict
+        received samples per second of each stream
+    """
+    server = MockCortexServer(port=0, rates=rates, script=script)
+    server.start()
+    c = Cortex('mock-client', 'mock-secret', url=server.url)
+    counter = _StreamCounter(c, ['eeg', 'mot', 'dev', 'pow', 'met', 'com'])
+    client = threading.Thread(target=c.open, daemon=True)
+    client.start()
+    time.sleep(seconds)
+    c.close()
+    client.join(5)
+    server.stop()
+    return {stream: count / seconds for stream, count in counter.counts.items()}
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Start the mock:   python mock_cortex.py --port 6868 --rate eeg=256 --rate com=8
+#   - Point the scripts at it, for example
+#         l = LiveAdvance(client_id, client_secret, url='ws://localhost:6868')
+#   - Faults are read from a JSON list with --script (see MockCortexServer.script)
+#   - python mock_cortex.py --self-test 5 runs a client against the mock and prints the received rates
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Emotiv Cortex service')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6868)
+    parser.add_argument('--rate', action='append', default=[], metavar='STREAM=HZ',
+                        help='stream rate, for example eeg=256. Can be repeated')
+    parser.add_argument('--script', help='JSON file with the fault script')
+    parser.add_argument('--training-seconds', type=float, default=8.0)
+    parser.add_argument('--seed', type=int, help='seed of the random data and outcomes, for reproducible runs')
+    parser.add_argument('--certfile', help='certificate to serve wss instead of ws')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--self-test', type=float, metavar='SECONDS',
+                        help='run a Cortex client against the mock and print the received rates')
+    args = parser.parse_args()
+
+    rates = {}
+    for item in args.rate:
+        stream, hz = item.split('=')
+        rates[stream] = float(hz)
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+
+    if args.self_test:
+        result = run_self_test(args.self_test, rates, script)
+        for stream, rate in result.items():
+            print('{0}: {1:.1f} samples/s'.format(stream, rate))
+        return
+
+    server = MockCortexServer(args.host, args.port, rates=rates, script=script,
+                              training_seconds=args.training_seconds, seed=args.seed,
+                              certfile=args.certfile, keyfile=args.keyfile)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Cross-validated hyperparameter search for the local motor imagery classifier
+
+Every recorded session is parsed once into plain arrays (EEG times and values,
+trial onsets, ends and labels) stored in a FeatureCache entry. The worker
+processes of the pool load those entries memory-mapped, so the EEG is shared
+through the page cache instead of being pickled to every worker, and a second
+search over the same sessions does not parse the logs again.
+
+A work unit is one feature configuration (window, band, order, n_filters) with
+every decision threshold to try. For each fold, a contiguous block of trials of
+every session is held out, a MotorImageryModel is fitted on the other trials,
+and the held-out block is scored twice:
+
+    - window accuracy, on the labelled windows of the held-out trials
+    - as LocalCommandDetector would run it: a decision every hop samples over
+      the whole held-out span, triggers on the first 'lift' above the threshold,
+      scored with synthetic.score_detections against the 'lift' trials
+
+The thresholds only change the triggers, so they are all scored from the same
+decisions without fitting again.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from feature_cache import FeatureCache, file_fingerprint
+from mi_classifier import DEFAULT_ACTIONS, MotorImageryModel, log_band_power, trial_intervals, trial_windows
+from synthetic import score_detections
+
+DEFAULT_GRID = {
+    'window': [0.5, 1.0, 2.0],
+    'band': [(8.0, 30.0), (8.0, 13.0), (13.0, 30.0)],
+    'order': [2, 4],
+    'n_filters': [4, 6],
+    'threshold': [0.3, 0.5, 0.7],
+}
+FEATURE_PARAMS = ('window', 'band', 'order', 'n_filters')
+SORT_KEYS = {
+    # key, descending
+    'hit_rate': ('hit_rate', True),
+    'accuracy': ('accuracy', True),
+    'false_per_minute': ('false_per_minute', False),
+    'latency': ('latency', False),
+}
+
+# sessions of the worker process, loaded memory-mapped by _init_worker
+_SESSIONS = []
+
+
+def load_sessions(paths, cache, actions=DEFAULT_ACTIONS, markers=False):
+    """
+    To parse every session once into a cache entry
+
+    Returns
+    -------
+    list
+        cache keys of the sessions, in the order of paths
+    """
+    @cache.stage('param_search.session', version=1)
+    def session_arrays(path, fingerprint, actions, markers):
+        # fingerprint only keys the entry, so an edited log is parsed again
+        onsets, ends, labels, eeg_times, values = trial_intervals(path, actions, markers)
+        return {'eeg_times': np.asarray(eeg_times, dtype=np.float64),
+                'values': np.ascontiguousarray(values, dtype=np.float64),
+                'onsets': np.asarray(onsets, dtype=np.float64), 'ends': np.asarray(ends, dtype=np.float64),
+                'labels': np.asarray(labels, dtype=str)}
+
+    keys = []
+    for path in paths:
+        params = {'path': os.path.abspath(path), 'fingerprint': file_fingerprint(path),
+                  'actions': list(actions), 'markers': markers}
+        session_arrays(**params)
+        keys.append(cache.make_key('param_search.session', 1, [], params))
+    return keys
+
+
+def expand_grid(grid, random_count=None, seed=0):
+    """
+    To list the feature configurations of a grid, all of them or random_count drawn without replacement
+
+    Returns
+    -------
+    list
+        dicts of FEATURE_PARAMS values
+    """
+    configs = [dict(zip(FEATURE_PARAMS, values)) for values in itertools.product(*(grid[p] for p in FEATURE_PARAMS))]
+    if random_count is not None and random_count < len(configs):
+        picked = np.random.default_rng(seed).choice(len(configs), size=random_count, replace=False)
+        configs = [configs[i] for i in sorted(picked)]
+    return configs
+
+
+def _init_worker(folder, keys):
+    global _SESSIONS
+    cache = FeatureCache(folder)
+    _SESSIONS = [cache.get(key) for key in keys]
+
+
+def _fold_of_trials(n_trials, folds):
+    # contiguous blocks, so a held-out span is one stretch of the session
+    return np.arange(n_trials) * folds // max(n_trials, 1)
+
+
+def _decision_probabilities(model, eeg_times, values, start, end, hop):
+    # decisions of LocalCommandDetector every hop samples over [start, end)
+    i0, i1 = np.searchsorted(eeg_times, [start, end])
+    n = model.window_samples
+    if i1 - i0 < n:
+        return np.zeros(0), np.zeros(0)
+    components = values[i0:i1] @ model.filters.T
+    windows = np.lib.stride_tricks.sliding_window_view(components, n, axis=0)[::hop]
+    weights = model.spectral_weights()
+    scores = np.concatenate([log_band_power(chunk.transpose(0, 2, 1), weights) @ model.weights + model.bias
+                             for chunk in np.array_split(windows, max(1, len(windows) // 512))])
+    ends = eeg_times[i0 + n - 1:i1:hop][:len(scores)]
+    return ends, 1.0 / (1.0 + np.exp(-scores))
+
+
+def evaluate_config(config, thresholds, folds=5, hop=16, step=0.25, skip=0.5, actions=DEFAULT_ACTIONS,
+                    tolerance=1.0, sessions=None):
+    """
+    To cross-validate one feature configuration at every threshold
+
+    Parameters
+    ----------
+    config : dict
+        window, band, order, n_filters
+    thresholds : list
+        minimum power of a 'lift' decision to trigger
+    sessions : list, optional
+        session arrays, the ones loaded by the worker by default
+
+    Returns
+    -------
+    list
+        one result dict per threshold
+    """
+    sessions = _SESSIONS if sessions is None else sessions
+    start_time = time.perf_counter()
+    model_params = dict(config, actions=actions)
+    template = MotorImageryModel(**model_params)
+    cut = []
+    for s in sessions:
+        windows, labels, trials = trial_windows(template, s['eeg_times'], s['values'], s['onsets'], s['ends'],
+                                                s['labels'], step, skip)
+        cut.append((windows, labels, _fold_of_trials(len(s['onsets']), folds)[trials]))
+
+    correct, total, minutes = 0, 0, 0.0
+    counts = {t: {'hits': 0, 'misses': 0, 'false_triggers': 0, 'latencies': []} for t in thresholds}
+    for fold in range(folds):
+        train_windows = [w[f != fold] for w, _, f in cut]
+        train_labels = [l[f != fold] for _, l, f in cut]
+        train_labels = np.concatenate(train_labels)
+        if len(np.unique(train_labels)) < 2:
+            continue
+        model = MotorImageryModel(**model_params).fit(np.concatenate(train_windows), train_labels)
+        for s, (windows, labels, fold_of_window) in zip(sessions, cut):
+            test = fold_of_window == fold
+            if test.any():
+                predicted = np.where(model.predict_proba(windows[test]) >= 0.5, actions[1], actions[0])
+                correct += np.count_nonzero(predicted == labels[test])
+                total += np.count_nonzero(test)
+            held_out = _fold_of_trials(len(s['onsets']), folds) == fold
+            if not held_out.any():
+                continue
+            span = (s['onsets'][held_out][0], s['ends'][held_out][-1])
+            times, p = _decision_probabilities(model, s['eeg_times'], s['values'], span[0], span[1], hop)
+            minutes += (span[1] - span[0]) / 60.0
+            lifts = held_out & (s['labels'] == actions[1])
+            for threshold in thresholds:
+                # power is |2p - 1|, so a 'lift' above the threshold is p > (1 + threshold) / 2
+                lifting = p > (1.0 + threshold) / 2.0
+                rising = lifting & ~np.concatenate([[False], lifting[:-1]])
+                score = score_detections(times[rising], s['onsets'][lifts], s['ends'][lifts], tolerance)
+                for name in ('hits', 'misses', 'false_triggers'):
+                    counts[threshold][name] += score[name]
+                counts[threshold]['latencies'].append(score['latencies'])
+
+    elapsed = time.perf_counter() - start_time
+    results = []
+    for threshold in thresholds:
+        c = counts[threshold]
+        latencies = np.concatenate(c['latencies']) if c['latencies'] else np.zeros(0)
+        latencies = latencies[~np.isnan(latencies)]
+        lifts = c['hits'] + c['misses']
+        results.append(dict(config, band=list(config['band']), threshold=threshold,
+                            accuracy=correct / total if total else None,
+                            hit_rate=c['hits'] / lifts if lifts else None,
+                            false_per_minute=c['false_triggers'] / minutes if minutes else None,
+                            latency=float(np.median(latencies)) if len(latencies) else None,
+                            hits=c['hits'], misses=c['misses'], false_triggers=c['false_triggers'],
+                            seconds=elapsed / len(thresholds)))
+    return results
+
+
+def search(paths, grid=None, random_count=None, seed=0, workers=None, cache_folder='.feature_cache',
+           actions=DEFAULT_ACTIONS, markers=False, progress=None, **evaluate_params):
+    """
+    To evaluate every configuration of a grid on recorded sessions in a process pool
+
+    Parameters
+    ----------
+    grid : dict, optional
+        lists of values for window, band, order, n_filters and threshold, DEFAULT_GRID by default
+    random_count : int, optional
+        number of feature configurations drawn at random from the grid instead of all of them
+    workers : int, optional
+        worker processes, os.cpu_count() by default
+    progress : callable, optional
+        called with (done, total) after every configuration
+
+    Returns
+    -------
+    list
+        one result dict per configuration and threshold
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    cache = FeatureCache(cache_folder)
+    keys = load_sessions(paths, cache, actions, markers)
+    configs = expand_grid(grid, random_count, seed)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache.folder, keys)) as pool:
+        futures = [pool.submit(evaluate_config, config, list(grid['threshold']), actions=actions, **evaluate_params)
+                   for config in configs]
+        for done, future in enumerate(as_completed(futures), 1):
+            results.extend(future.result())
+            if progress is not None:
+                progress(done, len(futures))
+    return results
+
+
+def rank(results, key='hit_rate', max_false_per_minute=None):
+    """
+    To sort results best first, keeping only those under a false trigger budget
+    """
+    name, descending = SORT_KEYS[key]
+    kept = [r for r in results if r[name] is not None and
+            (max_false_per_minute is None or r['false_per_minute'] <= max_false_per_minute)]
+    # ties, frequent with hit rates, go to the fewest false triggers
+    return sorted(kept, key=lambda r: (-r[name] if descending else r[name], r['false_per_minute'] or 0.0))
+
+
+def parse_grid(items):
+    """
+    To parse command line grid items such as window=0.5,1 band=8-30,8-13 order=4
+
+    Returns
+    -------
+    dict
+        lists of values by parameter
+    """
+    grid = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        if name not in DEFAULT_GRID or not values:
+            raise ValueError('Unknown grid item {0}, expected one of {1}.'.format(item, ', '.join(DEFAULT_GRID)))
+        if name == 'band':
+            grid[name] = [tuple(float(edge) for edge in value.split('-')) for value in values.split(',')]
+        elif name in ('order', 'n_filters'):
+            grid[name] = [int(value) for value in values.split(',')]
+        else:
+            grid[name] = [float(value) for value in values.split(',')]
+    return grid
+
+
+def _format(result):
+    def value(name, fmt):
+        return 'n/a' if result[name] is None else fmt.format(result[name])
+    return 'window {0:.2f} s, band {1:g}-{2:g} Hz, order {3}, {4} filters, threshold {5:.2f}: ' \
+           'accuracy {6}, hit rate {7}, {8} false/min, latency {9}'.format(
+               result['window'], result['band'][0], result['band'][1], result['order'], result['n_filters'],
+               result['threshold'], value('accuracy', '{0:.1%}'), value('hit_rate', '{0:.1%}'),
+               value('false_per_minute', '{0:.2f}'), value('latency', '{0:.2f} s'))
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Record training sessions with replay.SessionRecorder while train.py runs (sys events label the trials)
+#   - python param_search.py session1.log session2.log searches DEFAULT_GRID on every core
+#   - --grid window=0.5,1 band=8-30,13-30 threshold=0.4,0.6 overrides some lists of the grid,
+#     --random 20 evaluates 20 feature configurations drawn from it
+#   - --max-false 0.5 keeps the configurations under 0.5 false triggers per minute, --sort picks the ranking
+#   - --out results.json stores every result; the best window/band/order go to mi_classifier.py train
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-validated search of the local classifier parameters')
+    parser.add_argument('sessions', nargs='+')
+    parser.add_argument('--grid', nargs='*', default=[], help='name=v1,v2 items, bands as low-high')
+    parser.add_argument('--random', type=int, default=None, help='feature configurations drawn from the grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--hop', type=int, default=16, help='EEG samples between two decisions')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--actions', nargs=2, default=list(DEFAULT_ACTIONS))
+    parser.add_argument('--markers', action='store_true', help='label trials with injected markers')
+    parser.add_argument('--cache', default='.feature_cache')
+    parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='hit_rate')
+    parser.add_argument('--max-false', type=float, default=None, help='false triggers per minute allowed')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    def progress(done, total):
+        print('\r{0}/{1} configurations'.format(done, total), end='', flush=True)
+
+    start = time.perf_counter()
+    results = search(args.sessions, grid, args.random, args.seed, args.workers, args.cache, args.actions,
+                     args.markers, progress, folds=args.folds, hop=args.hop)
+    elapsed = time.perf_counter() - start
+    print('\r{0} results in {1:.1f} s ({2:.1f} s of computation on {3} workers)'.format(
+        len(results), elapsed, sum(r['seconds'] for r in results), args.workers or os.cpu_count()))
+
+    for result in rank(results, args.sort, args.max_false)[:args.top]:
+        print('  ' + _format(result))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
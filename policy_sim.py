@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Vectorized simulation of lift decision policies over recorded com streams
+
+A policy turns the com stream into lift triggers with four parameters:
+
+    threshold   a 'lift' sample above it switches the policy on
+    hysteresis  once on, it only switches off when the lift power drops to
+                threshold - hysteresis or below (a non-lift sample is power 0)
+    hold        seconds the policy must stay on before it triggers, once per on period
+    refractory  seconds after a trigger during which no other trigger is allowed
+
+live.py today is threshold 0.5 with no hysteresis, hold or refractory period.
+
+Every session is parsed once into arrays (com times and lift power, trial
+intervals from the sys events or the injected markers) stored in a
+FeatureCache entry. The simulation then evaluates every combination at once:
+the on/off state of all threshold/hysteresis pairs is one forward fill over a
+(pairs, samples) matrix, the hold delay is a searchsorted per on period, and
+the refractory period follows the chain of accepted triggers of all
+combinations in lockstep, only inside runs of candidates closer than the
+refractory period. Triggers are scored against the 'lift' trials like
+synthetic.score_detections, and the Pareto front of hit rate, false triggers
+per minute outside the 'lift' trials and median latency is what is worth
+choosing from.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from adjust_sensitivity import save_threshold
+from epochs import session_markers
+from feature_cache import FeatureCache, file_fingerprint
+from mi_classifier import DEFAULT_ACTIONS, trial_bounds
+from replay import read_session
+
+DEFAULT_GRID = {
+    'threshold': [round(0.05 * k, 2) for k in range(1, 20)],
+    'hysteresis': [0.0, 0.1, 0.2, 0.3],
+    'hold': [0.0, 0.25, 0.5, 1.0, 1.5, 2.0],
+    'refractory': [0.0, 1.0, 2.0, 3.0, 5.0],
+}
+POLICY_PARAMS = ('threshold', 'hysteresis', 'hold', 'refractory')
+DEFAULT_POLICY_PATH = '.current_policy.json'
+# seconds between two recordings laid end to end
+SESSION_GAP = 60.0
+
+
+def read_com_session(path, actions=DEFAULT_ACTIONS, markers=False):
+    """
+    To read the com stream and the trials of a session recorded with replay.SessionRecorder
+
+    Returns
+    -------
+    dict
+        times and lift power of the com samples, onsets, ends and labels of the trials
+    """
+    com_times, com_power, sys_times, sys_events = [], [], [], []
+    for _, message in read_session(path):
+        if '"com"' not in message and '"sys"' not in message:
+            continue
+        data = json.loads(message)
+        if 'time' not in data:
+            continue
+        if 'com' in data:
+            action, power = data['com'][:2]
+            com_times.append(data['time'])
+            com_power.append(power if action == actions[1] else 0.0)
+        elif 'sys' in data:
+            sys_times.append(data['time'])
+            sys_events.append(data['sys'])
+    marker_times, marker_labels = session_markers(path) if markers else (None, None)
+    onsets, ends, labels = trial_bounds(np.array(sys_times), sys_events, marker_times, marker_labels, actions)
+    return {'times': np.array(com_times, dtype=np.float64), 'power': np.array(com_power, dtype=np.float64),
+            'onsets': np.asarray(onsets, dtype=np.float64), 'ends': np.asarray(ends, dtype=np.float64),
+            'labels': np.asarray(labels, dtype=str)}
+
+
+def load_recording(paths, cache=None, actions=DEFAULT_ACTIONS, markers=False):
+    """
+    To read sessions, through the cache when given, and lay them end to end
+
+    Returns
+    -------
+    dict
+        times, power, lift and neutral trial intervals and duration of the whole recording;
+        a power of -inf after every session ends the on period of every policy
+    """
+    read = read_com_session
+    if cache is not None:
+        @cache.stage('policy_sim.session', version=1)
+        def read(path, fingerprint, actions, markers):
+            # fingerprint only keys the entry, so an edited log is read again
+            return read_com_session(path, actions, markers)
+
+    parts = {name: [] for name in ('times', 'power', 'lift_onsets', 'lift_ends', 'neutral_onsets', 'neutral_ends')}
+    end, duration = None, 0.0
+    for path in paths:
+        if cache is not None:
+            s = read(os.path.abspath(path), file_fingerprint(path), list(actions), markers)
+        else:
+            s = read(path, actions, markers)
+        if len(s['times']) == 0:
+            continue
+        # sessions may overlap in time (synthetic ones start at 0), shift them after each other
+        shift = 0.0 if end is None else max(0.0, end + SESSION_GAP - s['times'][0])
+        parts['times'] += [s['times'] + shift, [s['times'][-1] + shift + 1e-3]]
+        parts['power'] += [s['power'], [-np.inf]]
+        for action in ('lift', 'neutral'):
+            keep = s['labels'] == actions[action == 'lift']
+            parts[action + '_onsets'].append(s['onsets'][keep] + shift)
+            parts[action + '_ends'].append(s['ends'][keep] + shift)
+        end = s['times'][-1] + shift
+        duration += s['times'][-1] - s['times'][0]
+    recording = {name: np.concatenate(values) if values else np.zeros(0) for name, values in parts.items()}
+    recording['duration'] = duration
+    return recording
+
+
+def _on_periods(power, on_level, off_level):
+    # (pair, start, end) of every on period of every (on level, off level) pair
+    on = power[None, :] > on_level[:, None]
+    decisive = on | (power[None, :] <= off_level[:, None])
+    # state = kind of the last decisive sample, found by a forward fill of its index
+    last = np.maximum.accumulate(np.where(decisive, np.arange(len(power), dtype=np.int32), -1), axis=1)
+    state = np.take_along_axis(on, np.maximum(last, 0), axis=1) & (last >= 0)
+    edges = np.diff(state.astype(np.int8), axis=1, prepend=0, append=0)
+    pair, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    return pair, start, end
+
+
+def _accept(group, times, refractories):
+    # greedy refractory filter of candidates sorted by group then time, for every refractory period
+    accepted = np.zeros((len(refractories), len(times)), dtype=bool)
+    if not len(times):
+        return accepted
+    # one increasing key for (group, time), so searchsorted finds the next candidate of the same group
+    span = times.max() - times.min() + max(refractories) + 1.0
+    key = group * span + (times - times.min())
+    gap = np.diff(key, prepend=-np.inf)
+    for row, refractory in enumerate(refractories):
+        # a candidate at least refractory after the previous one is accepted whatever happened before,
+        # so only the chains inside runs of closer candidates are followed, all runs in lockstep
+        head = gap >= refractory
+        accepted[row] = head
+        if head.all():
+            continue
+        heads = np.flatnonzero(head)
+        limit = np.append(heads[1:], len(key))
+        following = np.searchsorted(key, key + refractory)
+        pointer = following[heads]
+        active = pointer < limit
+        pointer, limit = pointer[active], limit[active]
+        while len(pointer):
+            accepted[row, pointer] = True
+            pointer = following[pointer]
+            active = pointer < limit
+            pointer, limit = pointer[active], limit[active]
+    return accepted
+
+
+def simulate(recording, grid=None, tolerance=1.0, chunk=2 ** 23):
+    """
+    To evaluate every policy of a grid on a recording
+
+    Parameters
+    ----------
+    recording : dict
+        from load_recording
+    grid : dict, optional
+        lists of values for threshold, hysteresis, hold and refractory, DEFAULT_GRID by default
+    tolerance : float, optional
+        triggers up to tolerance seconds after the end of a 'lift' trial still count for it
+    chunk : int, optional
+        elements of the (pairs, samples) state matrix computed at once, which bounds the memory
+
+    Returns
+    -------
+    dict
+        one array per parameter and per metric, one value per policy in the order of
+        itertools.product over POLICY_PARAMS
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    thresholds, hystereses, holds, refractories = (np.asarray(grid[p], dtype=np.float64) for p in POLICY_PARAMS)
+    times, power = recording['times'], recording['power']
+    lift_onsets, lift_ends = recording['lift_onsets'], recording['lift_ends']
+    on_level = np.repeat(thresholds, len(hystereses))
+    off_level = np.maximum(on_level - np.tile(hystereses, len(thresholds)), 0.0)
+    n_holds, n_refractories = len(holds), len(refractories)
+    n_policies = len(on_level) * n_holds * n_refractories
+    triggers, false_triggers, neutral_false, hits = (np.zeros(n_policies, dtype=np.int64) for _ in range(4))
+    latency = np.full(n_policies, np.nan)
+
+    # threshold/hysteresis pairs are independent, a chunk of them at a time bounds the memory
+    rows = max(1, chunk // max(len(power), 1))
+    for first in range(0, len(on_level), rows):
+        pair, start, end = _on_periods(power, on_level[first:first + rows], off_level[first:first + rows])
+        n_groups = len(on_level[first:first + rows]) * n_holds
+        base = first * n_holds * n_refractories
+
+        # hold: the trigger is the first sample at least hold seconds into the on period
+        trigger = np.maximum(np.searchsorted(times, times[start][:, None] + holds[None, :]), start[:, None])
+        valid = trigger < end[:, None]
+        group = (pair[:, None] * n_holds + np.arange(n_holds)[None, :])[valid]
+        trigger = trigger[valid]
+        order = np.argsort(group, kind='stable')
+        group, trigger_times = group[order], times[trigger[order]]
+        accepted = _accept(group, trigger_times, refractories)
+
+        # trial of every candidate, shared by all refractory periods
+        trial = np.searchsorted(lift_onsets, trigger_times, side='right') - 1
+        lifting = (trial >= 0) & (trigger_times < lift_ends[np.maximum(trial, 0)] + tolerance)
+        neutral = np.searchsorted(recording['neutral_onsets'], trigger_times, side='right') - 1
+        neutral = (neutral >= 0) & (trigger_times < recording['neutral_ends'][np.maximum(neutral, 0)]) & ~lifting
+
+        n = n_groups * n_refractories
+        for r in range(n_refractories):
+            # one refractory period at a time keeps the triggers sorted by policy then time
+            position = np.flatnonzero(accepted[r])
+            policy = group[position] * n_refractories + r
+            t, k = trigger_times[position], trial[position]
+            in_lift, in_neutral = lifting[position], neutral[position]
+            triggers[base:base + n] += np.bincount(policy, minlength=n)
+            false_triggers[base:base + n] += np.bincount(policy[~in_lift], minlength=n)
+            neutral_false[base:base + n] += np.bincount(policy[in_neutral], minlength=n)
+
+            # a hit is the first trigger of a policy in a lift trial
+            hit_policy, k, t = policy[in_lift], k[in_lift], t[in_lift]
+            first_hit = np.ones(len(k), dtype=bool)
+            first_hit[1:] = (hit_policy[1:] != hit_policy[:-1]) | (k[1:] != k[:-1])
+            hit_policy = hit_policy[first_hit]
+            delay = t[first_hit] - lift_onsets[k[first_hit]]
+            count = np.bincount(hit_policy, minlength=n)
+            hits[base:base + n] += count
+            if not len(delay):
+                continue
+            # median latency: sorting policy * scale + latency sorts the latencies within each policy
+            scale = delay.max() + 1.0
+            delay = np.sort(hit_policy * scale + delay) - hit_policy * scale
+            offset = np.concatenate([[0], np.cumsum(count)[:-1]])
+            has = np.flatnonzero(count)
+            latency[base + has] = (delay[offset[has] + (count[has] - 1) // 2] +
+                                   delay[offset[has] + count[has] // 2]) / 2.0
+
+    outside_minutes = (recording['duration'] - np.sum(lift_ends - lift_onsets)) / 60.0
+    values = list(itertools.product(*(grid[p] for p in POLICY_PARAMS)))
+    results = {name: np.array([v[i] for v in values], dtype=np.float64) for i, name in enumerate(POLICY_PARAMS)}
+    results.update({
+        'triggers': triggers,
+        'hits': hits,
+        'misses': len(lift_onsets) - hits,
+        'false_triggers': false_triggers,
+        'neutral_false_triggers': neutral_false,
+        'hit_rate': hits / max(len(lift_onsets), 1),
+        'false_per_minute': false_triggers / max(outside_minutes, 1e-9),
+        'latency': latency,
+    })
+    return results
+
+
+def pareto_front(results, chunk=1024):
+    """
+    To get the policies no other policy beats on hit rate, false triggers per minute and latency at once
+
+    Returns
+    -------
+    numpy.ndarray
+        indices of the front, fewest false triggers first; of policies with the same metrics
+        only the first of the grid is kept
+    """
+    costs = np.stack([-results['hit_rate'], results['false_per_minute'],
+                      np.nan_to_num(results['latency'], nan=np.inf)], axis=1)
+    _, unique = np.unique(costs, axis=0, return_index=True)
+    unique = np.sort(unique)
+    candidates = costs[unique]
+    dominated = np.zeros(len(unique), dtype=bool)
+    for first in range(0, len(unique), chunk):
+        c = candidates[first:first + chunk, None, :]
+        dominated[first:first + chunk] = np.any(np.all(candidates[None] <= c, axis=2) &
+                                                np.any(candidates[None] < c, axis=2), axis=1)
+    front = unique[~dominated]
+    return front[np.lexsort((-results['hit_rate'][front], results['false_per_minute'][front]))]
+
+
+def policy_at(results, i):
+    """
+    Returns
+    -------
+    dict
+        parameters and metrics of policy i, json-compatible
+    """
+    policy = {}
+    for name, values in results.items():
+        value = values[i].item()
+        policy[name] = None if isinstance(value, float) and np.isnan(value) else value
+    return policy
+
+
+def choose(results, front, max_false_per_minute):
+    """
+    To pick the policy of the front with the best hit rate under a false trigger budget
+
+    Returns
+    -------
+    int or None
+        policy index, None when no policy of the front fits the budget
+    """
+    within = [i for i in front if results['false_per_minute'][i] <= max_false_per_minute]
+    return max(within, key=lambda i: (results['hit_rate'][i], -results['false_per_minute'][i])) if within else None
+
+
+def parse_grid(items):
+    """
+    To parse command line grid items such as threshold=0.3,0.5 hold=0,0.5
+
+    Returns
+    -------
+    dict
+        lists of values by parameter
+    """
+    grid = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        if name not in DEFAULT_GRID or not values:
+            raise ValueError('Unknown grid item {0}, expected one of {1}.'.format(item, ', '.join(DEFAULT_GRID)))
+        grid[name] = [float(value) for value in values.split(',')]
+    return grid
+
+
+def _format(policy):
+    latency = 'n/a' if policy['latency'] is None else '{0:.2f} s'.format(policy['latency'])
+    return 'threshold {0:.2f}, hysteresis {1:.2f}, hold {2:.2f} s, refractory {3:.1f} s: hit rate {4:.1%}, ' \
+           '{5:.2f} false/min ({6} during neutral trials), latency {7}'.format(
+               policy['threshold'], policy['hysteresis'], policy['hold'], policy['refractory'],
+               policy['hit_rate'], policy['false_per_minute'], policy['neutral_false_triggers'], latency)
+
+
+def _demo_recording(hours):
+    # one synthetic hour of com and sys events, repeated
+    from synthetic import SignalGenerator
+    session = SignalGenerator(seed=3).generate(3600, start_time=0.0)
+    repeats = max(1, int(round(hours)))
+    shifts = np.arange(repeats) * (3600.0 + SESSION_GAP)
+    times = (session.com_times[None, :] + shifts[:, None])
+    power = np.where(session.com_actions == 'lift', session.com_power, 0.0)
+    breaks = times[:, -1:] + 1e-3
+    trial = session.lift_offsets - session.lift_onsets
+    neutral_onsets = np.concatenate([[0.0], session.lift_offsets[:-1]]) + 0.1 * trial
+    return {
+        'times': np.concatenate([times, breaks], axis=1).reshape(-1),
+        'power': np.concatenate([np.tile(power, (repeats, 1)), np.full((repeats, 1), -np.inf)], axis=1).reshape(-1),
+        'lift_onsets': (session.lift_onsets[None, :] + shifts[:, None]).reshape(-1),
+        'lift_ends': (session.lift_offsets[None, :] + shifts[:, None]).reshape(-1),
+        'neutral_onsets': (neutral_onsets[None, :] + shifts[:, None]).reshape(-1),
+        'neutral_ends': (session.lift_onsets[None, :] - 0.1 * trial + shifts[:, None]).reshape(-1),
+        'duration': repeats * 3600.0,
+    }
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Record sessions with replay.SessionRecorder while train.py runs, so sys events mark the trials,
+#     or inject 'neutral'/'lift' markers and pass --markers
+#   - python policy_sim.py session1.log session2.log prints the Pareto front of DEFAULT_GRID
+#   - --grid threshold=0.4,0.5,0.6 hold=0,0.5 replaces lists of the grid, --out front.json stores the front
+#   - --apply --max-false 0.5 saves the best policy under 0.5 false triggers per minute to .current_policy.json
+#     and its threshold where adjust_sensitivity.py keeps it
+#   - python policy_sim.py --demo 300 times the default grid over 300 synthetic hours
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate lift decision policies on recorded com streams')
+    parser.add_argument('sessions', nargs='*')
+    parser.add_argument('--grid', nargs='*', default=[], help='name=v1,v2 items')
+    parser.add_argument('--actions', nargs=2, default=list(DEFAULT_ACTIONS))
+    parser.add_argument('--markers', action='store_true', help='take the trials from injected markers')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='seconds after a lift trial still counted')
+    parser.add_argument('--cache', default='.feature_cache')
+    parser.add_argument('--out', default=None, help='json file for the front')
+    parser.add_argument('--max-false', type=float, default=1.0, help='false triggers per minute for --apply')
+    parser.add_argument('--apply', action='store_true', help='save the chosen policy for live use')
+    parser.add_argument('--demo', type=float, metavar='HOURS', default=None, help='run on synthetic hours')
+    args = parser.parse_args()
+
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    start = time.perf_counter()
+    if args.demo is not None:
+        recording = _demo_recording(args.demo)
+    elif args.sessions:
+        recording = load_recording(args.sessions, FeatureCache(args.cache), args.actions, args.markers)
+    else:
+        parser.print_help()
+        return
+    if not len(recording['times']):
+        print('No com samples in the sessions.')
+        sys.exit(1)
+    loaded = time.perf_counter()
+    results = simulate(recording, grid, args.tolerance)
+    front = pareto_front(results)
+    elapsed = time.perf_counter() - loaded
+    print('{0} policies over {1:.1f} h of com ({2} samples, {3} lift trials): loaded in {4:.1f} s, '
+          'simulated in {5:.2f} s'.format(len(results['hits']), recording['duration'] / 3600.0,
+                                           len(recording['times']), len(recording['lift_onsets']),
+                                           loaded - start, elapsed))
+    print('Pareto front, {0} policies:'.format(len(front)))
+    for i in front:
+        print('  ' + _format(policy_at(results, i)))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump([policy_at(results, i) for i in front], f, indent=1)
+    if args.apply:
+        chosen = choose(results, front, args.max_false)
+        if chosen is None:
+            print('No policy under {0} false triggers per minute.'.format(args.max_false))
+            sys.exit(1)
+        policy = policy_at(results, chosen)
+        with open(DEFAULT_POLICY_PATH, 'w') as f:
+            json.dump(policy, f, indent=1)
+        save_threshold(policy['threshold'])
+        print('Applied: ' + _format(policy))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Predictive pre-motion of the arm to hide part of the actuation latency
+
+From the first intent to the fingers closing, the servo travel comes after the
+detection. PreMotionController watches the 'lift' power of the com stream and,
+when it rises fast enough to reach the threshold within a prediction horizon,
+sends a cheap "prepare": the fingers start a partial, reversible move towards
+the grab pose. The decision then sends "commit", which completes the grab from
+wherever the fingers got to, or the rise dies out and "cancel" reopens them.
+
+The rise is an exponentially weighted slope of the power, O(1) per sample. A
+wrong guess costs a partial closing and reopening of the fingers, so its cost
+is bounded by the prepare percent, by the timeout after which a prepare with
+no decision is cancelled, and by a budget of cancels per minute above which
+predictions pause.
+
+RobotArm.ino commands, sent over one persistent serial connection:
+
+    1  grab            2  ungrab          3  surprise
+    4 <percent>        prepare, move percent of the way to the grab pose
+    5  commit          complete the grab
+    6  cancel          back to the open pose
+
+Commands end with ';' so Serial.parseInt on the board returns at once instead
+of waiting for its timeout.
+
+ArmLink keeps the port open for the whole session and "commit" is the grab, so
+the Node-RED flow's Grab Script (Mental_Command_Scripts/grab.py, on the same
+port) must be disabled while pre-motion drives the arm, see CONFIGURATION.md.
+"""
+
+import sys
+import time
+from collections import deque
+
+import numpy as np
+from pydispatch import Dispatcher
+
+from adjust_sensitivity import get_current_threshold
+
+COMMANDS = {'grab': 1, 'ungrab': 2, 'surprise': 3, 'prepare': 4, 'commit': 5, 'cancel': 6}
+
+
+class ArmLink():
+    """
+    A persistent serial connection to RobotArm.ino
+
+    Attributes
+    ----------
+    port : str or None
+        serial port such as 'COM3' or '/dev/ttyACM0'; None for a dry run that only logs the commands
+    log : deque
+        (time, command text) of the last commands sent
+    out_waiting : int
+        bytes written and not sent to the board yet, 0 for a dry run
+
+    Methods
+    -------
+    open():
+        To open the port, once
+    send(command, value):
+        To send one of COMMANDS without waiting for the board
+    prepare(percent) / commit() / cancel():
+        The pre-motion commands
+    """
+    def __init__(self, port=None, baudrate=9600, keep_log=1000):
+        self.port = port
+        self.baudrate = baudrate
+        self.log = deque(maxlen=keep_log)
+        self._serial = None
+
+    @property
+    def out_waiting(self):
+        return self._serial.out_waiting if self._serial is not None else 0
+
+    def open(self):
+        if self.port is None or self._serial is not None:
+            return self
+        import serial
+        # no read or write timeouts: a command never blocks the com callbacks
+        self._serial = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=0, write_timeout=0)
+        return self
+
+    def send(self, command, value=None):
+        text = '{0};'.format(COMMANDS[command]) if value is None else '{0} {1};'.format(COMMANDS[command], int(value))
+        self.log.append((time.time(), text))
+        if self._serial is not None:
+            self._serial.write(text.encode('ascii'))
+            # the board echoes the command number; drop the echoes so the input buffer never fills
+            if self._serial.in_waiting:
+                self._serial.read(self._serial.in_waiting)
+        return text
+
+    def prepare(self, percent):
+        return self.send('prepare', max(0, min(100, round(percent))))
+
+    def commit(self):
+        return self.send('commit')
+
+    def cancel(self):
+        return self.send('cancel')
+
+    def close(self):
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+
+class PreMotionController(Dispatcher):
+    """
+    A class to prepare, commit and cancel pre-motions from the com power and the lift decisions
+
+    Attributes
+    ----------
+    link : ArmLink
+        where the commands go
+    threshold : float
+        lift threshold, used when push is not given the decision engine's
+    horizon : float
+        seconds ahead the rising power is extrapolated to
+    percent : float
+        share of the travel to the grab pose done by a prepare, the cost of a wrong guess
+    min_power, min_slope : float
+        power and rise in power per second below which nothing is predicted
+    min_samples : int
+        consecutive samples at min_power or more before a prediction, against single-sample spikes
+    timeout : float
+        seconds after which a prepare with no decision is cancelled
+    max_cancels_per_minute : float
+        wrong guesses per minute above which predictions pause
+    travel_seconds : float
+        time of a full servo travel, to estimate the latency hidden by a prepare
+    counts : dict
+        prepares, commits after a prepare, commits without one, cancels and paused predictions
+    hidden : list
+        seconds of travel hidden by each prepared commit
+
+    Methods
+    -------
+    push(t, power, decided, threshold):
+        To feed one com sample, with whether the decision engine decided a lift on it
+    cancel(t):
+        To cancel a prepare, when a lift decision is dropped for example
+    """
+    _events_ = ['premotion']
+
+    def __init__(self, link=None, threshold=None, horizon=0.4, percent=30.0, min_power=0.1, min_slope=0.5, min_samples=2,
+                 slope_half_life=0.2, timeout=1.0, max_cancels_per_minute=2.0, travel_seconds=0.4,
+                 keep_hidden=1000):
+        self.link = link if link is not None else ArmLink()
+        self.threshold = threshold if threshold is not None else get_current_threshold()
+        self.horizon = horizon
+        self.percent = percent
+        self.min_power = min_power
+        self.min_slope = min_slope
+        self.min_samples = min_samples
+        self.slope_half_life = slope_half_life
+        self.timeout = timeout
+        self.max_cancels_per_minute = max_cancels_per_minute
+        self.travel_seconds = travel_seconds
+        self.counts = {'prepare': 0, 'prepared_commit': 0, 'commit': 0, 'cancel': 0, 'paused': 0}
+        self.hidden = []
+        self._keep_hidden = keep_hidden
+        self._cancels = deque()
+        self._prepared_at = None
+        self._last_time = None
+        self._last_power = 0.0
+        self._run = 0
+        self.slope = 0.0
+
+    @property
+    def prepared(self):
+        return self._prepared_at is not None
+
+    def _send(self, t, command, **extra):
+        if command == 'prepare':
+            self.link.prepare(self.percent)
+        else:
+            getattr(self.link, command)()
+        data = dict({'command': command, 'time': t}, **extra)
+        self.emit('premotion', data=data)
+        return data
+
+    def cancel(self, t):
+        if self._prepared_at is None:
+            return None
+        self._prepared_at = None
+        self.counts['cancel'] += 1
+        self._cancels.append(t)
+        return self._send(t, 'cancel')
+
+    def push(self, t, power, decided=False, threshold=None):
+        """
+        Parameters
+        ----------
+        t : float
+            sample time
+        power : float
+            'lift' power, 0 for any other action
+        decided : bool
+            whether a lift was decided on this sample
+        threshold : float, optional
+            the decision engine's threshold, self.threshold by default
+
+        Returns
+        -------
+        dict or None
+            the command sent on this sample, None if none
+        """
+        threshold = self.threshold if threshold is None else threshold
+        if self._last_time is not None and t > self._last_time:
+            dt = t - self._last_time
+            alpha = 1.0 - 2.0 ** (-dt / self.slope_half_life)
+            self.slope += alpha * ((power - self._last_power) / dt - self.slope)
+        self._last_time, self._last_power = t, power
+        self._run = self._run + 1 if power >= self.min_power else 0
+
+        if decided:
+            if self._prepared_at is None:
+                self.counts['commit'] += 1
+                return self._send(t, 'commit', hidden=0.0)
+            # the fingers moved for t - prepared_at, up to percent of the travel
+            hidden = min(self.percent / 100.0, (t - self._prepared_at) / self.travel_seconds) * self.travel_seconds
+            self._prepared_at = None
+            self.counts['prepared_commit'] += 1
+            self.hidden.append(hidden)
+            if len(self.hidden) > self._keep_hidden:
+                del self.hidden[:-self._keep_hidden]
+            return self._send(t, 'commit', hidden=hidden)
+
+        if self._prepared_at is not None:
+            if t - self._prepared_at >= self.timeout or power + self.slope * self.horizon < self.min_power:
+                return self.cancel(t)
+            return None
+
+        if not (self._run >= self.min_samples and power < threshold and self.slope >= self.min_slope
+                and power + self.slope * self.horizon >= threshold):
+            return None
+        while self._cancels and self._cancels[0] < t - 60.0:
+            self._cancels.popleft()
+        if len(self._cancels) >= self.max_cancels_per_minute:
+            self.counts['paused'] += 1
+            return None
+        self._prepared_at = t
+        self.counts['prepare'] += 1
+        return self._send(t, 'prepare', percent=self.percent)
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Upload Hardware/RobotArm/RobotArm.ino, which understands the commands 4 (prepare), 5 (commit) and 6 (cancel)
+#   - Disable the Grab Script node of the Node-RED flow: with --premotion, live.py holds the port and grabs itself
+#   - python live.py --premotion COM3 prepares the arm while the lift power rises and commits on the lift decisions;
+#     --premotion dry only prints the commands. --premotion-horizon and --premotion-percent tune the prediction
+#   - python premotion.py [horizon percent ...] estimates on a synthetic hour of com the travel time hidden
+#     and the wrong guesses per minute
+#
+# -----------------------------------------------------------
+
+def main():
+    from decision import DecisionEngine, make_policy
+    from synthetic import SignalGenerator
+    session = SignalGenerator(seed=8).generate(3600, start_time=0.0)
+    samples = list(zip(session.com_times.tolist(),
+                       np.where(session.com_actions == 'lift', session.com_power, 0.0).tolist()))
+    args = [float(a) for a in sys.argv[1:]]
+    settings = list(zip(args[::2], args[1::2])) or [(0.2, 30), (0.4, 30), (0.4, 50), (0.8, 50)]
+    minutes = (samples[-1][0] - samples[0][0]) / 60.0
+    for horizon, percent in settings:
+        engine = DecisionEngine(policy=make_policy('hysteresis', threshold=0.5, hysteresis=0.2, refractory=2.0))
+        controller = PreMotionController(threshold=0.5, horizon=horizon, percent=percent)
+        start = time.perf_counter()
+        for t, power in samples:
+            decided = engine.push(t, 'lift', power) is not None
+            controller.push(t, power, decided)
+        elapsed = time.perf_counter() - start
+        counts = controller.counts
+        decisions = counts['prepared_commit'] + counts['commit']
+        print('horizon {0:.1f} s, prepare {1:.0f}%: {2} of {3} lifts prepared, {4:.0f} ms of travel hidden on average, '
+              '{5:.2f} wrong guesses per minute, {6:.1f} us per sample'.format(
+                  horizon, percent, counts['prepared_commit'], decisions,
+                  sum(controller.hidden) / max(decisions, 1) * 1000, counts['cancel'] / minutes,
+                  elapsed / len(samples) * 1e6))
+
+if __name__ == '__main__':
+    main()
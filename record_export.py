@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Unattended batch export of Cortex records
+
+ExportOrchestrator queues record ids and exports them one at a time: neither
+the exportRecord response nor the names of the exported files carry the record
+id, and one record can write several CSVs, so every CSV that appears in the
+destination folder while a record is exporting is that record's. The record is
+exported once Cortex has answered and its files have stopped growing, or failed
+after export_timeout seconds. Finished files are converted to the columnar cache
+of export_loader.py in a process pool while the next record exports. Progress
+and per-file throughput are printed as files complete.
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from cortex import Cortex
+from dotenv import load_dotenv
+import export_loader
+
+QUEUED = 'queued'
+EXPORTING = 'exporting'
+CONVERTING = 'converting'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ExportJob():
+    """State of one record in the orchestrator"""
+    def __init__(self, record_id):
+        self.record_id = record_id
+        self.status = QUEUED
+        self.attempts = 0
+        self.paths = []
+        self.size = 0
+        self.responded = False
+        self.converting = 0
+        self.requested_at = None
+        self.exported_at = None
+        self.converted_at = None
+        self.convert_seconds = 0.0
+        self.message = ''
+
+
+class ExportOrchestrator():
+    """
+    A class to export many records one after the other and convert them with a process pool
+
+    Attributes
+    ----------
+    c : Cortex
+        an authorized Cortex with a session
+    folder : str
+        destination folder of the exports
+    workers : int or None
+        conversion processes. Default is one per core
+    export_timeout : float
+        seconds after the request after which a record with no finished export is failed
+
+    Methods
+    -------
+    add(record_ids):
+        To queue record ids for export
+    start():
+        To start exporting. Call it once the session is created
+    wait(timeout):
+        To block until every queued record is done or failed
+    summary():
+        To get counts, bytes and throughput of the batch
+    close():
+        To stop the folder watcher and the process pool
+    """
+    def __init__(self, cortex, folder, stream_types=None, export_format='CSV', version='V2',
+                 workers=None, convert=True, retries=1, poll_interval=0.5, export_timeout=600.0,
+                 auto_queue=False):
+        self.c = cortex
+        self.folder = os.path.abspath(folder)
+        self.stream_types = stream_types or ['EEG', 'MOTION', 'PM', 'BP']
+        self.export_format = export_format
+        self.version = version
+        self.convert = convert and export_format == 'CSV'
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.export_timeout = export_timeout
+
+        self.jobs = {}
+        self._queue = deque()
+        self._current = None
+        self._lock = threading.Lock()
+        self._all_done = threading.Condition(self._lock)
+        self._started = False
+        self._stopping = threading.Event()
+        self._known_files = {}
+        self._pool = ProcessPoolExecutor(max_workers=workers) if self.convert else None
+        self._watcher = None
+        self._start_time = None
+
+        os.makedirs(self.folder, exist_ok=True)
+        for entry in os.scandir(self.folder):
+            # files already in the folder are not results of this batch
+            self._known_files[entry.path] = None
+
+        self.c.bind(export_record_done=self.on_export_record_done)
+        if auto_queue:
+            self.c.bind(stop_record_done=self.on_stop_record_done)
+
+    def add(self, record_ids):
+        """
+        Parameters
+        ----------
+        record_ids : list or str, required
+            record ids to export
+
+        Returns
+        -------
+        None
+        """
+        if isinstance(record_ids, str):
+            record_ids = [record_ids]
+        with self._lock:
+            for record_id in record_ids:
+                if record_id in self.jobs:
+                    continue
+                self.jobs[record_id] = ExportJob(record_id)
+                self._queue.append(record_id)
+        if self._started:
+            self._dispatch()
+
+    def start(self):
+        self._started = True
+        self._start_time = time.perf_counter()
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_folder, name='ExportWatcher', daemon=True)
+            self._watcher.start()
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            if self._current is not None or not self._queue:
+                return
+            job = self.jobs[self._queue.popleft()]
+            job.attempts += 1
+            job.status = EXPORTING
+            job.responded = False
+            job.requested_at = time.perf_counter()
+            self._current = job
+        self.c.export_record(self.folder, self.stream_types, self.export_format, [job.record_id], self.version)
+
+    def _finish_export(self, job, status, message=''):
+        # called with the lock held: the record leaves the folder, the next one can be requested
+        job.status = status
+        job.message = message or job.message
+        job.exported_at = time.perf_counter()
+        if self._current is job:
+            self._current = None
+        if status in (DONE, FAILED):
+            self._report(job)
+        self._all_done.notify_all()
+
+    # callbacks functions
+    def on_stop_record_done(self, *args, **kwargs):
+        record = kwargs.get('data')
+        self.add([record['uuid']])
+
+    def on_export_record_done(self, *args, **kwargs):
+        failures = kwargs.get('failure') or []
+        with self._lock:
+            for failure in failures:
+                job = self.jobs.get(failure['recordId'])
+                if job is None or job.status != EXPORTING:
+                    continue
+                if job.attempts <= self.retries:
+                    job.status = QUEUED
+                    self._queue.append(job.record_id)
+                    if self._current is job:
+                        self._current = None
+                else:
+                    self._finish_export(job, FAILED, failure['message'])
+            for record_id in kwargs.get('data') or []:
+                job = self.jobs.get(record_id)
+                if job is None or job.status != EXPORTING:
+                    continue
+                job.responded = True
+                if self.export_format != 'CSV':
+                    # only CSV files are watched, the response finishes the others
+                    self._finish_export(job, DONE)
+        self._dispatch()
+
+    def _check_current(self, growing):
+        with self._lock:
+            job = self._current
+            if job is None:
+                return
+            if job.responded and job.paths and not growing:
+                self._finish_export(job, CONVERTING if job.converting else FAILED if job.message else DONE)
+            elif time.perf_counter() - job.requested_at > self.export_timeout:
+                self._finish_export(job, FAILED, 'no finished export after {0:.0f} s'.format(self.export_timeout))
+            else:
+                return
+        self._dispatch()
+
+    def _watch_folder(self):
+        while not self._stopping.is_set():
+            finished = []
+            growing = False
+            for entry in os.scandir(self.folder):
+                if not entry.is_file() or not entry.name.lower().endswith('.csv'):
+                    continue
+                if entry.path in self._known_files and self._known_files[entry.path] is None:
+                    continue
+                size = entry.stat().st_size
+                previous = self._known_files.get(entry.path, -1)
+                self._known_files[entry.path] = size
+                if size > 0 and size == previous:
+                    finished.append((entry.path, size))
+                else:
+                    growing = True
+            for path, size in finished:
+                self._known_files[path] = None
+                with self._lock:
+                    job = self._current
+                    if job is None:
+                        print('{0} appeared while no record was exporting, skipped'.format(os.path.basename(path)))
+                        continue
+                    job.paths.append(path)
+                    job.size += size
+                    if self.convert:
+                        job.converting += 1
+                if self.convert:
+                    future = self._pool.submit(export_loader.build_cache, path)
+                    future.add_done_callback(self._make_done_callback(job, path, size, time.perf_counter()))
+            self._check_current(growing)
+            self._stopping.wait(self.poll_interval)
+
+    def _make_done_callback(self, job, path, size, submitted):
+        def on_converted(future):
+            with self._lock:
+                job.converted_at = time.perf_counter()
+                seconds = job.converted_at - submitted
+                job.convert_seconds += seconds
+                job.converting -= 1
+                if future.exception() is not None:
+                    job.message = '{0}: {1}'.format(os.path.basename(path), future.exception())
+                else:
+                    mb = size / 1e6
+                    print('{0}: {1:.1f} MB converted in {2:.2f} s ({3:.1f} MB/s)'.format(
+                        os.path.basename(path), mb, seconds, mb / seconds if seconds > 0 else 0.0))
+                if job.converting == 0 and job.status == CONVERTING:
+                    job.status = FAILED if job.message else DONE
+                    self._report(job)
+                self._all_done.notify_all()
+        return on_converted
+
+    def _report(self, job):
+        finished = sum(1 for j in self.jobs.values() if j.status in (DONE, FAILED))
+        if job.status == FAILED:
+            print('[{0}/{1}] {2} failed: {3}'.format(finished, len(self.jobs), job.record_id, job.message))
+            return
+        print('[{0}/{1}] {2}: {3} file(s), {4:.1f} MB exported in {5:.1f} s'.format(
+            finished, len(self.jobs), job.record_id, len(job.paths), job.size / 1e6,
+            job.exported_at - job.requested_at))
+
+    def wait(self, timeout=None):
+        """
+        Returns
+        -------
+        bool
+            True when every job is done or failed, False on timeout
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self._lock:
+            while any(job.status not in (DONE, FAILED) for job in self.jobs.values()):
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._all_done.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def summary(self):
+        with self._lock:
+            done = [job for job in self.jobs.values() if job.status == DONE]
+            failed = [job for job in self.jobs.values() if job.status == FAILED]
+            total_bytes = sum(job.size for job in done)
+            convert_seconds = sum(job.convert_seconds for job in done)
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        return {
+            'records': len(self.jobs),
+            'done': len(done),
+            'failed': len(failed),
+            'bytes': total_bytes,
+            'elapsed_seconds': elapsed,
+            'convert_cpu_seconds': convert_seconds,
+            'throughput_mb_s': total_bytes / 1e6 / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def close(self):
+        self._stopping.set()
+        if self._watcher is not None:
+            self._watcher.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+class BatchExport():
+    """
+    A class to run an ExportOrchestrator as a standalone app: open a session, export, close.
+
+    Methods
+    -------
+    start(record_ids):
+        To export the records and block until the batch is finished
+    """
+    def __init__(self, app_client_id, app_client_secret, folder, cortex=None, export_timeout=600.0, **kwargs):
+        if cortex is None:
+            cortex = Cortex(app_client_id, app_client_secret, debug_mode=False, **kwargs)
+        self.c = cortex
+        self.orchestrator = ExportOrchestrator(self.c, folder, export_timeout=export_timeout)
+        self.c.bind(create_session_done=self.on_create_session_done)
+        self.c.bind(inform_error=self.on_inform_error)
+
+    def start(self, record_ids, headsetId=''):
+        self.orchestrator.add(record_ids)
+        if headsetId != '':
+            self.c.set_wanted_headset(headsetId)
+        self.c.open()
+        self.orchestrator.close()
+        return self.orchestrator.summary()
+
+    # callbacks functions
+    def on_create_session_done(self, *args, **kwargs):
+        self.orchestrator.start()
+        threading.Thread(target=self._close_when_done, daemon=True).start()
+
+    def _close_when_done(self):
+        # every record ends done or failed, at the latest export_timeout after its request
+        self.orchestrator.wait()
+        self.c.close()
+
+    def on_inform_error(self, *args, **kwargs):
+        print(kwargs.get('error_data'))
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - python record_export.py exports/ RECORD_ID [RECORD_ID ...]
+#     or --ids-file with one record id per line. Records are exported one at a time, use an empty folder
+#     or one that no other export writes to while the batch runs
+#   - Inside another app, bind an ExportOrchestrator to its Cortex with auto_queue=True
+#     so every stopped record is exported and converted
+# RESULT
+#   - exports/<record>.csv plus its columnar cache, see export_loader.py
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and convert many Cortex records')
+    parser.add_argument('folder', help='destination folder')
+    parser.add_argument('record_ids', nargs='*')
+    parser.add_argument('--ids-file', help='file with one record id per line')
+    parser.add_argument('--url', help='Cortex service url')
+    parser.add_argument('--export-timeout', type=float, default=600.0,
+                        help='seconds after which a record with no finished export is failed')
+    args = parser.parse_args()
+
+    record_ids = list(args.record_ids)
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            record_ids += [line.strip() for line in f if line.strip()]
+    if not record_ids:
+        parser.error('no record ids given')
+
+    load_dotenv()
+    kwargs = {'url': args.url} if args.url else {}
+    batch = BatchExport(os.environ['CLIENT_ID'], os.environ['CLIENT_SECRET'], args.folder,
+                        export_timeout=args.export_timeout, **kwargs)
+    result = batch.start(record_ids)
+    print('{0}/{1} records exported and converted, {2} failed, {3:.1f} MB in {4:.1f} s ({5:.1f} MB/s)'.format(
+        result['done'], result['records'], result['failed'], result['bytes'] / 1e6,
+        result['elapsed_seconds'], result['throughput_mb_s']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Record and replay Cortex sessions without a headset
+
+SessionRecorder stores every message the Cortex service sends, with its receive
+time. ReplayCortex is a drop-in Cortex that feeds a recorded session through the
+same on_message path instead of a websocket, so LiveAdvance, Train and anything
+else bound to Cortex events run on it unchanged. Requests sent by the consumers
+are swallowed (and kept in ReplayCortex.sent for inspection).
+"""
+
+import argparse
+import json
+import time
+
+from cortex import Cortex
+
+
+class VirtualClock():
+    """
+    A clock that follows the recording time of a replayed session
+
+    Methods
+    -------
+    time():
+        current recording time in seconds
+    sleep(seconds):
+        return at once; the recorded messages already carry the wait, only advance_to moves the time
+    advance_to(t):
+        move the virtual time forward to t
+    """
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        pass
+
+    def advance_to(self, t):
+        if t > self._now:
+            self._now = t
+
+
+class SessionRecorder():
+    """
+    A class to record the raw messages of a Cortex session into a file.
+    Each line is "<receive time>\\t<message json>".
+
+    Methods
+    -------
+    attach(cortex):
+        To record every message received by a Cortex instance. Call it before cortex.open()
+    write(message, t):
+        To write one message
+    close():
+        To close the file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def attach(self, cortex):
+        on_message = cortex.on_message
+
+        def record_and_handle(*args):
+            self.write(args[1])
+            on_message(*args)
+
+        # Cortex.open() passes self.on_message to the websocket, so an instance attribute wins
+        cortex.on_message = record_and_handle
+
+    def write(self, message, t=None):
+        """
+        Parameters
+        ----------
+        message : str or dict, required
+            the message as received from Cortex
+        t : float, optional
+            receive time. Default is now
+        """
+        if t is None:
+            t = time.time()
+        if not isinstance(message, str) or '\n' in message:
+            message = json.dumps(json.loads(message) if isinstance(message, str) else message,
+                                 separators=(',', ':'))
+        self._file.write('{0:.6f}\t{1}\n'.format(t, message))
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_session(path):
+    """
+    To iterate over a recorded session
+
+    Returns
+    -------
+    generator of (t, message) where message is the raw json string
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            t, message = line.rstrip('\n').split('\t', 1)
+            yield float(t), message
+
+
+class _ReplaySocket():
+    # stands in for websocket.WebSocketApp: requests are kept but never answered
+    def __init__(self, sent):
+        self.sent = sent
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def close(self):
+        pass
+
+
+class ReplayCortex(Cortex):
+    """
+    A Cortex that replays a recorded session instead of connecting to the Cortex service.
+    It emits exactly the events Cortex emits for the recorded messages, with their original data.
+
+    Attributes
+    ----------
+    path : str
+        recorded session file
+    speed : float or None
+        1.0 replays in real time, N replays N times faster, None replays as fast as possible
+    clock : VirtualClock
+        follows the recording time of the last replayed message. It is the Cortex clock, so the waits of
+        Cortex (such as for a connecting headset) do not block and consumers reading cortex.clock.time()
+        get the recording time
+    sent : list
+        requests sent by the consumers during the replay
+
+    Methods
+    -------
+    open():
+        To replay the whole session. Returns when the session ends or close() is called
+    close():
+        To stop the replay
+    """
+    def __init__(self, path, speed=1.0, clock=None, debug_mode=False, **kwargs):
+        super().__init__('replay', 'replay', debug_mode=debug_mode, **kwargs)
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive or None.')
+        self.path = path
+        self.speed = speed
+        self.clock = clock if clock is not None else VirtualClock()
+        self.sent = []
+        self.messages_replayed = 0
+        self._stopped = False
+
+    def open(self):
+        self._stopped = False
+        self.ws = _ReplaySocket(self.sent)
+        self.on_open(self.ws)
+
+        wall_start = time.perf_counter()
+        first_t = None
+        for t, message in read_session(self.path):
+            if self._stopped:
+                break
+            if first_t is None:
+                first_t = t
+            if self.speed is not None:
+                delay = (t - first_t) / self.speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.clock.advance_to(t)
+            self.on_message(self.ws, message)
+            self.messages_replayed += 1
+
+        self.on_close(self.ws, 'replay finished after {0} messages'.format(self.messages_replayed))
+
+    def close(self):
+        self._stopped = True
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Record a session while running live.py or train.py:
+#         recorder = SessionRecorder('session.log')
+#         recorder.attach(l.c)     # before l.start(...)
+#   - Replay it through the unchanged consumers:
+#         l = LiveAdvance('replay', 'replay', cortex=ReplayCortex('session.log', speed=None))
+#         l.start('TRAW spins')
+#   - Or from the command line:
+#         python replay.py session.log --speed 10
+#   - python replay.py session.log --speed 0 --pyramid also builds session.log.pyramid for decimation.load_pyramid
+# RESULT
+#   - the consumers receive the recorded events, at the chosen speed
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded Cortex session through live.py')
+    parser.add_argument('session', help='recorded session file')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('--profile', default='TRAW spins', help='profile name used in the recording')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='also build the min/max/mean pyramids of the recorded streams in <session>.pyramid')
+    args = parser.parse_args()
+
+    from live import LiveAdvance
+
+    replay = ReplayCortex(args.session, speed=args.speed or None)
+    pyramid = None
+    if args.pyramid:
+        from decimation import PyramidRecorder
+        pyramid = PyramidRecorder(args.session)
+        pyramid.bind(replay)
+    l = LiveAdvance('replay', 'replay', cortex=replay)
+    start = time.perf_counter()
+    l.start(args.profile)
+    elapsed = time.perf_counter() - start
+    print('Replayed {0} messages in {1:.3f} s'.format(replay.messages_replayed, elapsed))
+    if pyramid is not None:
+        pyramid.close()
+        print('Stream pyramids saved in {0}'.format(pyramid.folder))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Fixed-capacity ring buffer of timestamped samples
+
+Every sample is written twice, at i and i + capacity, so the last n samples are
+always one contiguous slice: windows are returned as views, without copies.
+"""
+
+import numpy as np
+
+
+class TimedRingBuffer():
+    """
+    A ring buffer of (time, row) samples
+
+    Attributes
+    ----------
+    capacity : int
+        maximum number of samples kept
+    width : int
+        number of values per sample
+    count : int
+        number of samples appended since creation
+
+    Methods
+    -------
+    append(t, row):
+        To append one sample
+    extend(times, rows):
+        To append a block of samples
+    view(n):
+        To get (times, values) views of the last n samples
+    since(t):
+        To get (times, values) views of the samples after t
+    latest_time():
+        Time of the last sample, -inf when empty
+    """
+    def __init__(self, capacity, width, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1.')
+        self.capacity = capacity
+        self.width = width
+        self.count = 0
+        self._times = np.full(2 * capacity, -np.inf)
+        self._values = np.zeros((2 * capacity, width), dtype=dtype)
+        self._head = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, row):
+        head = self._head
+        self._times[head] = t
+        self._times[head + self.capacity] = t
+        self._values[head] = row
+        self._values[head + self.capacity] = row
+        self._head = (head + 1) % self.capacity
+        self.count += 1
+
+    def extend(self, times, rows):
+        times = np.asarray(times, dtype=np.float64)
+        rows = np.asarray(rows).reshape(len(times), self.width)
+        appended = len(times)
+        if appended > self.capacity:
+            # only the last capacity samples are kept, but all of them count
+            times = times[-self.capacity:]
+            rows = rows[-self.capacity:]
+        n = len(times)
+        idx = (self._head + np.arange(n)) % self.capacity
+        self._times[idx] = times
+        self._times[idx + self.capacity] = times
+        self._values[idx] = rows
+        self._values[idx + self.capacity] = rows
+        self._head = (self._head + n) % self.capacity
+        self.count += appended
+
+    def view(self, n=None):
+        """
+        Parameters
+        ----------
+        n : int, optional
+            number of samples. Default is every sample kept
+
+        Returns
+        -------
+        tuple
+            (times, values) read-only views, oldest first
+        """
+        size = len(self)
+        n = size if n is None else min(n, size)
+        stop = self._head + self.capacity
+        times = self._times[stop - n:stop]
+        values = self._values[stop - n:stop]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        return times, values
+
+    def since(self, t):
+        times, values = self.view()
+        start = np.searchsorted(times, t, side='right')
+        return times[start:], values[start:]
+
+    def latest_time(self):
+        if self.count == 0:
+            return -np.inf
+        return self._times[self._head + self.capacity - 1]
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Closed-loop tuning of the mental command sensitivity in one session
+
+Instead of editing the sensitivities in live.py and going through the whole
+handshake again, SensitivityOptimizer runs short guided blocks: the user rests
+for neutral_seconds, then imagines the action for action_seconds. Every block
+is scored from the live com stream, then the next sensitivity is set with
+mentalCommandActionSensitivity in the same session:
+
+    reward = hit rate - false_weight * false rate
+
+where the hit rate is the share of the action phase with the action's power
+above the threshold, and the false rate the same share during the neutral
+phase. The first settle seconds of each phase are left out, the time it takes
+to switch.
+
+The sensitivities 1 to 10 are the arms of a bandit. A gaussian process over
+the sensitivity shares what a block taught about one value with its
+neighbours, and the next block tries the value with the highest upper
+confidence bound. The search stops once that value is also the best on
+average and was tried confirm times, or after max_blocks. The best value is set
+and the profile saved with setupProfile 'save'. With the defaults this takes
+about two minutes, during which LiveAdvance decides no lift and prepares no
+pre-motion: the com samples belong to the blocks.
+"""
+
+import argparse
+import os
+
+import numpy as np
+from pydispatch import Dispatcher
+
+from adjust_sensitivity import get_current_threshold
+
+SENSITIVITIES = np.arange(1, 11)
+
+
+class GaussianProcessBandit():
+    """
+    Upper confidence bound bandit over arms on a line, rewards smoothed by a gaussian process
+
+    Attributes
+    ----------
+    arms : ndarray
+        the arm values
+    length_scale, signal, noise : float
+        squared exponential kernel over the arm values, prior standard deviation of the reward
+        and standard deviation of a measured reward
+    beta : float
+        width of the confidence bound, in posterior standard deviations
+    observed : list
+        (arm, reward) of every measure
+
+    Methods
+    -------
+    observe(arm, reward):
+        To add a measure
+    posterior():
+        To get the posterior mean and standard deviation of every arm
+    suggest():
+        To get the arm with the highest upper confidence bound
+    best():
+        To get the arm with the highest posterior mean
+    """
+    def __init__(self, arms=SENSITIVITIES, length_scale=2.0, signal=0.5, noise=0.15, beta=2.0):
+        self.arms = np.asarray(arms, dtype=float)
+        self.length_scale = length_scale
+        self.signal = signal
+        self.noise = noise
+        self.beta = beta
+        self.observed = []
+
+    def _kernel(self, a, b):
+        return self.signal ** 2 * np.exp(-0.5 * ((a[:, None] - b[None, :]) / self.length_scale) ** 2)
+
+    def observe(self, arm, reward):
+        self.observed.append((float(arm), float(reward)))
+
+    def posterior(self):
+        if not self.observed:
+            return np.zeros(len(self.arms)), np.full(len(self.arms), self.signal)
+        x, y = (np.array(v) for v in zip(*self.observed))
+        gram = self._kernel(x, x) + self.noise ** 2 * np.eye(len(x))
+        cross = self._kernel(self.arms, x)
+        mean = cross @ np.linalg.solve(gram, y)
+        var = self.signal ** 2 - np.einsum('ij,ji->i', cross, np.linalg.solve(gram, cross.T))
+        return mean, np.sqrt(np.maximum(var, 0.0))
+
+    def suggest(self):
+        mean, std = self.posterior()
+        return self.arms[int(np.argmax(mean + self.beta * std))]
+
+    def best(self):
+        mean, _ = self.posterior()
+        return self.arms[int(np.argmax(mean))]
+
+    def tries(self, arm):
+        return sum(1 for a, _ in self.observed if a == arm)
+
+
+class SensitivityOptimizer(Dispatcher):
+    """
+    A class to tune the sensitivity of one mental command action with guided blocks
+
+    Starts when the sensitivity of the loaded profile is read (get_mental_command_action_sensitivity,
+    as LiveAdvance does once the profile is loaded), and saves the profile with the best value.
+
+    Attributes
+    ----------
+    profile_name : str
+        the profile tuned and saved
+    action : str
+        the action tuned, 'lift' by default
+    threshold : float
+        power above which a com sample counts for the action
+    neutral_seconds, action_seconds, settle : float
+        length of the phases of a block, and the beginning of each phase left out
+    false_weight : float
+        cost of the false rate against the hit rate
+    max_blocks, confirm : int
+        most blocks run, and tries of the best value that end the search early
+    bandit : GaussianProcessBandit
+        the search over the sensitivities
+    blocks : list
+        {'sensitivity', 'reward', 'hit_rate', 'false_rate', 'false_per_minute', 'latency'} of every block
+    values : list or None
+        sensitivities of all the actions currently set
+    state : str
+        'idle', 'setting', 'neutral', 'action', 'saving' or 'done'
+    active : bool
+        True from the first block until the profile is saved, while the com samples belong to the blocks
+
+    Methods
+    -------
+    start(values):
+        To start from the current sensitivities, called on the first sensitivity read
+    push(t, action, power):
+        To feed one com sample
+    """
+    _events_ = ['sensitivity_block', 'sensitivity_done']
+
+    def __init__(self, cortex_client, profile_name, action='lift', threshold=None, neutral_seconds=12.0,
+                 action_seconds=8.0, settle=1.5, false_weight=2.0, max_blocks=6, confirm=2, bandit=None):
+        self.profile_name = profile_name
+        self.action = action
+        self.threshold = threshold if threshold is not None else get_current_threshold()
+        self.neutral_seconds = neutral_seconds
+        self.action_seconds = action_seconds
+        self.settle = settle
+        self.false_weight = false_weight
+        self.max_blocks = max_blocks
+        self.confirm = confirm
+        self.bandit = bandit if bandit is not None else GaussianProcessBandit()
+        self.blocks = []
+        self.values = None
+        self.state = 'idle'
+        self._index = 0
+        self._sensitivity = None
+        self._phase_start = None
+        self._counts = None
+        self._above = False
+        self.c = cortex_client
+        cortex_client.bind(get_mc_active_action_done=self.on_get_mc_active_action_done)
+        cortex_client.bind(mc_action_sensitivity_done=self.on_mc_action_sensitivity_done)
+        cortex_client.bind(new_com_data=self.on_new_com_data)
+
+    @property
+    def active(self):
+        return self.state not in ('idle', 'done')
+
+    def start(self, values):
+        self.values = list(values)
+        self.blocks = []
+        # LiveAdvance subscribes com once the profile is saved, the blocks need it before
+        self.c.sub_request(['com'])
+        self._set(int(self.values[self._index]))
+
+    def _set(self, sensitivity, state='setting'):
+        self._sensitivity = sensitivity
+        self.values[self._index] = sensitivity
+        self.state = state
+        self._phase_start = None
+        print('Sensitivity of {0}: {1} {2}'.format(self.action, sensitivity, self.values))
+        self.c.set_mental_command_action_sensitivity(self.profile_name, self.values)
+
+    def _begin(self, state, t):
+        self.state = state
+        self._phase_start = t
+        self._above = False
+        if state == 'neutral':
+            self._counts = {'neutral': {'samples': 0, 'above': 0, 'crossings': 0},
+                            'action': {'samples': 0, 'above': 0, 'crossings': 0}, 'first': None}
+            print('>>> Block {0}: relax, think of nothing for {1:.0f} s'.format(len(self.blocks) + 1, self.neutral_seconds))
+        else:
+            print('>>> Block {0}: imagine {1} for {2:.0f} s'.format(len(self.blocks) + 1, self.action.upper(),
+                                                                self.action_seconds))
+
+    def _score(self):
+        neutral, imagery = self._counts['neutral'], self._counts['action']
+        hit_rate = imagery['above'] / imagery['samples'] if imagery['samples'] else 0.0
+        false_rate = neutral['above'] / neutral['samples'] if neutral['samples'] else 0.0
+        first = self._counts['first']
+        block = {'sensitivity': self._sensitivity, 'reward': hit_rate - self.false_weight * false_rate,
+                 'hit_rate': hit_rate, 'false_rate': false_rate,
+                 'false_per_minute': neutral['crossings'] / max(self.neutral_seconds - self.settle, 1e-9) * 60.0,
+                 'latency': first}
+        self.blocks.append(block)
+        self.bandit.observe(self._sensitivity, block['reward'])
+        print('Sensitivity {0}: {1:.0%} of the {2} above {3:.2f}, {4:.0%} of the rest, reward {5:.2f}'.format(
+            self._sensitivity, hit_rate, self.action, self.threshold, false_rate, block['reward']))
+        self.emit('sensitivity_block', data=block)
+
+    def _next(self):
+        suggested = int(self.bandit.suggest())
+        best = int(self.bandit.best())
+        if len(self.blocks) >= self.max_blocks or (suggested == best and self.bandit.tries(best) >= self.confirm):
+            mean, std = self.bandit.posterior()
+            arm = np.flatnonzero(self.bandit.arms == best)[0]
+            print('Best sensitivity of {0}: {1} (reward {2:.2f} +- {3:.2f}) after {4} blocks'.format(
+                self.action, best, mean[arm], std[arm], len(self.blocks)))
+            self._set(best, state='saving')
+        else:
+            self._set(suggested)
+
+    def push(self, t, action, power):
+        if self.state not in ('setting', 'neutral', 'action'):
+            return
+        if self._phase_start is None:
+            # first sample after the new sensitivity is acknowledged
+            if self.state == 'neutral':
+                self._begin('neutral', t)
+            return
+        elapsed = t - self._phase_start
+        length = self.neutral_seconds if self.state == 'neutral' else self.action_seconds
+        if elapsed >= length:
+            if self.state == 'neutral':
+                self._begin('action', t)
+            else:
+                self._score()
+                self._next()
+            return
+        if elapsed < self.settle:
+            return
+        above = action == self.action and power > self.threshold
+        counts = self._counts[self.state]
+        counts['samples'] += 1
+        counts['above'] += above
+        counts['crossings'] += above and not self._above
+        self._above = above
+        if above and self.state == 'action' and self._counts['first'] is None:
+            self._counts['first'] = elapsed
+
+    # callbacks functions
+    def on_get_mc_active_action_done(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if isinstance(data, list):
+            actions = [a for a in data if a != 'neutral']
+            self._index = actions.index(self.action) if self.action in actions else 0
+
+    def on_mc_action_sensitivity_done(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if isinstance(data, list):
+            if self.state == 'idle':
+                self.start(data)
+        elif self.state == 'setting':
+            self.state = 'neutral'
+        elif self.state == 'saving':
+            self.state = 'done'
+            self.c.setup_profile(self.profile_name, 'save')
+            self.emit('sensitivity_done', data={'values': list(self.values), 'sensitivity': self._sensitivity,
+                                                'blocks': list(self.blocks)})
+
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push(data['time'], data.get('action'), data.get('power', 0))
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Please ensure that you have completed the training of lift (train.py) on your profile
+#   - python sensitivity_optimizer.py --profile 'TRAW spins' loads the profile like live.py, then guides
+#     about two minutes of relax / imagine LIFT blocks, setting a new sensitivity between blocks, and saves the profile
+#     with the best one. Live mode starts right after
+#   - python live.py --optimize-sensitivity does the same instead of setting the fixed sensitivities
+#
+# -----------------------------------------------------------
+
+def main():
+    from dotenv import load_dotenv
+    from live import LiveAdvance
+    parser = argparse.ArgumentParser(description='Tune the mental command sensitivity with guided blocks')
+    parser.add_argument('--profile', default='TRAW spins', help='trained profile to tune and save')
+    parser.add_argument('--action', default='lift', help='action whose sensitivity is tuned')
+    parser.add_argument('--blocks', type=int, default=6, help='most blocks run')
+    parser.add_argument('--neutral-seconds', type=float, default=12.0, help='relax phase of a block')
+    parser.add_argument('--action-seconds', type=float, default=8.0, help='imagery phase of a block')
+    parser.add_argument('--false-weight', type=float, default=2.0, help='cost of power above the threshold during rest')
+    args = parser.parse_args()
+
+    load_dotenv()
+    l = LiveAdvance(os.environ['CLIENT_ID'], os.environ['CLIENT_SECRET'])
+    l.sensitivity_optimizer = SensitivityOptimizer(
+        l.c, args.profile, action=args.action, threshold=l.decision.threshold, neutral_seconds=args.neutral_seconds,
+        action_seconds=args.action_seconds, false_weight=args.false_weight, max_blocks=args.blocks)
+    l.start(args.profile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Sliding-window band power of raw EEG
+
+BandPowerEstimator is fed from new_eeg_data and, every `hop` samples, computes
+the periodogram of the newest `segment` samples of every channel: mean removal,
+precomputed Hann window, one real FFT for all channels, and one product with a
+precomputed (frequency x band) weight matrix. Band power is linear in the
+periodogram, so the Welch average over the last `averages` overlapping segments
+is a running sum of per-hop band powers: every hop costs a single new FFT and
+the overlapping segments are never transformed twice. When a block brings
+several hops, their segments are gathered through one strided view and
+transformed together.
+"""
+
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from pydispatch import Dispatcher
+
+import cortex
+from ring_buffer import TimedRingBuffer
+
+DEFAULT_BANDS = {'mu': (8.0, 12.0), 'beta': (13.0, 30.0)}
+
+
+class BandPowerEstimator(cortex.CortexConsumer, Dispatcher):
+    """
+    A class to estimate band power of every EEG channel on a sliding window
+
+    Attributes
+    ----------
+    rate : float
+        sample rate in Hz
+    segment : int
+        samples per FFT segment
+    hop : int
+        samples between two estimates
+    averages : int
+        segments averaged by Welch's method; the estimate spans segment + (averages - 1) * hop samples
+    bands : dict
+        band name -> (low, high) in Hz, inclusive
+    latest : dict or None
+        the last estimate, as emitted
+
+    Methods
+    -------
+    bind_cortex(cortex):
+        To feed the estimator from new_eeg_data
+    push(times, values):
+        To feed a block of samples of shape (n_samples, n_channels)
+    """
+    _events_ = ['new_band_power']
+
+    def __init__(self, cortex_client=None, rate=128.0, channels=14, segment=128, hop=16, averages=4,
+                 bands=None, max_block=1024):
+        self.rate = float(rate)
+        self.channels = channels
+        self.segment = segment
+        self.hop = hop
+        self.averages = averages
+        self.bands = dict(bands or DEFAULT_BANDS)
+        self.band_names = list(self.bands)
+        self.channel_names = list(cortex.EEG_CHANNELS[:channels])
+        self.latest = None
+        self._max_block = max_block
+        self._buffer = TimedRingBuffer(segment + max_block, channels)
+        self._next_end = segment
+        self._history = np.zeros((0, channels, len(self.bands)))
+        self._eeg_columns = cortex.EegColumns(channels)
+
+        self._window = np.hanning(segment + 2)[1:-1]
+        freqs = np.fft.rfftfreq(segment, 1.0 / self.rate)
+        # one-sided power spectral density scaling, integrated over each band
+        scale = np.full(len(freqs), 2.0 / (self.rate * np.sum(self._window ** 2)))
+        scale[0] /= 2.0
+        if segment % 2 == 0:
+            scale[-1] /= 2.0
+        df = self.rate / segment
+        self._weights = np.zeros((len(freqs), len(self.bands)))
+        for b, (low, high) in enumerate(self.bands.values()):
+            self._weights[(freqs >= low) & (freqs <= high), b] = df
+        self._weights *= scale[:, None]
+        if cortex_client is not None:
+            self.bind_cortex(cortex_client)
+
+    def bind_cortex(self, cortex_client):
+        cortex_client.bind(new_eeg_data=self.on_new_eeg_data)
+        cortex_client.bind(new_data_labels=self.on_new_data_labels)
+
+    def push(self, times, values):
+        """
+        Parameters
+        ----------
+        times : array-like, required
+            sample times
+        values : array-like, required
+            samples of shape (n_samples, channels)
+
+        Returns
+        -------
+        None
+        """
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), self.channels)
+        for start in range(0, len(times), self._max_block):
+            self._buffer.extend(times[start:start + self._max_block], values[start:start + self._max_block])
+            self._update()
+
+    def push_sample(self, t, row):
+        self._buffer.append(t, row)
+        if self._buffer.count >= self._next_end:
+            self._update()
+
+    def _update(self):
+        count = self._buffer.count
+        if count < self._next_end:
+            return
+        ends = np.arange(self._next_end, count + 1, self.hop)
+        self._next_end = ends[-1] + self.hop
+        times, values = self._buffer.view()
+        first = count - len(times)
+        starts = ends - self.segment - first
+
+        # (n_hops, segment, channels) view of the segments, transformed together
+        segments = as_strided(values, (len(values) - self.segment + 1, self.segment, self.channels),
+                              (values.strides[0],) + values.strides, writeable=False)[starts]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        spectrum = np.fft.rfft(segments * self._window[:, None], axis=1)
+        periodogram = spectrum.real ** 2 + spectrum.imag ** 2
+        band_power = np.einsum('hfc,fb->hcb', periodogram, self._weights)
+
+        # Welch average over the last `averages` segments as a moving sum
+        history = np.concatenate([self._history, band_power])
+        sums = np.cumsum(history, axis=0)
+        sums[self.averages:] = sums[self.averages:] - sums[:-self.averages]
+        counts = np.minimum(np.arange(1, len(history) + 1), self.averages)
+        averaged = (sums / counts[:, None, None])[len(self._history):]
+        self._history = history[-(self.averages - 1):] if self.averages > 1 else history[:0]
+
+        for i, end in enumerate(ends):
+            self.latest = {'time': times[end - first - 1], 'power': averaged[i],
+                           'bands': self.band_names, 'channels': self.channel_names}
+            for b, name in enumerate(self.band_names):
+                self.latest[name] = averaged[i][:, b]
+            self.emit('new_band_power', data=self.latest)
+
+    # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['streamName'] != 'eeg':
+            return
+        if self._eeg_columns.update(data['labels']):
+            self.channel_names = self._eeg_columns.names
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push_sample(data['time'], self._eeg_columns.select(data['eeg']))
+
+
+def band_power(times, values, cache=None, **params):
+    """
+    To estimate the band power of a whole recording offline, hop by hop like BandPowerEstimator
+
+    Parameters
+    ----------
+    times : array-like, required
+        sample times
+    values : array-like, required
+        samples of shape (n_samples, channels)
+    cache : feature_cache.FeatureCache, optional
+        with a cache, the same samples are transformed once with the same parameters
+    params :
+        rate, segment, hop, averages and bands of BandPowerEstimator
+
+    Returns
+    -------
+    dict
+        'times' of the estimates and 'power' of shape (n_estimates, channels, bands), bands in their order
+    """
+    times = np.asarray(times, dtype=np.float64).reshape(-1)
+    values = np.asarray(values, dtype=np.float64).reshape(len(times), -1)
+    if cache is not None:
+        return cache.stage('spectral.band_power', version=1)(band_power)(times, values, **params)
+    estimator = BandPowerEstimator(channels=values.shape[1], **params)
+    estimates = []
+
+    def collect(*args, **kwargs):
+        estimates.append(kwargs.get('data'))
+    estimator.bind(new_band_power=collect)
+    estimator.push(times, values)
+    return {'times': np.array([e['time'] for e in estimates], dtype=np.float64),
+            'power': np.array([e['power'] for e in estimates], dtype=np.float64).reshape(
+                len(estimates), values.shape[1], len(estimator.bands))}
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - estimator = BandPowerEstimator(cortex, rate=128, hop=16)
+#     estimator.bind(new_band_power=self.on_new_band_power), then subscribe 'eeg'
+#   - data['mu'] and data['beta'] are arrays with one power (uV^2) per channel, data['channels'] their names
+#   - A whole recording, computed once with a feature_cache.FeatureCache:
+#     result = band_power(times, eeg, cache=FeatureCache(), rate=128, hop=16)
+#   - python spectral.py [rate] benchmarks the cost per sample and channel
+#
+# -----------------------------------------------------------
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 256.0
+    channels = 14
+    seconds = 120
+    n = int(rate * seconds)
+    rng = np.random.default_rng(0)
+    t = np.arange(n) / rate
+    values = rng.standard_normal((n, channels)) * 5.0 + 10.0 * np.sin(2 * np.pi * 10.0 * t)[:, None]
+    segment = int(rate)
+
+    estimator = BandPowerEstimator(rate=rate, channels=channels, segment=segment, hop=segment // 8)
+    start = time.perf_counter()
+    for i in range(n):
+        estimator.push_sample(t[i], values[i])
+    per_sample = time.perf_counter() - start
+
+    estimator = BandPowerEstimator(rate=rate, channels=channels, segment=segment, hop=segment // 8)
+    start = time.perf_counter()
+    estimator.push(t, values)
+    block = time.perf_counter() - start
+
+    print('{0:.0f} Hz, {1} channels, segment {2}, hop {3}, {4} averages'.format(
+        rate, channels, segment, estimator.hop, estimator.averages))
+    print('sample by sample: {0:.2f} us per sample per channel ({1:.2f}% of one core in real time)'.format(
+        per_sample / n / channels * 1e6, per_sample / seconds * 100))
+    print('block:            {0:.3f} us per sample per channel'.format(block / n / channels * 1e6))
+    latest = estimator.latest
+    print('10 Hz test tone: mu {0:.1f} uV^2, beta {1:.1f} uV^2 on {2}'.format(
+        latest['mu'][0], latest['beta'][0], latest['channels'][0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Multi-rate stream aligner
+
+StreamAligner buffers the Cortex data streams, which arrive at different rates
+(eeg 128/256 Hz, mot 64 Hz, pow/met/com 2-8 Hz, dev 2 Hz), and emits frames of
+every stream resampled on one clock. The clock is either the samples of one
+stream or a fixed rate. Values are taken with sample-and-hold or linear
+interpolation; a clock tick is emitted once every stream has data at or after it,
+or once it is older than max_latency so a slow or silent stream cannot hold the
+output back. Ticks are resolved in blocks: one searchsorted and one gather per
+stream for the whole block.
+"""
+
+import numpy as np
+from pydispatch import Dispatcher
+
+from ring_buffer import TimedRingBuffer
+
+HOLD = 'hold'
+LINEAR = 'linear'
+
+STREAMS = ('eeg', 'mot', 'dev', 'met', 'pow', 'com')
+
+# streams with categorical values are never interpolated
+_HOLD_ONLY = ('com', 'dev')
+
+
+class AlignedFrame():
+    """
+    A block of synchronized samples
+
+    Attributes
+    ----------
+    times : numpy.ndarray
+        clock ticks, shape (n,)
+    values : dict
+        stream name -> array of shape (n, width), NaN before the first sample of the stream
+    labels : dict
+        stream name -> column labels
+    actions : list
+        mental command names; the com 'action' column holds indexes into this list
+    """
+    def __init__(self, times, values, labels, actions):
+        self.times = times
+        self.values = values
+        self.labels = labels
+        self.actions = actions
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, stream):
+        return self.values[stream]
+
+    def column(self, stream, label):
+        return self.values[stream][:, self.labels[stream].index(label)]
+
+
+class StreamAligner(Dispatcher):
+    """
+    A class to join Cortex streams into synchronized frames
+
+    Attributes
+    ----------
+    streams : tuple
+        aligned stream names
+    clock : str or float
+        name of the stream whose sample times are the clock, or a rate in Hz
+    max_latency : float
+        seconds a tick waits for late streams before they are held
+    block_size : int
+        minimum number of ticks per emitted frame
+
+    Methods
+    -------
+    bind_cortex(cortex):
+        To feed the aligner from the stream events of a Cortex
+    push(stream, t, row):
+        To feed one sample without a Cortex
+    flush():
+        To emit every pending tick without waiting
+    """
+    _events_ = ['new_aligned_frame']
+
+    def __init__(self, cortex=None, streams=('eeg', 'mot', 'pow', 'met', 'com'), clock='eeg',
+                 method=HOLD, max_latency=0.25, block_size=1, buffer_seconds=10.0, max_rate=256):
+        self.streams = tuple(streams)
+        for stream in self.streams:
+            if stream not in STREAMS:
+                raise ValueError('Unknown stream {0}.'.format(stream))
+        if isinstance(clock, str) and clock not in self.streams:
+            raise ValueError('The clock stream {0} is not aligned.'.format(clock))
+        self.clock = clock
+        self.max_latency = max_latency
+        self.block_size = block_size
+        self.methods = {}
+        for stream in self.streams:
+            m = method.get(stream, HOLD) if isinstance(method, dict) else method
+            self.methods[stream] = HOLD if stream in _HOLD_ONLY else m
+        self.labels = {'com': ['action', 'power']}
+        self.actions = []
+        self._capacity = int(buffer_seconds * max_rate)
+        self._buffers = {}
+        self._last_tick = -np.inf
+        self._next_tick = None
+        self._now = -np.inf
+        if cortex is not None:
+            self.bind_cortex(cortex)
+
+    def bind_cortex(self, cortex):
+        handlers = {'new_data_labels': self.on_new_data_labels}
+        for stream in self.streams:
+            handlers['new_{0}_data'.format(stream)] = getattr(self, 'on_new_{0}_data'.format(stream))
+        cortex.bind(**handlers)
+
+    def push(self, stream, t, row):
+        """
+        Parameters
+        ----------
+        stream : str, required
+            stream name
+        t : float, required
+            sample time
+        row : list, required
+            numeric values of the sample
+        """
+        buffer = self._buffers.get(stream)
+        if buffer is None:
+            buffer = TimedRingBuffer(self._capacity, len(row))
+            self._buffers[stream] = buffer
+        if t <= buffer.latest_time():
+            # out of order or duplicated sample
+            return
+        buffer.append(t, row)
+        if t > self._now:
+            self._now = t
+        if self.clock == stream or not isinstance(self.clock, str):
+            self._advance()
+
+    def flush(self):
+        self._advance(force=True)
+
+    def _ticks(self):
+        # pending clock ticks, oldest first
+        if isinstance(self.clock, str):
+            buffer = self._buffers.get(self.clock)
+            if buffer is None:
+                return np.empty(0)
+            # copied: the frame outlives the ring buffer slot
+            return buffer.since(self._last_tick)[0].copy()
+        if self._next_tick is None:
+            self._next_tick = np.ceil(self._now * self.clock) / self.clock
+        n = int(np.floor((self._now - self._next_tick) * self.clock + 1e-9)) + 1
+        if n <= 0:
+            return np.empty(0)
+        return self._next_tick + np.arange(n) / self.clock
+
+    def _advance(self, force=False):
+        ticks = self._ticks()
+        if len(ticks) == 0:
+            return
+        if not force:
+            # every stream must have reached the tick, unless the tick is older than max_latency
+            ready_until = min(self._buffers[s].latest_time() if s in self._buffers else -np.inf
+                              for s in self.streams)
+            ready_until = max(ready_until, self._now - self.max_latency)
+            ticks = ticks[:np.searchsorted(ticks, ready_until, side='right')]
+            if len(ticks) < self.block_size:
+                return
+        if len(ticks) == 0:
+            return
+        values = {stream: self._resample(stream, ticks) for stream in self.streams}
+        self._last_tick = ticks[-1]
+        if not isinstance(self.clock, str):
+            self._next_tick = ticks[-1] + 1.0 / self.clock
+        self.emit('new_aligned_frame', data=AlignedFrame(ticks, values, self.labels, self.actions))
+
+    def _resample(self, stream, ticks):
+        buffer = self._buffers.get(stream)
+        if buffer is None:
+            width = len(self.labels.get(stream, []))
+            return np.full((len(ticks), width), np.nan)
+        times, values = buffer.view()
+        idx = np.searchsorted(times, ticks, side='right') - 1
+        before = idx < 0
+        held = values[np.maximum(idx, 0)]
+        if self.methods[stream] == LINEAR and len(times) > 1:
+            nxt = np.minimum(idx + 1, len(times) - 1)
+            span = times[nxt] - times[np.maximum(idx, 0)]
+            inside = (~before) & (nxt > idx) & (span > 0)
+            weight = np.zeros(len(ticks))
+            weight[inside] = (ticks[inside] - times[idx[inside]]) / span[inside]
+            held = held + weight[:, None] * (values[nxt] - held)
+        held[before] = np.nan
+        return held
+
+    # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        stream = data['streamName']
+        if stream == 'dev':
+            self.labels[stream] = ['signal', 'batteryPercent'] + list(data['labels'])
+        elif stream in STREAMS:
+            self.labels[stream] = list(data['labels'])
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push('eeg', data['time'], data['eeg'])
+
+    def on_new_mot_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push('mot', data['time'], data['mot'])
+
+    def on_new_pow_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.push('pow', data['time'], data['pow'])
+
+    def on_new_met_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        # booleans become 0/1 and missing values NaN
+        self.push('met', data['time'], np.asarray(data['met'], dtype=np.float64))
+
+    def on_new_dev_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        row = [data['signal'], data['batteryPercent']] + list(data['dev'])
+        self.push('dev', data['time'], np.asarray(row, dtype=np.float64))
+
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        action = data['action']
+        if action not in self.actions:
+            self.actions.append(action)
+        self.push('com', data['time'], [self.actions.index(action), data['power']])
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - aligner = StreamAligner(cortex, streams=('eeg', 'pow', 'com'), clock='eeg')
+#     aligner.bind(new_aligned_frame=self.on_new_aligned_frame)
+#     then subscribe to the same streams with cortex.sub_request(...)
+#   - clock=32.0 resamples every stream at 32 Hz instead of following the eeg samples
+#   - frame['eeg'], frame.column('com', 'power'), frame.actions
+#
+# -----------------------------------------------------------
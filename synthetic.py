@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Synthetic EEG and mental-command data with known ground truth
+
+Generates, fully vectorized, EPOC-like EEG (1/f background, mu and beta rhythms
+that desynchronize on motor channels during 'lift' intervals, blinks on the
+frontal channels), the matching pow, mot and dev streams and a com stream whose
+action and power follow the ground truth with a known detection delay. The
+result can be turned into Cortex stream messages, written as a replayable
+session (see replay.py) or served by the mock Cortex service (see mock_cortex.py).
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import cortex
+from replay import SessionRecorder
+
+EEG_OFFSET_UV = 4200.0
+EEG_LSB_UV = 0.128205128
+
+# how strongly each EPOC channel carries the motor rhythms that desynchronize on 'lift'
+MOTOR_WEIGHTS = {'FC5': 1.0, 'FC6': 1.0, 'F3': 0.6, 'F4': 0.6, 'T7': 0.4, 'T8': 0.4}
+# how strongly each EPOC channel sees a blink
+BLINK_WEIGHTS = {'AF3': 1.0, 'AF4': 1.0, 'F7': 0.5, 'F8': 0.5, 'F3': 0.3, 'F4': 0.3}
+
+
+def channel_names(channels):
+    """EPOC channel names for up to 14 channels, CH15, CH16, ... after that"""
+    names = list(cortex.EEG_CHANNELS[:channels])
+    names += ['CH{0}'.format(i + 1) for i in range(len(names), channels)]
+    return names
+
+
+def _shaped_noise(rng, n, channels, rate, gain):
+    # white noise shaped in the frequency domain by gain(freqs), normalized to unit std
+    spectrum = np.fft.rfft(rng.standard_normal((n, channels)), axis=0)
+    freqs = np.fft.rfftfreq(n, 1.0 / rate)
+    spectrum *= gain(freqs)[:, None]
+    noise = np.fft.irfft(spectrum, n, axis=0)
+    noise /= noise.std(axis=0, keepdims=True) + 1e-12
+    return noise
+
+
+def _in_intervals(t, onsets, offsets):
+    # boolean mask of the times that fall in one of the sorted [onset, offset) intervals
+    idx = np.searchsorted(onsets, t, side='right') - 1
+    inside = idx >= 0
+    inside[inside] = t[inside] < offsets[idx[inside]]
+    return inside
+
+
+class SyntheticSession():
+    """
+    Generated streams and their ground truth. Times are in seconds, already divided by the speed-up factor.
+
+    Attributes
+    ----------
+    channels : list
+        EEG channel names
+    eeg_times, eeg : ndarray
+        (n,) and (n, n_channels) in uV
+    com_times, com_actions, com_power : ndarray
+        com stream, action names and powers
+    pow_times, pow : ndarray
+        (m,) and (m, n_channels * 5) band powers, channel-major like the Cortex pow stream
+    mot_times, mot : ndarray
+        motion stream rows
+    dev_times : ndarray
+        device stream times
+    lift_onsets, lift_offsets : ndarray
+        ground truth 'lift' intervals
+    com_onsets : ndarray
+        time at which the com stream starts reporting each 'lift' interval
+    blink_times : ndarray
+        blink peak times
+
+    Methods
+    -------
+    to_messages(streams, sys_events):
+        To iterate over Cortex stream messages in time order
+    write_session(path, profile_name, streams):
+        To write a session file that replay.ReplayCortex can replay
+    as_source():
+        To get a data source for mock_cortex.MockCortexServer
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def _rows(self, stream):
+        if stream == 'eeg':
+            counter = np.arange(len(self.eeg_times)) % 128
+            for i, values in enumerate(self.eeg.tolist()):
+                yield [int(counter[i]), 0] + values + [0, 0, []]
+        elif stream == 'com':
+            for action, power in zip(self.com_actions.tolist(), self.com_power.tolist()):
+                yield [action, power]
+        elif stream == 'pow':
+            for values in self.pow.tolist():
+                yield values
+        elif stream == 'mot':
+            counter = np.arange(len(self.mot_times)) % 64
+            for i, values in enumerate(self.mot.tolist()):
+                yield [int(counter[i]), 0] + values
+        elif stream == 'dev':
+            cq = [4] * len(self.channels) + [100]
+            for _ in range(len(self.dev_times)):
+                yield [4, 1.0, cq, 90]
+
+    def _times(self, stream):
+        return getattr(self, stream + '_times')
+
+    def _sys_events(self):
+        # training-like trials: a neutral trial in the block before each lift interval, then the lift trial,
+        # so trial k is for action ['neutral', 'lift'][k % 2] like Train with actions ['neutral', 'lift'].
+        # A lift whose neutral trial does not fit in the rest before it gets no trials at all, which keeps
+        # the alternation of the labels
+        times = []
+        previous = self.eeg_times[0] if len(self.eeg_times) else 0.0
+        for onset, offset in zip(self.lift_onsets, self.lift_offsets):
+            length = offset - onset
+            neutral_start = max(previous + 0.25 * length, onset - 1.25 * length)
+            if neutral_start + length <= onset:
+                times += [neutral_start, neutral_start + length, neutral_start + length, onset, offset, offset]
+            previous = offset
+        events = [['mentalCommand', name] for name in ['MC_Started', 'MC_Succeeded', 'MC_Completed']]
+        return np.array(times), events * (len(times) // 3)
+
+    def to_messages(self, streams=('eeg', 'com', 'pow', 'mot', 'dev'), sys_events=False, sid='synthetic'):
+        """
+        To iterate over the Cortex stream messages of the session, ordered by time
+
+        Parameters
+        ----------
+        streams : tuple, optional
+            streams to include
+        sys_events : bool, optional
+            also emit training-like sys events at the ground truth onsets and offsets
+
+        Returns
+        -------
+        generator of dict
+            messages such as {'sid': 'synthetic', 'time': 1.25, 'com': ['lift', 0.7]}
+        """
+        names = list(streams)
+        times = [self._times(s) for s in names]
+        rows = [self._rows(s) for s in names]
+        if sys_events:
+            sys_times, events = self._sys_events()
+            # rows are taken in the order of their times
+            sys_order = np.argsort(sys_times, kind='stable')
+            sys_times, events = sys_times[sys_order], [events[i] for i in sys_order.tolist()]
+            names.append('sys')
+            times.append(sys_times)
+            rows.append(iter(events))
+
+        all_times = np.concatenate(times)
+        which = np.concatenate([np.full(len(t), i) for i, t in enumerate(times)])
+        order = np.argsort(all_times, kind='stable')
+        for i in order.tolist():
+            k = which[i]
+            yield {'sid': sid, 'time': float(all_times[i]), names[k]: next(rows[k])}
+
+    def write_session(self, path, profile_name='TRAW spins', streams=('eeg', 'com', 'pow', 'mot', 'dev'),
+                      sys_events=False, handshake=True):
+        """
+        To write the session in the replay.py format. With handshake=True the recording starts with
+        the Cortex responses live.py expects, so LiveAdvance can run on it unchanged.
+
+        Returns
+        -------
+        int
+            number of messages written
+        """
+        start = self.eeg_times[0] if len(self.eeg_times) else 0.0
+        count = 0
+        with SessionRecorder(path) as recorder:
+            if handshake:
+                for i, message in enumerate(handshake_messages(profile_name, list(streams))):
+                    recorder.write(message, start - 1.0 + i * 1e-3)
+                    count += 1
+            for message in self.to_messages(streams, sys_events):
+                recorder.write(message, message['time'])
+                count += 1
+        return count
+
+    def as_source(self):
+        """
+        To serve the generated streams from mock_cortex.MockCortexServer(source=...).
+        Rows are replayed in order and wrap around at the end.
+        """
+        rows = {}
+
+        def source(stream, t, index):
+            if stream not in rows:
+                rows[stream] = list(self._rows(stream)) if stream in ('eeg', 'com', 'pow', 'mot', 'dev') else []
+            table = rows[stream]
+            if not table:
+                return []
+            row = table[index % len(table)]
+            return list(row)
+        return source
+
+
+def handshake_messages(profile_name, streams):
+    """The Cortex responses of a live.py start-up, from hasAccessRight to the subscription"""
+    from mock_cortex import STREAM_COLS
+    headset = [{'id': 'EPOCX-SYNTH001', 'status': 'connected', 'connectedBy': 'dongle'}]
+
+    def result(req_id, value):
+        return {'id': req_id, 'jsonrpc': '2.0', 'result': value}
+
+    return [
+        result(cortex.HAS_ACCESS_RIGHT_ID, {'accessGranted': True}),
+        result(cortex.AUTHORIZE_ID, {'cortexToken': 'synthetic'}),
+        result(cortex.QUERY_HEADSET_ID, headset),
+        result(cortex.QUERY_HEADSET_ID, headset),
+        result(cortex.CREATE_SESSION_ID, {'id': 'synthetic'}),
+        result(cortex.QUERY_PROFILE_ID, [{'name': profile_name, 'readOnly': False}]),
+        result(cortex.GET_CURRENT_PROFILE_ID, {'name': profile_name, 'loadedByThisApp': True}),
+        result(cortex.MENTAL_COMMAND_ACTIVE_ACTION_ID, ['neutral', 'lift']),
+        result(cortex.SENSITIVITY_REQUEST_ID, [5, 5, 5, 5]),
+        result(cortex.SENSITIVITY_REQUEST_ID, 'success'),
+        result(cortex.SETUP_PROFILE_ID, {'action': 'save', 'name': profile_name}),
+        result(cortex.SUB_REQUEST_ID, {'success': [{'streamName': s, 'cols': STREAM_COLS[s]}
+                                                   for s in streams if s in STREAM_COLS],
+                                       'failure': []}),
+    ]
+
+
+class SignalGenerator():
+    """
+    A class to generate synthetic sessions with known 'lift' intervals
+
+    Attributes
+    ----------
+    seed : int or None
+        random seed, the same seed gives the same session
+    channels : int
+        number of EEG channels
+    speedup : float
+        time compression factor. 10 gives 10x the nominal sample rates over 1/10 of the duration
+    eeg_rate, com_rate, pow_rate, mot_rate, dev_rate : float
+        nominal sample rates
+    com_delay : float
+        seconds between a 'lift' onset and the com stream reporting it
+    erd_depth : float
+        relative drop of mu/beta amplitude on motor channels during 'lift'
+
+    Methods
+    -------
+    generate(duration, start_time):
+        To generate a SyntheticSession of duration nominal seconds
+    """
+    def __init__(self, seed=None, channels=14, speedup=1.0, eeg_rate=128, com_rate=8, pow_rate=8,
+                 mot_rate=64, dev_rate=2, neutral_seconds=(4.0, 10.0), lift_seconds=(2.0, 5.0),
+                 com_delay=0.6, com_rise=0.4, false_lift_rate=0.05, erd_depth=0.5,
+                 blink_rate=0.3, background_uv=8.0, alpha_exponent=1.0):
+        if channels < 1:
+            raise ValueError('channels must be at least 1.')
+        if speedup <= 0:
+            raise ValueError('speedup must be positive.')
+        self.seed = seed
+        self.channels = channels
+        self.speedup = speedup
+        self.eeg_rate = eeg_rate
+        self.com_rate = com_rate
+        self.pow_rate = pow_rate
+        self.mot_rate = mot_rate
+        self.dev_rate = dev_rate
+        self.neutral_seconds = neutral_seconds
+        self.lift_seconds = lift_seconds
+        self.com_delay = com_delay
+        self.com_rise = com_rise
+        self.false_lift_rate = false_lift_rate
+        self.erd_depth = erd_depth
+        self.blink_rate = blink_rate
+        self.background_uv = background_uv
+        self.alpha_exponent = alpha_exponent
+
+    def _schedule(self, rng, duration):
+        # alternate neutral and lift blocks, starting and ending with neutral
+        count = int(duration / (self.neutral_seconds[0] + self.lift_seconds[0])) + 2
+        neutral = rng.uniform(*self.neutral_seconds, size=count)
+        lift = rng.uniform(*self.lift_seconds, size=count)
+        onsets = np.cumsum(neutral + np.concatenate([[0.0], lift[:-1]]))
+        offsets = onsets + lift
+        keep = offsets < duration - self.neutral_seconds[0] / 2
+        return onsets[keep], offsets[keep]
+
+    def generate(self, duration, start_time=None):
+        """
+        Parameters
+        ----------
+        duration : float, required
+            nominal duration in seconds (before the speed-up)
+        start_time : float, optional
+            time of the first sample. Default is now
+
+        Returns
+        -------
+        SyntheticSession
+        """
+        rng = np.random.default_rng(self.seed)
+        if start_time is None:
+            start_time = time.time()
+        names = channel_names(self.channels)
+        motor = np.array([MOTOR_WEIGHTS.get(ch, 0.2) for ch in names])
+        blink_gain = np.array([BLINK_WEIGHTS.get(ch, 0.05) for ch in names])
+        onsets, offsets = self._schedule(rng, duration)
+
+        # EEG: 1/f background with some spatial mixing, plus mu and beta rhythms
+        n = int(duration * self.eeg_rate)
+        t = np.arange(n) / self.eeg_rate
+        exponent = self.alpha_exponent / 2.0
+        background = _shaped_noise(rng, n, self.channels, self.eeg_rate,
+                                   lambda f: np.maximum(f, 0.5) ** -exponent)
+        mixing = 0.7 * np.eye(self.channels) + 0.3 / self.channels
+        background = background @ mixing * self.background_uv
+        mu = _shaped_noise(rng, n, self.channels, self.eeg_rate,
+                           lambda f: np.exp(-0.5 * ((f - 10.0) / 1.0) ** 2))
+        beta = _shaped_noise(rng, n, self.channels, self.eeg_rate,
+                             lambda f: np.exp(-0.5 * ((f - 20.0) / 3.0) ** 2))
+
+        # ERD envelope: 1 in neutral, 1 - depth * weight during lift, smoothed over ~0.5 s
+        lifting = _in_intervals(t, onsets, offsets).astype(np.float64)
+        ramp = max(1, int(0.5 * self.eeg_rate))
+        lifting = np.convolve(lifting, np.ones(ramp) / ramp, mode='full')[:n]
+        envelope = 1.0 - self.erd_depth * lifting[:, None] * motor[None, :]
+        eeg = background + envelope * (6.0 * mu + 3.0 * beta)
+
+        # blinks: ~150 uV gaussian bumps on the frontal channels
+        blink_times = np.sort(rng.uniform(0, duration, size=rng.poisson(self.blink_rate * duration)))
+        if len(blink_times):
+            width = int(0.2 * self.eeg_rate)
+            offsets_idx = np.arange(-width, width + 1)
+            shape = np.exp(-0.5 * (offsets_idx / (0.05 * self.eeg_rate)) ** 2)
+            centers = np.round(blink_times * self.eeg_rate).astype(np.int64)
+            idx = centers[:, None] + offsets_idx[None, :]
+            valid = (idx >= 0) & (idx < n)
+            amplitude = rng.uniform(100.0, 200.0, size=len(centers))[:, None] * shape[None, :]
+            pulse = np.zeros(n)
+            np.add.at(pulse, idx[valid], amplitude[valid])
+            eeg += pulse[:, None] * blink_gain[None, :]
+        eeg = np.round(np.round((EEG_OFFSET_UV + eeg) / EEG_LSB_UV) * EEG_LSB_UV, 6)
+
+        # com: follows the ground truth after com_delay, rising with time constant com_rise
+        m = int(duration * self.com_rate)
+        tc = np.arange(m) / self.com_rate
+        lagged = tc - self.com_delay
+        idx = np.searchsorted(onsets, lagged, side='right') - 1
+        active = _in_intervals(lagged, onsets, offsets)
+        peak = rng.uniform(0.55, 0.95, size=len(onsets))
+        power = np.zeros(m)
+        since = lagged[active] - onsets[idx[active]]
+        power[active] = peak[idx[active]] * (1.0 - np.exp(-since / self.com_rise))
+        power[active] += rng.normal(0, 0.05, size=active.sum())
+        false_lift = ~active & (rng.random(m) < self.false_lift_rate)
+        power[false_lift] = rng.uniform(0.05, 0.6, size=false_lift.sum())
+        is_lift = active | false_lift
+        power = np.round(np.clip(power, 0.0, 1.0), 3)
+        power[~is_lift] = 0.0
+        actions = np.where(is_lift, 'lift', 'neutral').astype(object)
+
+        # pow: band powers following the rhythm envelopes, log-normal noise
+        k = int(duration * self.pow_rate)
+        tp = np.arange(k) / self.pow_rate
+        env_p = np.stack([np.interp(tp, t, envelope[:, c]) for c in range(self.channels)], axis=1)
+        base = np.array([4.0, 6.0, 2.5, 1.5, 0.5])
+        gains = np.stack([np.ones_like(env_p), env_p ** 2, env_p ** 2, env_p ** 2, np.ones_like(env_p)], axis=2)
+        band_power = base[None, None, :] * gains * rng.lognormal(0.0, 0.2, size=gains.shape)
+        band_power = np.round(band_power.reshape(k, self.channels * 5), 6)
+
+        # mot: quaternion and accelerometer at rest with a little noise
+        j = int(duration * self.mot_rate)
+        rest = np.array([0.7, 0.0, 0.0, 0.7, 0.0, 0.0, 1.0, 20.0, -5.0, 40.0])
+        mot = np.round(rest[None, :] + rng.normal(0, 0.005, size=(j, len(rest))), 6)
+
+        d = int(duration * self.dev_rate)
+        scale = 1.0 / self.speedup
+        return SyntheticSession(
+            channels=names,
+            speedup=self.speedup,
+            eeg_times=start_time + t * scale,
+            eeg=eeg,
+            com_times=start_time + tc * scale,
+            com_actions=actions,
+            com_power=power,
+            pow_times=start_time + tp * scale,
+            pow=band_power,
+            mot_times=start_time + np.arange(j) / self.mot_rate * scale,
+            mot=mot,
+            dev_times=start_time + np.arange(d) / self.dev_rate * scale,
+            lift_onsets=start_time + onsets * scale,
+            lift_offsets=start_time + offsets * scale,
+            com_onsets=start_time + (onsets + self.com_delay) * scale,
+            blink_times=start_time + blink_times * scale,
+        )
+
+
+def score_detections(trigger_times, onsets, offsets, tolerance=0.0):
+    """
+    To score triggers against ground truth intervals
+
+    Parameters
+    ----------
+    trigger_times : array-like, required
+        times at which a 'lift' was triggered
+    onsets, offsets : array-like, required
+        ground truth 'lift' intervals
+    tolerance : float, optional
+        triggers up to tolerance seconds after an offset still count for that interval
+
+    Returns
+    -------
+    dict
+        hits, misses, false_triggers and latencies (first trigger - onset, NaN for misses)
+    """
+    triggers = np.sort(np.asarray(trigger_times, dtype=np.float64))
+    onsets = np.asarray(onsets, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.float64) + tolerance
+    first = np.searchsorted(triggers, onsets, side='left')
+    hit = first < len(triggers)
+    hit[hit] = triggers[first[hit]] < offsets[hit]
+    latencies = np.full(len(onsets), np.nan)
+    latencies[hit] = triggers[first[hit]] - onsets[hit]
+    inside = _in_intervals(triggers, onsets, offsets) if len(onsets) else np.zeros(len(triggers), bool)
+    return {
+        'hits': int(hit.sum()),
+        'misses': int((~hit).sum()),
+        'false_triggers': int((~inside).sum()),
+        'latencies': latencies,
+    }
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - session = SignalGenerator(seed=1, speedup=10).generate(600)
+#   - session.write_session('synthetic.log') then replay it with replay.py
+#   - MockCortexServer(source=session.as_source()) serves it over the mock Cortex service
+#   - score_detections(trigger_times, session.lift_onsets, session.lift_offsets) scores a detector
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic EEG / mental command session')
+    parser.add_argument('path', help='session file to write')
+    parser.add_argument('--duration', type=float, default=300.0, help='nominal duration in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--channels', type=int, default=14)
+    parser.add_argument('--speedup', type=float, default=1.0)
+    parser.add_argument('--sys-events', action='store_true', help='add training-like sys events')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    session = SignalGenerator(seed=args.seed, channels=args.channels, speedup=args.speedup).generate(args.duration)
+    generated = time.perf_counter() - start
+    count = session.write_session(args.path, sys_events=args.sys_events)
+    print('Generated {0} EEG samples x {1} channels in {2:.3f} s, {3} lift intervals'.format(
+        len(session.eeg_times), args.channels, generated, len(session.lift_onsets)))
+    print('Wrote {0} messages to {1}'.format(count, args.path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import numpy as np
+
+from adaptive import AdaptiveLDA
+
+
+def _trials(rng, n=40, dimension=4):
+    rest = rng.normal(0.0, 1.0, size=(n, dimension))
+    lift = rng.normal(0.8, 1.0, size=(n, dimension))
+    return rest, lift
+
+
+def test_rollback_undoes_the_last_updates():
+    rng = np.random.default_rng(2)
+    rest, lift = _trials(rng)
+    learner = AdaptiveLDA(4, actions=['neutral', 'lift'], forgetting=0.9)
+    learner.fit(np.vstack([rest, lift]), ['neutral'] * len(rest) + ['lift'] * len(lift))
+    fitted = learner.snapshot()
+    weights, bias = learner.weights.copy(), learner.bias
+
+    learner.update(rng.normal(0.8, 1.0, size=(10, 4)), 'lift')
+    after_one = learner.weights.copy()
+    learner.update(rng.normal(3.0, 1.0, size=(10, 4)), 'neutral')
+    assert learner.updates == 2
+    assert learner.rollback()
+    np.testing.assert_allclose(learner.weights, after_one)
+    assert learner.rollback()
+    np.testing.assert_allclose(learner.weights, weights)
+    assert learner.bias == bias and learner.updates == 0
+    assert not learner.rollback()
+
+    learner.update(rng.normal(3.0, 1.0, size=(10, 4)), 'lift')
+    assert learner.rollback(fitted)
+    np.testing.assert_allclose(learner.weights, weights)
+    # the snapshot is a copy, later updates do not change it
+    learner.update(rng.normal(3.0, 1.0, size=(10, 4)), 'lift')
+    assert learner.rollback(fitted)
+    np.testing.assert_allclose(learner.weights, weights)
+
+
+def test_rollback_restores_the_outside_discriminant_below_min_count():
+    rng = np.random.default_rng(3)
+    learner = AdaptiveLDA(4, actions=['neutral', 'lift'], min_count=15)
+    learner.weights, learner.bias = np.ones(4), 0.5
+    learner.update(rng.normal(0.0, 1.0, size=(10, 4)), 'neutral')
+    learner.update(rng.normal(1.0, 1.0, size=(10, 4)), 'lift')
+    np.testing.assert_array_equal(learner.weights, np.ones(4))
+    learner.update(rng.normal(1.0, 1.0, size=(10, 4)), 'lift')
+    learner.update(rng.normal(0.0, 1.0, size=(10, 4)), 'neutral')
+    assert not np.array_equal(learner.weights, np.ones(4))
+    learner.rollback()
+    np.testing.assert_array_equal(learner.weights, np.ones(4))
+    assert learner.bias == 0.5
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from com_stats import P2Quantile
+
+
+@pytest.mark.parametrize('p', [0.1, 0.5, 0.9, 0.99])
+def test_p2_quantile_follows_the_exact_quantile(p):
+    rng = np.random.default_rng(4)
+    for samples in (rng.normal(0.0, 1.0, 20000), rng.exponential(1.0, 20000), rng.uniform(0.0, 1.0, 20000)):
+        estimate = P2Quantile(p)
+        for x in samples:
+            estimate.push(float(x))
+        exact = np.quantile(samples, p)
+        spread = np.quantile(samples, 0.75) - np.quantile(samples, 0.25)
+        assert abs(estimate.value() - exact) < 0.05 * spread
+        assert estimate.count == len(samples)
+
+
+def test_p2_quantile_is_exact_on_the_first_samples():
+    estimate = P2Quantile(0.5)
+    assert estimate.value() is None
+    for x in (5.0, 1.0, 3.0):
+        estimate.push(x)
+    assert estimate.value() == 3.0
@@ -0,0 +1,76 @@
+import pytest
+
+from decision import (DecisionEngine, HysteresisPolicy, RefractoryPolicy, SprtPolicy, ThresholdPolicy,
+                      VotingPolicy, make_policy, parse_policy)
+
+
+def _run(policy, powers, dt=0.125):
+    return [policy.update(i * dt, power) for i, power in enumerate(powers)]
+
+
+def test_threshold_decides_once_per_crossing():
+    decisions = _run(ThresholdPolicy(0.5), [0.2, 0.6, 0.7, 0.4, 0.5, 0.8, 0.9])
+    assert decisions == [None, 0.125, None, None, None, 0.625, None]
+
+
+def test_hysteresis_stays_on_until_the_lower_level():
+    # 0.45 does not switch off with hysteresis 0.1, 0.35 does
+    decisions = _run(HysteresisPolicy(0.5, hysteresis=0.1), [0.6, 0.45, 0.6, 0.35, 0.6])
+    assert decisions == [0.0, None, None, None, 0.5]
+
+
+def test_hysteresis_hold_reports_the_start_of_the_on_period():
+    decisions = _run(HysteresisPolicy(0.5, hysteresis=0.1, hold=0.25), [0.6, 0.7, 0.8, 0.9, 0.2, 0.6, 0.1])
+    assert decisions == [None, None, 0.0, None, None, None, None]
+
+
+def test_voting_needs_n_of_the_last_m():
+    decisions = _run(VotingPolicy(0.5, n=3, m=5), [0.6, 0.1, 0.6, 0.1, 0.6, 0.6, 0.1, 0.1, 0.1, 0.1, 0.1, 0.6])
+    assert decisions[4] == 0.0
+    assert [d for d in decisions if d is not None] == [0.0]
+    with pytest.raises(ValueError):
+        VotingPolicy(0.5, n=4, m=3)
+
+
+def test_sprt_decides_on_sustained_lift_and_rearms_after_rest():
+    policy = SprtPolicy(rest_level=0.05, lift_level=0.6, sigma=0.25, alpha=0.01, beta=0.05)
+    decisions = _run(policy, [0.05] * 4 + [0.6] * 6 + [0.05] * 6 + [0.6] * 6)
+    fired = [(i, d) for i, d in enumerate(decisions) if d is not None]
+    assert len(fired) == 2
+    # the decision time is that of the first sample pushing towards lift
+    assert fired[0][1] == 4 * 0.125 and fired[1][1] == 16 * 0.125
+    assert _run(SprtPolicy(), [0.3] * 40).count(None) == 40
+
+
+def test_refractory_drops_decisions_too_close_to_the_previous_one():
+    policy = RefractoryPolicy(ThresholdPolicy(0.5), refractory=1.0)
+    powers = [0.9, 0.1, 0.9, 0.1] + [0.1] * 6 + [0.9]
+    decisions = _run(policy, powers)
+    assert [i for i, d in enumerate(decisions) if d is not None] == [0, 10]
+    assert policy.threshold == 0.5 and policy.name == 'threshold+refractory'
+
+
+def test_engine_reports_latency_and_ignores_other_actions():
+    engine = DecisionEngine(policy=make_policy('hysteresis', threshold=0.5, hold=0.25))
+    decided = []
+
+    def on_new_decision(*args, **kwargs):
+        decided.append(kwargs.get('data'))
+    engine.bind(new_decision=on_new_decision)
+    assert engine.push(0.0, 'push', 0.9) is None
+    assert engine.push(0.125, 'lift', 0.9) is None
+    assert engine.push(0.25, 'lift', 0.9) is None
+    decision = engine.push(0.375, 'lift', 0.9)
+    assert decision['first_support'] == 0.125 and decision['latency'] == 0.25
+    assert decided == [decision] and engine.latencies == [0.25]
+    engine.set_threshold(0.7)
+    assert engine.threshold == 0.7
+
+
+def test_parse_policy():
+    policy = parse_policy('vote:n=2,m=4,refractory=2', threshold=0.6)
+    assert isinstance(policy, RefractoryPolicy) and policy.refractory == 2.0
+    assert (policy.policy.n, policy.policy.m, policy.threshold) == (2, 4, 0.6)
+    assert isinstance(parse_policy('sprt'), SprtPolicy)
+    with pytest.raises(ValueError):
+        make_policy('unknown')
@@ -0,0 +1,38 @@
+import numpy as np
+
+from eeg_codec import ArchiveWriter, decode_chunk, encode_chunk, read_archive
+
+
+def test_chunk_round_trip_is_lossless():
+    rng = np.random.default_rng(0)
+    times = np.round(1590736942.0 + np.arange(500) / 128.0, 6)
+    values = np.round((32768 + np.cumsum(rng.integers(-40, 41, size=(500, 14)), axis=0)) * 0.128205128, 6)
+    stream, decoded_times, decoded = decode_chunk(encode_chunk('eeg', times, values))
+    assert stream == 'eeg'
+    np.testing.assert_array_equal(decoded_times, times)
+    np.testing.assert_array_equal(decoded, values)
+
+
+def test_columns_off_the_resolution_are_stored_raw():
+    times = np.arange(6, dtype=float)
+    values = np.column_stack([[1.0, np.nan, 3.0, np.inf, -2.5, 0.0],
+                              [0.1234567891, 2.0, 3.0, 4.0, 5.0, 6.0],
+                              [1.0, 0.0, 1.0, 1.0, 0.0, 1.0]])
+    _, decoded_times, decoded = decode_chunk(encode_chunk('mot', times, values))
+    np.testing.assert_array_equal(decoded_times, times)
+    np.testing.assert_array_equal(decoded, values)
+
+
+def test_archive_round_trip_over_several_chunks(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / 'session.eza')
+    eeg = (np.arange(1000) / 128.0, np.round(rng.normal(4200, 20, size=(1000, 14)), 6))
+    pow_ = (np.arange(60) / 8.0, np.round(rng.gamma(2.0, size=(60, 70)), 6))
+    with ArchiveWriter(path, chunk_rows=256) as writer:
+        writer.write('eeg', *eeg)
+        writer.write('pow', *pow_)
+    archive = read_archive(path, workers=2)
+    for stream, (times, values) in (('eeg', eeg), ('pow', pow_)):
+        np.testing.assert_array_equal(archive[stream][0], times)
+        np.testing.assert_array_equal(archive[stream][1], values)
+    assert list(read_archive(path, streams=['pow'])) == ['pow']
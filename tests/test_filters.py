@@ -0,0 +1,32 @@
+import numpy as np
+
+from filters import StreamingFilter, design_bandpass, design_notch
+
+SOS = np.concatenate([design_notch(50.0, 128.0), design_bandpass(8.0, 30.0, 128.0)])
+
+
+def _signal(n=700, channels=5):
+    return np.random.default_rng(0).standard_normal((n, channels)) * 20.0 + 4000.0
+
+
+def test_block_is_bit_identical_to_sample_by_sample():
+    x = _signal()
+    for reference in (None, 'car', np.eye(5) - 0.2):
+        sample = StreamingFilter(SOS, 5, reference)
+        expected = np.array([sample.step(row) for row in x])
+        for sizes in ((700,), (1, 2, 3, 64, 630), (256, 0, 444)):
+            block = StreamingFilter(SOS, 5, reference)
+            bounds = np.cumsum((0,) + sizes)
+            y = np.concatenate([block.process(x[a:b]) for a, b in zip(bounds[:-1], bounds[1:])])
+            np.testing.assert_array_equal(y, expected)
+            np.testing.assert_array_equal(block.zi, sample.zi)
+
+
+def test_chunked_mode_matches_to_the_rounding_error():
+    x = _signal()
+    sample = StreamingFilter(SOS, 5, 'car')
+    expected = np.array([sample.step(row) for row in x])
+    chunked = StreamingFilter(SOS, 5, 'car', exact=False, chunk=37)
+    y = np.concatenate([chunked.process(x[:300]), np.array([chunked.step(row) for row in x[300:310]]),
+                        chunked.process(x[310:])])
+    np.testing.assert_allclose(y, expected, rtol=0, atol=1e-9)
@@ -0,0 +1,40 @@
+import itertools
+
+import numpy as np
+
+from decision import DecisionEngine, make_policy
+from policy_sim import POLICY_PARAMS, simulate
+
+GRID = {'threshold': [0.3, 0.5, 0.7], 'hysteresis': [0.0, 0.2], 'hold': [0.0, 0.25, 0.5], 'refractory': [0.0, 1.0, 3.0]}
+
+
+def _recording(seconds=600, rate=8):
+    rng = np.random.default_rng(5)
+    times = np.arange(seconds * rate) / rate
+    lift_onsets = np.arange(10.0, seconds - 10, 20.0)
+    lift_ends = lift_onsets + 5.0
+    trial = np.searchsorted(lift_onsets, times, side='right') - 1
+    lifting = (trial >= 0) & (times < lift_ends[np.maximum(trial, 0)])
+    power = np.where(lifting, rng.choice([0.0, 0.4, 0.6, 0.8, 0.9], size=len(times)),
+                     rng.choice([0.0, 0.0, 0.0, 0.2, 0.4, 0.6], size=len(times)))
+    return {'times': times, 'power': power, 'lift_onsets': lift_onsets, 'lift_ends': lift_ends,
+            'neutral_onsets': lift_ends + 2.0, 'neutral_ends': np.append(lift_onsets[1:], seconds),
+            'duration': times[-1] - times[0]}
+
+
+def test_simulation_matches_the_decision_engine():
+    recording = _recording()
+    results = simulate(recording, GRID, tolerance=1.0)
+    values = list(itertools.product(*(GRID[p] for p in POLICY_PARAMS)))
+    assert len(results['triggers']) == len(values)
+    assert results['triggers'].max() > 0
+    for i, (threshold, hysteresis, hold, refractory) in enumerate(values):
+        engine = DecisionEngine(policy=make_policy('hysteresis', threshold=threshold, hysteresis=hysteresis,
+                                                   hold=hold, refractory=refractory))
+        triggers = [t for t, power in zip(recording['times'], recording['power'])
+                    if engine.push(t, 'lift', power) is not None]
+        assert results['triggers'][i] == len(triggers), values[i]
+        trial = np.searchsorted(recording['lift_onsets'], triggers, side='right') - 1
+        in_lift = (trial >= 0) & (np.asarray(triggers) < recording['lift_ends'][np.maximum(trial, 0)] + 1.0)
+        assert results['false_triggers'][i] == np.sum(~in_lift), values[i]
+        assert results['hits'][i] == len(np.unique(trial[in_lift])), values[i]
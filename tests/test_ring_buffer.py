@@ -0,0 +1,38 @@
+import numpy as np
+
+from ring_buffer import TimedRingBuffer
+
+
+def test_extend_longer_than_capacity_counts_every_sample():
+    buffer = TimedRingBuffer(10, 2)
+    times = np.arange(25, dtype=float)
+    buffer.extend(times, np.column_stack([times, -times]))
+    assert buffer.count == 25
+    assert len(buffer) == 10
+    kept, values = buffer.view()
+    np.testing.assert_array_equal(kept, times[-10:])
+    np.testing.assert_array_equal(values[:, 1], -times[-10:])
+    assert buffer.latest_time() == 24.0
+
+
+def test_wraparound_keeps_the_latest_samples_in_order():
+    buffer = TimedRingBuffer(8, 3)
+    expected = []
+    t = 0.0
+    for size in (3, 5, 1, 7, 2, 4, 6):
+        times = t + np.arange(size, dtype=float)
+        rows = np.column_stack([times, times * 2, times * 3])
+        if size == 1:
+            buffer.append(times[0], rows[0])
+        else:
+            buffer.extend(times, rows)
+        expected.extend(times)
+        t += size
+        kept, values = buffer.view()
+        np.testing.assert_array_equal(kept, expected[-8:])
+        np.testing.assert_array_equal(values, np.column_stack([kept, kept * 2, kept * 3]))
+    assert buffer.count == len(expected)
+    kept, values = buffer.view(3)
+    np.testing.assert_array_equal(kept, expected[-3:])
+    kept, _ = buffer.since(expected[-5])
+    np.testing.assert_array_equal(kept, expected[-4:])
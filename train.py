@@ -1,6 +1,8 @@
 import cortex
 from cortex import Cortex
+import argparse
 import os
+import shutil
 from dotenv import load_dotenv
 
 class Train():
@@ -42,8 +44,11 @@ class Train():
         to handle new_sys_data which inform when sys event is streamed
     """
 
-    def __init__(self, app_client_id, app_client_secret, **kwargs):
-        self.c = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
+    def __init__(self, app_client_id, app_client_secret, cortex=None, **kwargs):
+        # an already constructed Cortex, such as replay.ReplayCortex, can be passed instead
+        if cortex is None:
+            cortex = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
+        self.c = cortex
         self.c.bind(create_session_done=self.on_create_session_done)
         self.c.bind(query_profile_done=self.on_query_profile_done)
         self.c.bind(load_unload_profile_done=self.on_load_unload_profile_done)
@@ -257,10 +262,19 @@ class Train():
 #          You can modify these functions to control the training such as: reject an training, use advanced bci api.
 # RESULT
 #   - train mental command action
+#   - with --dashboard, a terminal dashboard shows the training state and the headset instead of the logs
+#   - with --adapt model.npz, eeg is subscribed too and every accepted trial updates that mi_classifier.py model;
+#     the result goes to --adapt-out, or replaces model.npz after a copy of it is kept as model.npz.bak
 # 
 # -----------------------------------------------------------
 
 def main():
+    parser = argparse.ArgumentParser(description='Train mental command actions')
+    parser.add_argument('--dashboard', action='store_true', help='show a terminal dashboard instead of the logs')
+    parser.add_argument('--adapt', metavar='MODEL', help='update a mi_classifier.py model with every accepted trial')
+    parser.add_argument('--adapt-out', metavar='MODEL', help='where the adapted model is saved. Default is MODEL, keeping MODEL.bak')
+    args = parser.parse_args()
+
     # Load environment variables from .env file
     load_dotenv()
 
@@ -270,7 +284,11 @@ def main():
     print(your_app_client_id)
 
     # Init Train
-    t=Train(your_app_client_id, your_app_client_secret)
+    if args.dashboard:
+        t=Train(your_app_client_id, your_app_client_secret,
+                cortex=Cortex(your_app_client_id, your_app_client_secret, debug_mode=False))
+    else:
+        t=Train(your_app_client_id, your_app_client_secret)
 
     profile_name = 'TRAW spins' # set your profile name. If the profile is not exited it will be created.
 
@@ -281,7 +299,30 @@ def main():
     print(f"Training profile '{profile_name}' with actions: {actions}")
     print("This will enable the robotic arm to respond to your 'lift' mental command")
     
-    t.start(profile_name, actions)
+    adapter = None
+    if args.adapt:
+        from adaptive import TrialAdapter
+        from mi_classifier import MotorImageryModel
+        adapter = TrialAdapter(MotorImageryModel.load(args.adapt), t.c, actions=actions)
+
+    dashboard = None
+    if args.dashboard:
+        from dashboard import Dashboard
+        dashboard = Dashboard(t.c)
+        dashboard.watch('trained action', lambda: t.actions[t.action_idx] if t.action_idx < len(t.actions) else 'done')
+        dashboard.start()
+
+    try:
+        t.start(profile_name, actions)
+    finally:
+        if dashboard is not None:
+            dashboard.stop()
+        if adapter is not None and adapter.learner.updates:
+            output = args.adapt_out or args.adapt
+            if output == args.adapt:
+                shutil.copyfile(args.adapt, args.adapt + '.bak')
+            adapter.model.save(output)
+            print('{0} accepted trials adapted {1}, saved as {2}'.format(adapter.learner.updates, args.adapt, output))
 
 if __name__ =='__main__':
     main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Live visualization server for a running Cortex
+
+VizServer serves a page on http://localhost:8765/ and pushes binary frames to
+every connected browser over a websocket at a fixed display rate (30 fps by
+default), whatever the rates of the streams: each frame carries the min/max of
+every EEG channel since the previous frame, and the latest known band power,
+mental command and contact quality. No frame is sent when nothing changed. A frame is encoded once by the frame thread and the
+same bytes are sent to every viewer; a slow viewer skips frames instead of
+delaying the others. The Cortex callbacks only append to a list, so the command
+loop is never blocked by the viewers.
+
+Frame layout, little-endian:
+    header  4s magic 'EVF1', uint32 seq, float64 time, uint16 n_eeg, uint16 n_pow, uint16 n_cq,
+            uint8 action index (255 for none), uint8 flags, float32 com power, float32 battery
+    body    float32 eeg min[n_eeg], eeg max[n_eeg], pow[n_pow], cq[n_cq]
+flags bits: 1 eeg, 2 pow, 4 com, 8 dev. Labels and action names are sent as a
+JSON text message on connect and whenever they change.
+"""
+
+import argparse
+import json
+import struct
+import threading
+import time
+
+import numpy as np
+
+import cortex
+from ws_server import ConnectionClosed, WebSocketServer
+
+FRAME_MAGIC = b'EVF1'
+FRAME_HEADER = struct.Struct('<4sIdHHHBBff')
+NO_ACTION = 255
+
+FLAG_EEG = 1
+FLAG_POW = 2
+FLAG_COM = 4
+FLAG_DEV = 8
+
+VIEWER_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Cortex live</title>
+<style>
+body { background: #111; color: #ddd; font: 13px sans-serif; margin: 8px; }
+canvas { background: #000; display: block; margin-bottom: 6px; }
+#status { margin-bottom: 6px; }
+</style></head>
+<body>
+<div id="status">connecting...</div>
+<canvas id="eeg" width="1200" height="560"></canvas>
+<canvas id="panel" width="1200" height="160"></canvas>
+<script>
+const HEADER = 32;
+const eeg = document.getElementById('eeg').getContext('2d');
+const panel = document.getElementById('panel').getContext('2d');
+const status = document.getElementById('status');
+let labels = {eeg: [], pow: [], dev: [], actions: []};
+let x = 0, frames = 0, lastCount = performance.now();
+const scale = 0.1;
+const ws = new WebSocket('ws://' + location.host + '/ws');
+ws.binaryType = 'arraybuffer';
+ws.onclose = () => { status.textContent = 'disconnected'; };
+ws.onmessage = (event) => {
+  if (typeof event.data === 'string') { labels = JSON.parse(event.data); return; }
+  const view = new DataView(event.data);
+  const nEeg = view.getUint16(16, true), nPow = view.getUint16(18, true), nCq = view.getUint16(20, true);
+  const action = view.getUint8(22), flags = view.getUint8(23);
+  const power = view.getFloat32(24, true), battery = view.getFloat32(28, true);
+  const body = new Float32Array(event.data, HEADER);
+  const w = eeg.canvas.width, h = eeg.canvas.height;
+  if (flags & 1) {
+    const row = h / nEeg;
+    eeg.fillStyle = '#000'; eeg.fillRect(x, 0, 3, h);
+    eeg.strokeStyle = '#4c4';
+    eeg.beginPath();
+    for (let c = 0; c < nEeg; c++) {
+      const mid = row * (c + 0.5), mean = (body[c] + body[nEeg + c]) / 2;
+      eeg.moveTo(x + 0.5, mid - (body[nEeg + c] - mean) * scale * row);
+      eeg.lineTo(x + 0.5, mid - (body[c] - mean) * scale * row - 1);
+    }
+    eeg.stroke();
+    x = (x + 1) % w;
+  }
+  const pw = panel.canvas.width, ph = panel.canvas.height;
+  panel.fillStyle = '#000'; panel.fillRect(0, 0, pw, ph);
+  if (flags & 4) {
+    panel.fillStyle = '#fa3'; panel.fillRect(10, ph - 20 - power * (ph - 40), 60, power * (ph - 40));
+    panel.fillStyle = '#ddd';
+    panel.fillText((labels.actions[action] || '-') + ' ' + power.toFixed(2), 10, ph - 6);
+  }
+  if (flags & 2) {
+    const bands = 5, perBand = new Array(bands).fill(0);
+    for (let i = 0; i < nPow; i++) perBand[i % bands] += body[2 * nEeg + i] / (nPow / bands);
+    const top = Math.max(...perBand, 1e-6);
+    for (let b = 0; b < bands; b++) {
+      panel.fillStyle = '#39f';
+      panel.fillRect(100 + b * 40, ph - 20 - perBand[b] / top * (ph - 40), 30, perBand[b] / top * (ph - 40));
+      panel.fillStyle = '#ddd';
+      panel.fillText(['theta', 'alpha', 'betaL', 'betaH', 'gamma'][b], 100 + b * 40, ph - 6);
+    }
+  }
+  if (flags & 8) {
+    const colors = ['#222', '#d22', '#d22', '#dd2', '#2d2'];
+    for (let i = 0; i < nCq; i++) {
+      const q = body[2 * nEeg + nPow + i];
+      panel.fillStyle = colors[Math.max(0, Math.min(4, Math.round(q)))] || '#2d2';
+      panel.fillRect(340 + i * 46, 30, 40, 40);
+      panel.fillStyle = '#ddd'; panel.fillText(labels.dev[i] || '', 340 + i * 46, 86);
+    }
+    panel.fillText('battery ' + battery.toFixed(0) + '%', 340, 110);
+  }
+  frames++;
+  const now = performance.now();
+  if (now - lastCount > 1000) {
+    status.textContent = (frames * 1000 / (now - lastCount)).toFixed(1) + ' fps';
+    frames = 0; lastCount = now;
+  }
+};
+</script></body></html>
+"""
+
+
+def decode_frame(frame):
+    """
+    To decode a binary frame, mainly for tests and non-browser viewers
+
+    Returns
+    -------
+    dict
+        seq, time, flags, action, power, battery, eeg_min, eeg_max, pow and cq
+    """
+    magic, seq, t, n_eeg, n_pow, n_cq, action, flags, power, battery = FRAME_HEADER.unpack_from(frame)
+    if magic != FRAME_MAGIC:
+        raise ValueError('Not a visualization frame.')
+    body = np.frombuffer(frame, dtype='<f4', offset=FRAME_HEADER.size)
+    return {'seq': seq, 'time': t, 'flags': flags, 'action': action, 'power': power, 'battery': battery,
+            'eeg_min': body[:n_eeg], 'eeg_max': body[n_eeg:2 * n_eeg],
+            'pow': body[2 * n_eeg:2 * n_eeg + n_pow], 'cq': body[2 * n_eeg + n_pow:2 * n_eeg + n_pow + n_cq]}
+
+
+class VizServer(cortex.CortexConsumer):
+    """
+    A class to serve live views of the streams of a Cortex to browsers
+
+    Attributes
+    ----------
+    fps : float
+        display rate of the frames
+    viewers : int
+        number of connected viewers
+    frames_encoded : int
+        number of frames encoded since start
+    pending_rows : int
+        eeg rows received and not encoded into a frame yet
+
+    Methods
+    -------
+    start():
+        To start the HTTP/WebSocket server and the frame thread
+    stop():
+        To stop them
+    """
+    def __init__(self, cortex_client, host='localhost', port=8765, fps=30.0, subscribe=('eeg', 'pow', 'dev')):
+        self.c = cortex_client
+        self.fps = fps
+        self.subscribe = list(subscribe)
+        self.frames_encoded = 0
+        self._lock = threading.Lock()
+        self._frame_ready = threading.Condition()
+        self._stopping = threading.Event()
+        self._viewers = set()
+        self._frame = None
+        self._seq = 0
+        self._labels = {'eeg': [], 'pow': [], 'dev': [], 'actions': []}
+        self._labels_version = 0
+        self._eeg_columns = cortex.EegColumns()
+        self._eeg_rows = []
+        self._pow = None
+        self._com = None
+        self._dev = None
+        self._time = 0.0
+        self._changed = False
+        self._thread = None
+        self._server = WebSocketServer(self._on_viewer, host, port, http_handler=self._on_http)
+
+        self.c.bind(create_session_done=self.on_create_session_done)
+        self.c.bind(new_data_labels=self.on_new_data_labels)
+        self.c.bind(new_eeg_data=self.on_new_eeg_data)
+        self.c.bind(new_pow_data=self.on_new_pow_data)
+        self.c.bind(new_com_data=self.on_new_com_data)
+        self.c.bind(new_dev_data=self.on_new_dev_data)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/'.format(self._server.host, self._server.port)
+
+    @property
+    def viewers(self):
+        return len(self._viewers)
+
+    @property
+    def pending_rows(self):
+        return len(self._eeg_rows)
+
+    def start(self):
+        self._server.start()
+        self._thread = threading.Thread(target=self._frame_loop, name='VizFrames', daemon=True)
+        self._thread.start()
+        print('Live view on ' + self.url)
+
+    def stop(self):
+        self._stopping.set()
+        with self._frame_ready:
+            self._frame_ready.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._server.stop()
+
+    def _on_http(self, path):
+        if path in ('/', '/index.html'):
+            return '200 OK', 'text/html; charset=utf-8', VIEWER_PAGE.encode('utf-8')
+        return None
+
+    def _frame_loop(self):
+        period = 1.0 / self.fps
+        deadline = time.monotonic()
+        while not self._stopping.is_set():
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stopping.wait(delay)
+            else:
+                # behind schedule: skip the missed frames instead of bursting
+                deadline = time.monotonic()
+            frame = self._encode()
+            if frame is None or not self._viewers:
+                continue
+            with self._frame_ready:
+                self._frame = frame
+                self._seq += 1
+                self._frame_ready.notify_all()
+
+    def _encode(self):
+        with self._lock:
+            if not self._changed:
+                return None
+            rows, self._eeg_rows = self._eeg_rows, []
+            pow_row, com, dev, t = self._pow, self._com, self._dev, self._time
+            self._changed = False
+        flags = 0
+        parts = []
+        n_eeg = 0
+        if rows:
+            values = np.asarray(rows, dtype=np.float32)
+            values = values[:, self._eeg_columns.columns]
+            n_eeg = values.shape[1]
+            parts += [values.min(axis=0), values.max(axis=0)]
+            flags |= FLAG_EEG
+        n_pow = 0
+        if pow_row is not None:
+            parts.append(np.asarray(pow_row, dtype=np.float32))
+            n_pow = len(pow_row)
+            flags |= FLAG_POW
+        action, power = NO_ACTION, 0.0
+        if com is not None:
+            action, power = com
+            flags |= FLAG_COM
+        n_cq, battery = 0, 0.0
+        if dev is not None:
+            cq, battery = dev
+            parts.append(np.asarray(cq, dtype=np.float32))
+            n_cq = len(cq)
+            flags |= FLAG_DEV
+        self.frames_encoded += 1
+        header = FRAME_HEADER.pack(FRAME_MAGIC, self.frames_encoded, t, n_eeg, n_pow, n_cq,
+                                   action, flags, power, battery)
+        return header + b''.join(part.astype('<f4').tobytes() for part in parts)
+
+    def _on_viewer(self, connection):
+        if connection.path != '/ws':
+            return
+        # the reader answers pings and notices when the browser goes away
+        reader = threading.Thread(target=self._drain, args=(connection,), daemon=True)
+        reader.start()
+        with self._frame_ready:
+            self._viewers.add(connection)
+            seq = self._seq
+        labels_version = -1
+        try:
+            while not self._stopping.is_set() and not connection.closed:
+                if labels_version != self._labels_version:
+                    labels_version = self._labels_version
+                    connection.send_text(json.dumps(self._labels))
+                with self._frame_ready:
+                    self._frame_ready.wait_for(lambda: self._seq != seq or self._stopping.is_set(), timeout=1.0)
+                    if self._seq == seq:
+                        continue
+                    # only the latest frame is sent, a slow viewer skips the others
+                    frame, seq = self._frame, self._seq
+                connection.send_binary(frame)
+        except ConnectionClosed:
+            pass
+        finally:
+            with self._frame_ready:
+                self._viewers.discard(connection)
+
+    def _drain(self, connection):
+        while connection.recv() is not None:
+            pass
+
+    # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        stream = data['streamName']
+        labels = list(data['labels'])
+        if stream == 'eeg':
+            if self._eeg_columns.update(labels):
+                labels = self._eeg_columns.names
+        if stream in self._labels:
+            self._labels[stream] = labels
+            self._labels_version += 1
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        with self._lock:
+            self._eeg_rows.append(data['eeg'])
+            self._changed = True
+            self._time = data['time']
+
+    def on_new_pow_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        with self._lock:
+            self._pow = data['pow']
+            self._changed = True
+            self._time = data['time']
+
+    def on_new_com_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        actions = self._labels['actions']
+        if data['action'] not in actions:
+            actions.append(data['action'])
+            self._labels_version += 1
+        with self._lock:
+            self._com = (actions.index(data['action']), data['power'])
+            self._changed = True
+            self._time = data['time']
+
+    def on_new_dev_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        with self._lock:
+            self._dev = (data['dev'], data['batteryPercent'])
+            self._changed = True
+            self._time = data['time']
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Next to any app holding a Cortex: viz = VizServer(app.c); viz.start() before app.start(...)
+#     then open http://localhost:8765/ in one or more browsers
+#   - python viz_server.py session.log replays a recorded session (see replay.py) into the view
+#   - python live.py --viz 8765 runs live mode with the view
+#
+# -----------------------------------------------------------
+
+def main():
+    from replay import ReplayCortex
+
+    parser = argparse.ArgumentParser(description='Serve a live view of a replayed session')
+    parser.add_argument('session', help='session recorded with replay.SessionRecorder')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--profile', default='TRAW spins')
+    args = parser.parse_args()
+
+    replay = ReplayCortex(args.session, speed=1.0)
+    replay.set_wanted_profile(args.profile)
+    viz = VizServer(replay, port=args.port, fps=args.fps, subscribe=())
+    viz.start()
+    try:
+        replay.open()
+    finally:
+        viz.stop()
+
+if __name__ == '__main__':
+    main()
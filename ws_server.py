@@ -0,0 +1,271 @@
+"""
+Minimal threaded WebSocket (RFC 6455) and HTTP server built on the standard library
+
+Used by the local tools that need to serve a websocket, such as the mock Cortex
+service. Each client runs in its own thread; plain HTTP GET requests can be
+answered with an http_handler.
+"""
+
+import base64
+import hashlib
+import socket
+import socketserver
+import ssl
+import struct
+import threading
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class WebSocketConnection():
+    """
+    A server side websocket connection
+
+    Methods
+    -------
+    send_text(text):
+        To send a text message
+    send_binary(data):
+        To send a binary message
+    recv():
+        To receive the next text (str) or binary (bytes) message. Returns None when the connection is closed
+    close():
+        To close the connection with a close frame
+    abort():
+        To drop the connection without a close frame
+    """
+    def __init__(self, sock, path, headers):
+        self.sock = sock
+        self.path = path
+        self.headers = headers
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def _recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionClosed()
+            buf.extend(chunk)
+        return bytes(buf)
+
+    def _send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        size = len(payload)
+        if size < 126:
+            header.append(size)
+        elif size < 65536:
+            header.append(126)
+            header.extend(struct.pack('>H', size))
+        else:
+            header.append(127)
+            header.extend(struct.pack('>Q', size))
+        with self._send_lock:
+            if self.closed:
+                raise ConnectionClosed()
+            try:
+                self.sock.sendall(bytes(header) + payload)
+            except OSError:
+                self.closed = True
+                raise ConnectionClosed()
+
+    def send_text(self, text):
+        self._send_frame(OP_TEXT, text.encode('utf-8'))
+
+    def send_binary(self, data):
+        self._send_frame(OP_BINARY, bytes(data))
+
+    def _recv_frame(self):
+        b0, b1 = self._recv_exact(2)
+        fin = b0 & 0x80
+        opcode = b0 & 0x0F
+        size = b1 & 0x7F
+        if size == 126:
+            size, = struct.unpack('>H', self._recv_exact(2))
+        elif size == 127:
+            size, = struct.unpack('>Q', self._recv_exact(8))
+        mask = self._recv_exact(4) if b1 & 0x80 else None
+        payload = self._recv_exact(size)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return fin, opcode, payload
+
+    def recv(self):
+        message = bytearray()
+        message_op = None
+        try:
+            while True:
+                fin, opcode, payload = self._recv_frame()
+                if opcode == OP_PING:
+                    self._send_frame(OP_PONG, payload)
+                    continue
+                if opcode == OP_PONG:
+                    continue
+                if opcode == OP_CLOSE:
+                    self.close()
+                    return None
+                if opcode != OP_CONTINUATION:
+                    message_op = opcode
+                message.extend(payload)
+                if fin:
+                    break
+        except (ConnectionClosed, OSError):
+            self.closed = True
+            return None
+        if message_op == OP_TEXT:
+            return message.decode('utf-8')
+        return bytes(message)
+
+    def close(self):
+        try:
+            self._send_frame(OP_CLOSE, struct.pack('>H', 1000))
+        except ConnectionClosed:
+            pass
+        self.abort()
+
+    def abort(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.owner
+        sock = self.request
+        try:
+            request = b''
+            while b'\r\n\r\n' not in request:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+                if len(request) > 65536:
+                    return
+        except OSError:
+            return
+
+        lines = request.split(b'\r\n\r\n', 1)[0].decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        path = parts[1] if len(parts) > 1 else '/'
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        if headers.get('upgrade', '').lower() != 'websocket':
+            self._answer_http(server, sock, path)
+            return
+
+        accept = base64.b64encode(hashlib.sha1(
+            (headers.get('sec-websocket-key', '') + WS_GUID).encode('ascii')).digest()).decode('ascii')
+        sock.sendall(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: ' + accept + '\r\n\r\n').encode('ascii'))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = WebSocketConnection(sock, path, headers)
+        try:
+            server.on_connect(connection)
+        finally:
+            if not connection.closed:
+                connection.close()
+
+    def _answer_http(self, server, sock, path):
+        response = server.http_handler(path) if server.http_handler else None
+        if response is None:
+            status, content_type, body = '404 Not Found', 'text/plain', b'not found'
+        else:
+            status, content_type, body = response
+        head = ('HTTP/1.1 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n'
+                'Connection: close\r\n\r\n').format(status, content_type, len(body))
+        try:
+            sock.sendall(head.encode('ascii') + body)
+        except OSError:
+            pass
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, owner, ssl_context):
+        self.owner = owner
+        self.ssl_context = ssl_context
+        super().__init__(address, _Handler)
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, address
+
+
+class WebSocketServer():
+    """
+    A threaded websocket server
+
+    Attributes
+    ----------
+    on_connect : callable
+        called with a WebSocketConnection in the client thread. The connection is closed when it returns
+    http_handler : callable or None
+        called with the request path for plain HTTP requests, returns (status, content_type, body) or None for 404
+    port : int
+        the listening port (useful when port 0 was requested)
+
+    Methods
+    -------
+    start():
+        To start serving in a background thread
+    stop():
+        To stop serving
+    """
+    def __init__(self, on_connect, host='localhost', port=0, http_handler=None,
+                 certfile=None, keyfile=None):
+        self.on_connect = on_connect
+        self.http_handler = http_handler
+        ssl_context = None
+        if certfile:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(certfile, keyfile)
+        self._server = _TCPServer((host, port), self, ssl_context)
+        self.host = host
+        self.port = self._server.server_address[1]
+        self.scheme = 'wss' if ssl_context else 'ws'
+        self._thread = None
+
+    @property
+    def url(self):
+        return '{0}://{1}:{2}'.format(self.scheme, self.host, self.port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='WebSocketServer:{0}'.format(self.port), daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self._thread = threading.current_thread()
+        self._server.serve_forever()
+
+    def stop(self):
+        # shutdown() waits for serve_forever(), which never ran if start() was not called
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()